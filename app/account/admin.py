@@ -1,11 +1,17 @@
-from flask import session
+from collections import defaultdict
+
+from flask import session, flash
+from flask_admin import BaseView, expose
+from flask_admin.actions import action
 from flask_admin.contrib.sqla import ModelView
 
 from app.extensions import admin, db
-from app.models import EnrollmentTerm, GradeCalculation, Task
+from app.models import EnrollmentTerm, GradeCalculation, SyncRun, Task
+from app.task_utils import launch_task
+from utilities.cbl_calculator import CALCULATION_METHODS, DROP_LOWEST, OUTCOME_METHOD
 
 
-class CblModelView(ModelView):
+class AdminAccessMixin:
     def is_accessible(self):
         if "role" in session:
             return session["role"] == "Admin"
@@ -16,11 +22,43 @@ class CblModelView(ModelView):
         return "You're not supposed to be here."
 
 
+class CblModelView(AdminAccessMixin, ModelView):
+    pass
+
+
+def launch_regrade(term_ids=None):
+    """
+    Queues a regrade from the stored outcome results
+    :param term_ids: terms to regrade, None for the sync terms
+    :return: None
+    """
+    description = f"regrading terms {term_ids}" if term_ids else "regrading sync terms"
+    launch_task("regrade", description, term_ids=term_ids)
+    db.session.commit()
+    flash("Grades are being recalculated, they'll update in a few seconds.")
+
+
 class EnrollmentTermView(CblModelView):
     can_create = False
     can_delete = False
-    column_list = ("name", "current_term", "sync_term", "cut_off_date")
-    column_editable_list = ["current_term", "sync_term", "cut_off_date"]
+    column_list = (
+        "name",
+        "current_term",
+        "sync_term",
+        "cut_off_date",
+        "calculation_method",
+    )
+    column_editable_list = [
+        "current_term",
+        "sync_term",
+        "cut_off_date",
+        "calculation_method",
+    ]
+    form_choices = dict(
+        calculation_method=[(DROP_LOWEST, DROP_LOWEST)]
+        + [(method, method) for method in CALCULATION_METHODS if method != DROP_LOWEST]
+        + [(OUTCOME_METHOD, "outcome (each outcome's Canvas method)")]
+    )
 
     form_excluded_columns = [
         "id",
@@ -39,7 +77,32 @@ class EnrollmentTermView(CblModelView):
             "Only select columns that need to be synced for performance. Multiple terms can be selected"
         ),
         current_term="The term that will be displayed in the student/observer view. ONLY ONE can be selected at a time.",
+        cut_off_date="Changing this recalculates the term's grades automatically.",
+        calculation_method=(
+            "How each outcome's scores are averaged. drop_lowest is the school's rule, the others "
+            "are Canvas's calculation methods. Changing this recalculates the term's grades automatically."
+        ),
+    )
+
+    @action(
+        "regrade",
+        "Recalculate Grades",
+        "Recalculate grades for the selected terms from the stored outcome results?",
     )
+    def action_regrade(self, ids):
+        launch_regrade([int(_id) for _id in ids])
+
+    def on_model_change(self, form, model, is_created):
+        # Only the cut off date and calculation method affect grades
+        attrs = db.inspect(model).attrs
+        model.regrade_needed = (
+            attrs.cut_off_date.history.has_changes()
+            or attrs.calculation_method.history.has_changes()
+        )
+
+    def after_model_change(self, form, model, is_created):
+        if getattr(model, "regrade_needed", False):
+            launch_regrade([model.id])
 
 
 class GradeCriteriaView(CblModelView):
@@ -47,6 +110,13 @@ class GradeCriteriaView(CblModelView):
         grade_rank="1 = Highest grade. This order must be correct for grades to calculate correctly"
     )
 
+    # Any change to the grade cutoffs regrades the sync terms
+    def after_model_change(self, form, model, is_created):
+        launch_regrade()
+
+    def after_model_delete(self, model):
+        launch_regrade()
+
 class TaskView(CblModelView):
     column_editable_list = ["complete"]
     column_descriptions = dict(
@@ -54,6 +124,70 @@ class TaskView(CblModelView):
     )
 
 
+class SyncRunView(CblModelView):
+    can_create = False
+    can_edit = False
+    column_default_sort = ("id", True)
+    column_list = ("id", "kind", "started_at", "finished_at", "status")
+
+
+class SyncRunChartView(AdminAccessMixin, BaseView):
+    @expose("/")
+    def index(self):
+        runs = {}
+        stages = defaultdict(dict)
+        for row in SyncRun.stage_totals():
+            run = runs.setdefault(
+                row.id,
+                dict(
+                    label=f"{row.id} {row.started_at:%m/%d %H:%M}",
+                    kind=row.kind,
+                    status=row.status,
+                    duration=float(row.duration or 0),
+                    canvas_requests=0,
+                    canvas_bytes=0,
+                    rows_written=0,
+                    skipped=0,
+                    cpu_seconds=0.0,
+                    peak_rss_mb=0.0,
+                ),
+            )
+            stages[row.stage][row.id] = float(row.wall_seconds or 0)
+            run["canvas_requests"] += row.canvas_requests or 0
+            run["canvas_bytes"] += row.canvas_bytes or 0
+            run["rows_written"] += row.rows_written or 0
+            run["skipped"] += row.skipped or 0
+            run["cpu_seconds"] += float(row.cpu_seconds or 0)
+            run["peak_rss_mb"] = max(run["peak_rss_mb"], float(row.peak_rss_mb or 0))
+
+        run_ids = list(runs.keys())
+        chart = dict(
+            labels=[runs[run_id]["label"] for run_id in run_ids],
+            duration=[runs[run_id]["duration"] for run_id in run_ids],
+            stages={
+                stage: [seconds.get(run_id, 0) for run_id in run_ids]
+                for stage, seconds in stages.items()
+            },
+            canvas_requests=[runs[run_id]["canvas_requests"] for run_id in run_ids],
+            canvas_mb=[runs[run_id]["canvas_bytes"] / 1e6 for run_id in run_ids],
+            rows_written=[runs[run_id]["rows_written"] for run_id in run_ids],
+        )
+
+        latest = run_ids[-1] if run_ids else None
+        slowest = SyncRun.slowest_courses(latest) if latest else []
+        return self.render(
+            "admin/sync_runs.html",
+            chart=chart,
+            runs=[dict(id=run_id, **runs[run_id]) for run_id in reversed(run_ids)],
+            latest=latest,
+            slowest=slowest,
+        )
+
+
 admin.add_view(EnrollmentTermView(EnrollmentTerm, db.session))
 admin.add_view(GradeCriteriaView(GradeCalculation, db.session))
 admin.add_view(TaskView(Task, db.session))
+admin.add_view(SyncRunView(SyncRun, db.session, category="Sync Runs", name="Runs"))
+admin.add_view(
+    SyncRunChartView(name="Timings", endpoint="sync_timings", category="Sync Runs")
+)
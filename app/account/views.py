@@ -7,6 +7,7 @@ from flask import (
     request,
     redirect,
     make_response,
+    jsonify,
 )
 
 import pandas as pd
@@ -15,6 +16,7 @@ from pylti.flask import lti
 
 from app.extensions import db
 from app.models import Record, EnrollmentTerm, Task
+from app.sync_progress import get_sync_progress
 from app.queries import get_calculation_dictionaries, get_enrollment_term
 from app.user.views import get_user_dash_data
 from utilities.canvas_api import get_course_users
@@ -161,6 +163,23 @@ def manual_sync(lti=lti):
     return render_template("account/manual_sync.html", task=task, completed_task=completed_task)
 
 
+@blueprint.route("sync_progress/<task_id>")
+@lti(error=error, request="session", role="admin", app=app)
+def sync_progress(task_id, lti=lti):
+    """
+    Progress of a sync task, the manual sync page polls it every couple of seconds. Each
+    request returns straight away, so an open page doesn't hold a web worker.
+    :param task_id: Task id
+    :return: JSON progress, with the task's status and whether it's complete
+    """
+    task = Task.query.get(task_id)
+    if task is None:
+        return jsonify(complete=True)
+
+    details = get_sync_progress(current_app.redis, task_id) or task.details or {}
+    return jsonify(dict(details, status=task.status, complete=bool(task.complete)))
+
+
 @blueprint.route("run_sync")
 @lti(error=error, request="session", role="admin", app=app)
 def run_sync(lti=lti):
@@ -169,3 +188,13 @@ def run_sync(lti=lti):
     db.session.commit()
 
     return redirect(url_for("account.manual_sync"))
+
+
+@blueprint.route("run_regrade")
+@lti(error=error, request="session", role="admin", app=app)
+def run_regrade(lti=lti):
+    # Only recalculates grades from the database, no Canvas pull
+    task = launch_task('regrade', 'recalculating grades for the sync terms', job_timeout=1800)
+    db.session.commit()
+
+    return redirect(url_for("account.manual_sync"))
@@ -1,3 +1,4 @@
+import hmac
 import time
 import jwt
 import os
@@ -28,6 +29,7 @@ from app.models import (
     EnrollmentTerm,
 )
 from app.queries import get_calculation_dictionaries
+from app.live_events import queue_live_events
 
 from utilities.canvas_api import get_course_users
 
@@ -36,6 +38,8 @@ from utilities.helpers import make_outcome_avg_dicts, format_users, error
 
 # api secret
 SECRET_API = os.getenv('SECRET_API')
+# shared with the Canvas Live Events subscription, the endpoint is off without it
+LIVE_EVENTS_SECRET = os.getenv('LIVE_EVENTS_SECRET')
 
 blueprint = Blueprint(
     "api", __name__, url_prefix="/api/v1"
@@ -75,3 +79,26 @@ def dragon_time():
     results = db.session.execute(stmt)
     
     return jsonify([dict(row) for row in results])
+
+
+@blueprint.route("/live_events", methods=["POST"])
+def live_events():
+    """
+    Receives Canvas Live Events (a single event or a list) and queues them for the
+    live events worker. The token comes in the X-Live-Events-Token header or the token
+    query parameter of the subscription url.
+    """
+    if not LIVE_EVENTS_SECRET:
+        return jsonify({'message': 'live events are not enabled'}), 404
+
+    token = request.headers.get('X-Live-Events-Token') or request.args.get('token', '')
+    if not hmac.compare_digest(token, LIVE_EVENTS_SECRET):
+        return jsonify({'message': 'a valid token is missing'}), 401
+
+    payload = request.get_json(silent=True)
+    if payload is None:
+        return jsonify({'message': 'expected a JSON body'}), 400
+    events = payload if isinstance(payload, list) else [payload]
+
+    queued = queue_live_events(current_app.redis, events)
+    return jsonify({'received': len(events), 'queued': queued}), 202
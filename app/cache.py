@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""Redis cache for computed dashboard payloads.
+
+Payloads are JSON, keyed by view, course/user, term and the latest record id, so a new
+sync naturally misses. create_record also bumps a generation counter, which drops the
+whole namespace at once. The number of entries is bounded separately from Redis' own eviction
+because the same instance holds the rq queues.
+"""
+import json
+import os
+import time
+
+import redis
+from flask import current_app
+
+CACHE_PREFIX = "dashboard-cache"
+GENERATION_KEY = f"{CACHE_PREFIX}:generation"
+INDEX_KEY = f"{CACHE_PREFIX}:index"
+
+CACHE_TTL = int(os.getenv("DASHBOARD_CACHE_TTL", 6 * 60 * 60))
+CACHE_MAX_ENTRIES = int(os.getenv("DASHBOARD_CACHE_MAX_ENTRIES", 20000))
+
+
+def _cache_key(redis_conn, view, key_parts, record_id):
+    generation = int(redis_conn.get(GENERATION_KEY) or 0)
+    parts = ":".join(str(part) for part in key_parts)
+    return f"{CACHE_PREFIX}:{generation}:{view}:{parts}:{record_id}"
+
+
+def _evict(redis_conn):
+    # Drop the least recently used entries once the cache is over its size
+    overflow = redis_conn.zcard(INDEX_KEY) - CACHE_MAX_ENTRIES
+    if overflow > 0:
+        oldest = [key for key, _ in redis_conn.zpopmin(INDEX_KEY, overflow)]
+        if oldest:
+            redis_conn.delete(*oldest)
+
+
+def get_or_set(redis_conn, view, key_parts, record_id, compute):
+    """
+    Returns the cached payload or computes and stores it. The dashboard still works
+    (uncached) if Redis is unavailable.
+    :param redis_conn: Redis connection
+    :param view: name of the view the payload belongs to
+    :param key_parts: course/user/term ids that identify the payload
+    :param record_id: latest record id
+    :param compute: function returning a JSON serializable payload
+    :return: payload
+    """
+    try:
+        key = _cache_key(redis_conn, view, key_parts, record_id)
+        cached = redis_conn.get(key)
+        if cached is not None:
+            redis_conn.zadd(INDEX_KEY, {key: time.time()})
+            return json.loads(cached)
+    except redis.exceptions.RedisError as e:
+        current_app.logger.warning(f"Dashboard cache unavailable: {e}")
+        return compute()
+
+    payload = compute()
+    try:
+        pipe = redis_conn.pipeline()
+        pipe.set(key, json.dumps(payload), ex=CACHE_TTL)
+        pipe.zadd(INDEX_KEY, {key: time.time()})
+        pipe.execute()
+        _evict(redis_conn)
+    except redis.exceptions.RedisError as e:
+        current_app.logger.warning(f"Dashboard cache unavailable: {e}")
+    return payload
+
+
+def cached_payload(view, key_parts, record_id, compute):
+    return get_or_set(current_app.redis, view, key_parts, record_id, compute)
+
+
+def invalidate(redis_conn):
+    """
+    Invalidates every cached dashboard. Old entries become unreachable immediately and
+    are removed from the index here (their TTL cleans up anything else).
+    :param redis_conn: Redis connection
+    :return: None
+    """
+    pipe = redis_conn.pipeline()
+    pipe.incr(GENERATION_KEY)
+    pipe.zrange(INDEX_KEY, 0, -1)
+    pipe.delete(INDEX_KEY)
+    _, keys, _ = pipe.execute()
+    if keys:
+        redis_conn.delete(*keys)
+
+
+def invalidate_dashboards():
+    """
+    Invalidates the dashboard cache from outside the app (the sync jobs), a sync never
+    fails because Redis is down or not configured.
+    :return: None
+    """
+    redis_url = os.getenv("REDIS_URL")
+    if not redis_url:
+        return
+    try:
+        invalidate(redis.Redis.from_url(redis_url))
+    except redis.exceptions.RedisError as e:
+        print(f"Could not invalidate the dashboard cache: {e}")
@@ -11,6 +11,7 @@ from flask import (
 )
 from pylti.flask import lti
 
+from app.cache import cached_payload
 from app.extensions import db
 from app.models import (
     Outcome,
@@ -29,7 +30,12 @@ from app.queries import get_calculation_dictionaries
 from utilities.canvas_api import get_course_users
 
 # from utilities.cbl_calculator import calculation_dictionaries
-from utilities.helpers import make_outcome_avg_dicts, format_users, error
+from utilities.helpers import (
+    make_outcome_avg_dicts,
+    grade_outcome_avg_dicts,
+    format_users,
+    error,
+)
 
 blueprint = Blueprint(
     "course", __name__, url_prefix="/courses", static_folder="../static"
@@ -82,56 +88,77 @@ def dashboard(lti=lti):
         .all()
     )
 
-    # Query Grades
-    grades = (
-        Grade.query.join(Grade.user)
-        .options(db.joinedload(Grade.user, innerjoin=True))
-        .filter(
-            # Grade.record_id == record.id,
-            Grade.course_id
-            == course_id
+    def load_dashboard():
+        # Query Grades
+        grades = (
+            Grade.query.join(Grade.user)
+            .options(db.joinedload(Grade.user, innerjoin=True))
+            .filter(
+                # Grade.record_id == record.id,
+                Grade.course_id
+                == course_id
+            )
+            .order_by(User.name)
+            .all()
         )
-        .order_by(User.name)
-        .all()
-    )
-    # grade_schema = GradeSchema()
-    # grades = grade_schema.dump(grades, many=True)
-
-    # Base query
-    base_query = OutcomeResult.query.filter(OutcomeResult.course_id == course_id)
-
-    # Get outcome info
-    outcome_ids = base_query.with_entities(OutcomeResult.outcome_id).distinct().all()
-    if outcome_ids:
-        outcome_id_list = list(zip(*outcome_ids))[0]
-    else:
-        outcome_id_list = []
-    outcomes = Outcome.query.filter(Outcome.id.in_(outcome_id_list)).all()
-    outcome_schema = OutcomeSchema()
-    outcomes = outcome_schema.dump(outcomes, many=True)
-
-    # Get course outcome_results
-    outcome_results = (
-        OutcomeResult.query.options(db.joinedload(OutcomeResult.course, innerjoin=True))
-        .filter(OutcomeResult.score.isnot(None), OutcomeResult.course_id == course_id)
-        .order_by(OutcomeResult.user_id, OutcomeResult.outcome_id)
-        .all()
+        # grade_schema = GradeSchema()
+        # grades = grade_schema.dump(grades, many=True)
+
+        if all(grade.outcomes is not None for grade in grades):
+            # Outcome averages are stored with the grades at sync time
+            outcome_id_list = sorted(
+                {
+                    outcome["outcome_id"]
+                    for grade in grades
+                    for outcome in grade.outcomes
+                }
+            )
+            grades = grade_outcome_avg_dicts(grades)
+        else:
+            # Grades synced before the averages were stored, use the outcome results
+            base_query = OutcomeResult.query.filter(
+                OutcomeResult.course_id == course_id
+            )
+            outcome_ids = (
+                base_query.with_entities(OutcomeResult.outcome_id).distinct().all()
+            )
+            outcome_id_list = list(zip(*outcome_ids))[0] if outcome_ids else []
+
+            outcome_results = (
+                OutcomeResult.query.options(
+                    db.joinedload(OutcomeResult.course, innerjoin=True)
+                )
+                .filter(
+                    OutcomeResult.score.isnot(None),
+                    OutcomeResult.course_id == course_id,
+                )
+                .order_by(OutcomeResult.user_id, OutcomeResult.outcome_id)
+                .all()
+            )
+            grades = make_outcome_avg_dicts(outcome_results, grades, current_term)
+
+        # Get outcome info
+        outcomes = Outcome.query.filter(Outcome.id.in_(outcome_id_list)).all()
+        outcome_schema = OutcomeSchema()
+        outcomes = outcome_schema.dump(outcomes, many=True)
+        return {"grades": grades, "outcomes": outcomes}
+
+    payload = cached_payload(
+        "course_dashboard",
+        [course_id, current_term.id],
+        record.id if record else None,
+        load_dashboard,
     )
-    # res_schema = OutcomeResultSchema()
-    # alignments = res_schema.dump(outcome_results, many=True)
-
-    # grade dictionaries
-    grades = make_outcome_avg_dicts(outcome_results, grades, current_term)
 
     calculation_dictionaries = get_calculation_dictionaries()
     return render_template(
         "courses/dashboard.html",
         users=users,
-        grades=grades,
+        grades=payload["grades"],
         calculation_dict=calculation_dictionaries,
         record=record,
         course_id=course_id,
-        outcomes=outcomes,
+        outcomes=payload["outcomes"],
         # alignments=alignments
     )
 
@@ -204,26 +231,31 @@ def detail(course_id=357, user_id=384, lti=lti):
 def analytics(course_id=None, lti=lti):
     if not course_id:
         course_id = session["course_id"]
-    results = [grade for grade in Course.course_grades(course_id)]
-    num_outcomes = (
-        OutcomeResult.query.filter(OutcomeResult.course_id == course_id)
-        .with_entities(OutcomeResult.outcome_id)
-        .distinct()
-        .count()
+    record = Record.query.order_by(Record.id.desc()).first()
+
+    def load_analytics():
+        results = [grade for grade in Course.course_grades(course_id)]
+        keys = ["title", "id", "max", "min"]
+        outcome_stats = [
+            dict(zip(keys, out)) for out in Course.outcome_stats(course_id)
+        ]
+
+        graph = [
+            {
+                "x": [grade[0] for grade in results],
+                "y": [grade[1] for grade in results],
+                "type": "bar",
+            }
+        ]
+        return {"graph": graph, "outcome_stats": outcome_stats}
+
+    payload = cached_payload(
+        "course_analytics", [course_id], record.id if record else None, load_analytics
     )
-    keys = ["title", "id", "max", "min"]
-    outcome_stats = [dict(zip(keys, out)) for out in Course.outcome_stats(course_id)]
-    print(outcome_stats)
-
-    graph = [
-        {
-            "x": [grade[0] for grade in results],
-            "y": [grade[1] for grade in results],
-            "type": "bar",
-        }
-    ]
 
     return render_template(
-        "courses/analytics.html", graph=graph, outcome_stats=outcome_stats
+        "courses/analytics.html",
+        graph=payload["graph"],
+        outcome_stats=payload["outcome_stats"],
     )
 
@@ -17,6 +17,7 @@ class EnrollmentTerm(db.Model):
     sis_term_id = db.Column(db.String)
     sis_import_id = db.Column(db.Integer)
     cut_off_date = db.Column(db.DateTime)
+    calculation_method = db.Column(db.String)
 
     current_term = db.Column(db.Boolean, server_default="false", nullable=False)
     sync_term = db.Column(db.Boolean, server_default="false", nullable=False)
@@ -40,6 +41,8 @@ class Course(db.Model):
     name = db.Column(db.String)
     enrollment_term_id = db.Column(db.Integer, db.ForeignKey("enrollment_terms.id"))
     sis_course_id = db.Column(db.String)
+    # Digest of the roster last written, the roster sync skips courses that match
+    roster_digest = db.Column(db.String)
 
     grades = db.relationship("Grade", backref="course")
     courses = db.relationship("CourseUserLink", backref="course")
@@ -121,6 +124,7 @@ class User(db.Model):
     name = db.Column(db.String)
     sis_user_id = db.Column(db.String)
     login_id = db.Column(db.String)
+    content_hash = db.Column(db.String)
 
     grades = db.relationship("Grade", backref="user", lazy="dynamic")
     courses = db.relationship("CourseUserLink", backref="user")
@@ -149,6 +153,10 @@ class Outcome(db.Model):
     title = db.Column(db.String, nullable=False)
     display_name = db.Column(db.String)
     calculation_int = db.Column(db.Integer)
+    calculation_method = db.Column(db.String)
+    mastery_points = db.Column(db.Float)
+    content_hash = db.Column(db.String)
+    checked_at = db.Column(db.DateTime)
     outcome_results = db.relationship("OutcomeResult", backref="outcome")
 
     def __repr__(self):
@@ -159,6 +167,8 @@ class Alignment(db.Model):
     __tablename__ = "alignments"
     id = db.Column(db.String, primary_key=True)
     name = db.Column(db.String)
+    content_hash = db.Column(db.String)
+    checked_at = db.Column(db.DateTime)
 
     outcome_results = db.relationship("OutcomeResult", backref="alignment")
 
@@ -170,6 +180,134 @@ class CourseUserLink(db.Model):
     section_id = db.Column(db.Integer)
     section_name = db.Column(db.String)
 
+class CourseSyncState(db.Model):
+    """High-water mark, result ids and digest from the last incremental results sync"""
+    __tablename__ = "course_sync_state"
+    course_id = db.Column(db.Integer, db.ForeignKey("courses.id"), primary_key=True)
+    high_water_mark = db.Column(db.DateTime)
+    result_ids = db.Column(db.ARRAY(db.Integer))
+    synced_at = db.Column(db.DateTime)
+    results_digest = db.Column(db.String)
+
+
+class OutcomeResultStaging(db.Model):
+    """Shadow copy of outcome_results changes, published per term by staged syncs"""
+    __tablename__ = "outcome_results_staging"
+    id = db.Column(db.Integer, primary_key=True)
+    term_id = db.Column(db.Integer, nullable=False, index=True)
+    deleted = db.Column(db.Boolean, nullable=False, default=False)
+    score = db.Column(db.Float)
+    course_id = db.Column(db.Integer)
+    user_id = db.Column(db.Integer)
+    outcome_id = db.Column(db.Integer)
+    alignment_id = db.Column(db.String)
+    submitted_or_assessed_at = db.Column(db.DateTime)
+    last_updated = db.Column(db.DateTime)
+    enrollment_term = db.Column(db.Integer)
+
+
+class CourseSyncStateStaging(db.Model):
+    __tablename__ = "course_sync_state_staging"
+    course_id = db.Column(db.Integer, primary_key=True)
+    term_id = db.Column(db.Integer, nullable=False, index=True)
+    high_water_mark = db.Column(db.DateTime)
+    result_ids = db.Column(db.ARRAY(db.Integer))
+    synced_at = db.Column(db.DateTime)
+    results_digest = db.Column(db.String)
+
+
+class SyncRun(db.Model):
+    """Ledger entry for one sync (or regrade) run"""
+    __tablename__ = "sync_runs"
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String)
+    checkpoint_run_id = db.Column(db.String(36), index=True)
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+    status = db.Column(db.String)
+
+    stages = db.relationship("SyncRunStage", backref="sync_run", lazy="dynamic")
+
+    @staticmethod
+    def stage_totals(limit=60):
+        """Per-stage totals for the latest sync runs, course rows are summed as one stage"""
+        stmt = db.text(
+            """
+            SELECT r.id, r.kind, r.started_at, r.status,
+                EXTRACT(EPOCH FROM r.finished_at - r.started_at) AS duration,
+                s.stage,
+                sum(s.wall_seconds) AS wall_seconds,
+                sum(s.cpu_seconds) AS cpu_seconds,
+                max(s.peak_rss_mb) AS peak_rss_mb,
+                sum(s.canvas_requests) AS canvas_requests,
+                sum(s.canvas_bytes) AS canvas_bytes,
+                sum(s.rows_written) AS rows_written,
+                sum(s.skipped) AS skipped
+            FROM (SELECT * FROM sync_runs WHERE kind != 'regrade'
+                  ORDER BY id DESC LIMIT :limit) r
+                JOIN sync_run_stages s ON s.sync_run_id = r.id
+            WHERE s.course_id IS NULL OR r.kind = 'full_sync'
+            GROUP BY r.id, r.kind, r.started_at, r.status, r.finished_at, s.stage
+            ORDER BY r.id, s.stage;
+        """
+        )
+        return db.session.execute(stmt, dict(limit=limit))
+
+    @staticmethod
+    def slowest_courses(sync_run_id, limit=25):
+        stmt = db.text(
+            """
+            SELECT s.course_id, c.name, s.wall_seconds, s.canvas_requests,
+                s.results, s.rows_written, s.failed
+            FROM sync_run_stages s
+                LEFT JOIN courses c ON c.id = s.course_id
+            WHERE s.sync_run_id = :sync_run_id AND s.course_id IS NOT NULL
+            ORDER BY s.wall_seconds DESC NULLS LAST
+            LIMIT :limit;
+        """
+        )
+        return db.session.execute(stmt, dict(sync_run_id=sync_run_id, limit=limit))
+
+
+class SyncRunStage(db.Model):
+    """Timings and counts for one stage of a sync run, or one course if course_id is set"""
+    __tablename__ = "sync_run_stages"
+    id = db.Column(db.Integer, primary_key=True)
+    sync_run_id = db.Column(
+        db.Integer, db.ForeignKey("sync_runs.id"), nullable=False, index=True
+    )
+    stage = db.Column(db.String, nullable=False)
+    term_id = db.Column(db.Integer)
+    course_id = db.Column(db.Integer)
+    wall_seconds = db.Column(db.Float)
+    cpu_seconds = db.Column(db.Float)
+    peak_rss_mb = db.Column(db.Float)
+    canvas_requests = db.Column(db.Integer)
+    canvas_bytes = db.Column(db.BigInteger)
+    rows_written = db.Column(db.Integer)
+    results = db.Column(db.Integer)
+    skipped = db.Column(db.Integer)
+    failed = db.Column(db.Boolean)
+    recorded_at = db.Column(db.DateTime)
+
+
+class SyncCheckpoint(db.Model):
+    """A finished stage (or course) of a sync run, so a restarted sync can resume"""
+    __tablename__ = "sync_checkpoints"
+    sync_run_id = db.Column(db.String(36), primary_key=True)
+    stage = db.Column(db.String, primary_key=True)
+    item_id = db.Column(db.String, primary_key=True, default="")
+    completed_at = db.Column(db.DateTime)
+
+
+class GradeDirtyPair(db.Model):
+    """A student's course whose outcome results changed since its grade was calculated"""
+    __tablename__ = "grade_dirty_pairs"
+    user_id = db.Column(db.Integer, primary_key=True)
+    course_id = db.Column(db.Integer, primary_key=True)
+    marked_at = db.Column(db.DateTime)
+
+
 class GradeCalculation(db.Model):
     __tablename__ = "grade_calculation"
     id = db.Column(db.Integer, primary_key=True)
@@ -197,6 +335,8 @@ class Task(db.Model):
     status = db.Column(db.String())
     started_at = db.Column(db.DateTime, default=db.func.current_timestamp())
     completed_at = db.Column(db.DateTime)
+    # Latest sync progress: stage, courses done/total, results, rows/s, ETA
+    details = db.Column(db.JSON)
 
     def get_rq_job(self):
         try:
@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+"""Live progress of a running sync.
+
+The course jobs of a fanned out sync run in separate worker processes, so the counters
+live in a Redis hash and are updated atomically. The derived numbers (percent, rows per
+second, ETA) are calculated when the progress is read.
+
+The course jobs are also counted off in Redis as they end, so the last one can start the
+sync's finish_sync job whether or not the others succeeded.
+"""
+import json
+import time
+
+from rq.job import Job
+
+PROGRESS_TTL = 2 * 24 * 60 * 60
+
+# Percent of the task reached when each stage starts, the course stage fills the gap
+STAGE_PERCENT = {
+    "terms": 1,
+    "users": 2,
+    "courses": 4,
+    "rosters": 5,
+    "outcome results": 5,
+    "grades": 90,
+    "complete": 100,
+}
+COURSES_START, COURSES_END = 5, 90
+
+
+def _progress_key(task_id):
+    return f"sync-progress:{task_id}"
+
+
+def start_sync_progress(redis_conn, task_id, total=0):
+    key = _progress_key(task_id)
+    pipe = redis_conn.pipeline()
+    pipe.hset(
+        key,
+        mapping={
+            "stage": "terms",
+            "courses_total": total,
+            "courses_done": 0,
+            "courses_failed": 0,
+            "results": 0,
+            "canvas_requests": 0,
+            "started_at": time.time(),
+        },
+    )
+    pipe.expire(key, PROGRESS_TTL)
+    pipe.execute()
+
+
+def set_sync_stage(redis_conn, task_id, stage, total=None):
+    key = _progress_key(task_id)
+    mapping = {"stage": stage}
+    if total is not None:
+        mapping["courses_total"] = total
+    if stage in ("grades", "complete"):
+        mapping["courses_finished_at"] = time.time()
+    pipe = redis_conn.pipeline()
+    pipe.hset(key, mapping=mapping)
+    if stage == "outcome results":
+        # Rows per second and the ETA are measured over the course stage only
+        pipe.hsetnx(key, "courses_started_at", time.time())
+    pipe.execute()
+
+
+def add_sync_courses(redis_conn, task_id, total):
+    # Serial syncs learn the course count one term at a time
+    redis_conn.hincrby(_progress_key(task_id), "courses_total", total)
+
+
+def record_course_progress(redis_conn, task_id, synced, results=0, canvas_requests=0):
+    """
+    Adds a finished course to the sync's counters
+    :param redis_conn: Redis connection
+    :param task_id: id of the task running the sync
+    :param synced: False if the course failed
+    :param results: outcome results received from Canvas
+    :param canvas_requests: Canvas API requests made for the course
+    :return: None
+    """
+    key = _progress_key(task_id)
+    pipe = redis_conn.pipeline()
+    pipe.hincrby(key, "courses_done", 1)
+    pipe.hincrby(key, "courses_failed", 0 if synced else 1)
+    pipe.hincrby(key, "results", results)
+    pipe.hincrby(key, "canvas_requests", canvas_requests)
+    pipe.execute()
+
+
+def get_sync_progress(redis_conn, task_id):
+    """
+    Reads a sync's progress
+    :param redis_conn: Redis connection
+    :param task_id: id of the task running the sync
+    :return: progress dictionary or None if the sync isn't tracked
+    """
+    raw = redis_conn.hgetall(_progress_key(task_id))
+    if not raw:
+        return None
+    raw = {k.decode(): v.decode() for k, v in raw.items()}
+
+    now = time.time()
+    done = int(raw["courses_done"])
+    total = int(raw["courses_total"])
+    results = int(raw["results"])
+    stage = raw["stage"]
+    courses_started_at = float(raw.get("courses_started_at") or now)
+    if stage == "outcome results" or not raw.get("courses_finished_at"):
+        elapsed = now - courses_started_at
+    else:
+        elapsed = float(raw["courses_finished_at"]) - courses_started_at
+
+    if stage == "outcome results" and total:
+        percent = COURSES_START + (COURSES_END - COURSES_START) * done / total
+    else:
+        percent = STAGE_PERCENT.get(stage, 0)
+
+    eta = None
+    if stage == "outcome results" and 0 < done < total:
+        eta = round(elapsed / done * (total - done))
+
+    return {
+        "stage": stage,
+        "percent": round(percent),
+        "courses_done": done,
+        "courses_total": total,
+        "courses_failed": int(raw["courses_failed"]),
+        "results": results,
+        "rows_per_second": round(results / elapsed, 1) if elapsed > 0 else 0.0,
+        "canvas_requests": int(raw["canvas_requests"]),
+        "elapsed": round(now - float(raw["started_at"])),
+        "eta": eta,
+    }
+
+
+def _course_jobs_key(task_id):
+    return f"sync-course-jobs:{task_id}"
+
+
+def start_course_jobs(redis_conn, task_id, total, finish_job_id):
+    """
+    Starts counting a fanned out sync's course jobs, call it before enqueuing them
+    :param redis_conn: Redis connection
+    :param task_id: id of the task running the sync
+    :param total: number of course jobs
+    :param finish_job_id: id of the saved, not yet enqueued, finish_sync job
+    :return: None
+    """
+    key = _course_jobs_key(task_id)
+    pipe = redis_conn.pipeline()
+    pipe.hset(key, mapping={"total": total, "finish_job_id": finish_job_id})
+    pipe.expire(key, PROGRESS_TTL)
+    pipe.execute()
+
+
+def end_course_job(redis_conn, queue, task_id, job_id, result=None):
+    """
+    Counts a course job as ended, whether it synced, failed or its work horse died. The
+    last one to end enqueues the finish_sync job.
+    :param redis_conn: Redis connection
+    :param queue: rq Queue the finish_sync job is enqueued on
+    :param task_id: id of the task running the sync
+    :param job_id: course job id
+    :param result: the job's result dictionary, None if it died without one
+    :return: False if the job had already been counted
+    """
+    key = _course_jobs_key(task_id)
+    pipe = redis_conn.pipeline()
+    pipe.sadd(f"{key}:ended", job_id)
+    pipe.scard(f"{key}:ended")
+    pipe.hget(key, "total")
+    pipe.expire(f"{key}:ended", PROGRESS_TTL)
+    if result is not None:
+        # Stored with the count, finish_sync may start as soon as the last job is counted
+        pipe.hsetnx(f"{key}:results", job_id, json.dumps(result))
+        pipe.expire(f"{key}:results", PROGRESS_TTL)
+    added, ended, total = pipe.execute()[:3]
+    if not added:
+        return False
+
+    # hsetnx makes sure only one job enqueues it, even if the last two end together
+    if total is not None and ended >= int(total) and redis_conn.hsetnx(key, "finishing", 1):
+        finish_job_id = redis_conn.hget(key, "finish_job_id").decode()
+        queue.enqueue_job(Job.fetch(finish_job_id, connection=redis_conn))
+    return True
+
+
+def get_course_job_results(redis_conn, task_id):
+    """
+    :param redis_conn: Redis connection
+    :param task_id: id of the task running the sync
+    :return: dictionary of course job id to result dictionary, jobs that died are missing
+    """
+    raw = redis_conn.hgetall(f"{_course_jobs_key(task_id)}:results")
+    return {k.decode(): json.loads(v) for k, v in raw.items()}
@@ -1,10 +1,30 @@
 import time
+import uuid
 from rq import get_current_job
+from rq.exceptions import NoSuchJobError
+from rq.job import Job, JobStatus
 from app.app import create_app
 from app.models import Task
 from app.extensions import db
 from flask import current_app
-from cron import run
+from app.sync_progress import (
+    start_sync_progress,
+    set_sync_stage,
+    add_sync_courses,
+    record_course_progress,
+    get_sync_progress,
+    start_course_jobs,
+    end_course_job,
+    get_course_job_results,
+)
+from utilities.canvas_client import client
+from cron import (
+    run,
+    regrade as run_regrade,
+    prepare_sync,
+    sync_course as run_sync_course,
+    finish_sync as run_finish_sync,
+)
 import sys
 import traceback
 import datetime
@@ -21,27 +41,239 @@ def launch_task(name, description, *args, **kwargs):
     return task
 
 
-def _set_task_progress(progress, status=None):
-    job = get_current_job()
+COURSE_JOB_TIMEOUT = 30 * 60
+FINISH_JOB_TIMEOUT = 2 * 60 * 60
+
+
+def _set_task_progress(progress, status=None, task_id=None, details=None):
+    # A fanned out sync reports on the task that launched it, whose job may have expired
+    if task_id:
+        try:
+            job = Job.fetch(task_id, connection=app.redis)
+        except NoSuchJobError:
+            job = None
+    else:
+        job = get_current_job()
+        task_id = job.get_id() if job else None
     if job:
         job.meta['progress'] = progress
+        if details is not None:
+            job.meta['details'] = details
         job.save_meta()
-        task = Task.query.get(job.get_id())
+    if task_id:
+        task = Task.query.get(task_id)
         if status:
             task.status = status
+        if details is not None:
+            task.details = details
         if progress >= 100:
             task.complete = True
             task.completed_at = db.func.current_timestamp()
         db.session.commit()
 
 
-def full_sync():
+def _describe_progress(details):
+    if details["stage"] != "outcome results":
+        return details["stage"]
+    status = (
+        f"syncing courses: {details['courses_done']} of {details['courses_total']}, "
+        f"{details['results']} results at {details['rows_per_second']} rows/s, "
+        f"{details['canvas_requests']} Canvas requests"
+    )
+    if details["eta"] is not None:
+        status += f", about {details['eta'] // 60 + 1} min left"
+    return status
+
+
+class TaskProgress(object):
+    """
+    Progress reporter handed to the sync: keeps the counters in Redis (shared by every
+    course job) and copies the latest numbers to the rq job meta and the Task row
+    """
+
+    def __init__(self, task_id):
+        self.task_id = task_id
+        self._requests_seen = client.get_stats()["requests"]
+
+    def start(self):
+        start_sync_progress(app.redis, self.task_id)
+        self.publish()
+
+    def stage(self, stage):
+        set_sync_stage(app.redis, self.task_id, stage)
+        self.publish()
+
+    def add_courses(self, total):
+        add_sync_courses(app.redis, self.task_id, total)
+
+    def course_done(
+        self, course_id, synced, results, canvas_requests=None, **course_stats
+    ):
+        if canvas_requests is None:
+            # Same process as the Canvas client, count what it made since the last course
+            requests = client.get_stats()["requests"]
+            canvas_requests = requests - self._requests_seen
+            self._requests_seen = requests
+        record_course_progress(
+            app.redis, self.task_id, synced, results, canvas_requests
+        )
+        self.publish()
+
+    def publish(self, status=None):
+        details = get_sync_progress(app.redis, self.task_id)
+        if details is None:
+            return
+        _set_task_progress(
+            details["percent"],
+            status or _describe_progress(details),
+            task_id=self.task_id,
+            details=details,
+        )
+
+    def finish(self, status):
+        set_sync_stage(app.redis, self.task_id, "complete")
+        self.publish(status)
+
+
+def _sync_failed(task_id, e):
+    _set_task_progress(100, f"The following error ocurred, check the logs for more information: {e}", task_id=task_id)
+    traceback.format_exception(*sys.exc_info())
+
+
+def full_sync(staged=None):
+    """
+    Fans the sync out over the rq workers: this job updates terms, users and courses,
+    enqueues a sync_course job per course and saves a finish_sync job that the last
+    course job to end enqueues, whether or not the courses synced. The task completes
+    when finish_sync does. Relaunching after a crash resumes the unfinished sync run and
+    only enqueues the courses it hadn't finished.
+
+    The courses sync as many at a time as there are rq workers, so there's no workers
+    setting like serial_sync's.
+    """
+    task_id = get_current_job().get_id()
+    progress = TaskProgress(task_id)
     try:
         _set_task_progress(0, "job started")
-        run()
+        progress.start()
+        sync_run_id, ledger_id, term_courses = prepare_sync(
+            staged=staged, progress=progress
+        )
+
+        # The job ids are known up front, so finish_sync can be saved before any course
+        # job could end
+        course_jobs = [
+            (str(uuid.uuid4()), term, course)
+            for term, courses in term_courses
+            for course in courses
+        ]
+        course_ids = {job_id: course["id"] for job_id, _, course in course_jobs}
+        finish_job = app.task_queue.create_job(
+            "app.tasks.finish_sync",
+            args=([term for term, _ in term_courses], course_ids, task_id),
+            kwargs=dict(staged=staged, sync_run_id=sync_run_id, ledger_id=ledger_id),
+            timeout=FINISH_JOB_TIMEOUT,
+            status=JobStatus.DEFERRED,
+        )
+        finish_job.save()
+        start_course_jobs(app.redis, task_id, len(course_jobs), finish_job.get_id())
+
+        progress.add_courses(len(course_jobs))
+        progress.stage("outcome results")
+        for job_id, term, course in course_jobs:
+            app.task_queue.enqueue(
+                "app.tasks.sync_course",
+                term,
+                course,
+                staged=staged,
+                sync_run_id=sync_run_id,
+                ledger_id=ledger_id,
+                task_id=task_id,
+                job_id=job_id,
+                job_timeout=COURSE_JOB_TIMEOUT,
+            )
+        if not course_jobs:
+            app.task_queue.enqueue_job(finish_job)
+    except Exception as e:
+        _sync_failed(task_id, e)
+        raise
+    print('Courses enqueued')
+
+
+def sync_course(
+    term, course, staged=None, sync_run_id=None, ledger_id=None, task_id=None
+):
+    # Never raise, the job has to end normally to be counted for finish_sync. A work
+    # horse that dies is counted by SyncWorker instead.
+    try:
+        result = run_sync_course(
+            term, course, staged=staged, sync_run_id=sync_run_id, ledger_id=ledger_id
+        )
+    except Exception as e:
+        print(f'Error syncing course {course["id"]}: {e}')
+        traceback.print_exc()
+        result = dict(synced=False, results=0, canvas_requests=0)
+
+    if task_id:
+        job_id = get_current_job().get_id()
+        if end_course_job(app.redis, app.task_queue, task_id, job_id, result):
+            TaskProgress(task_id).course_done(course["id"], **result)
+    return result
+
+
+def finish_sync(
+    terms, course_ids, task_id, staged=None, sync_run_id=None, ledger_id=None
+):
+    progress = TaskProgress(task_id)
+    try:
+        # A course whose job died has no result
+        results = get_course_job_results(app.redis, task_id)
+        failed = [
+            course_id
+            for job_id, course_id in course_ids.items()
+            if not results.get(job_id, {}).get("synced")
+        ]
+        skipped = sum(result.get("skipped", 0) for result in results.values())
+        print(f"{skipped} of {len(course_ids)} courses unchanged since the last sync")
+        run_finish_sync(
+            terms,
+            staged=staged,
+            sync_run_id=sync_run_id,
+            progress=progress,
+            ledger_id=ledger_id,
+        )
+    except Exception as e:
+        _sync_failed(task_id, e)
+        raise
+    if failed:
+        progress.finish(f"The sync completed, but these courses failed: {failed}")
+    else:
+        progress.finish("The sync completed successfully.")
+    print('Task Completed')
+
+
+def serial_sync(workers=None, staged=None):
+    """Runs the whole sync inside this job, the way full_sync used to"""
+    task_id = get_current_job().get_id()
+    progress = TaskProgress(task_id)
+    try:
+        _set_task_progress(0, "job started")
+        progress.start()
+        run(workers=workers, staged=staged, progress=progress)
+    except Exception as e:
+        _sync_failed(task_id, e)
+        raise
+    progress.finish("The sync completed successfully.")
+    print('Task Completed')
+
+
+def regrade(term_ids=None):
+    try:
+        _set_task_progress(0, "regrade started")
+        run_regrade(term_ids)
     except Exception as e:
         _set_task_progress(100, f"The following error ocurred, check the logs for more information: {e}")
         traceback.format_exception(*sys.exc_info())
         raise
-    _set_task_progress(100, "The sync completed successfully.")
+    _set_task_progress(100, "The regrade completed successfully.")
     print('Task Completed')
@@ -11,6 +11,7 @@ from flask import (
 )
 from pylti.flask import lti
 
+from app.cache import cached_payload
 from app.extensions import db
 from app.models import (
     Course,
@@ -177,10 +178,18 @@ def get_user_dash_data(user_id):
         ORDER BY  ores.course_id, ores.outcome_id;
         """
     )
-    outcomes = db.session.execute(outcomes_stmt, dict(user_id=user_id, current_term=current_term.id))
-    
-    # format outcome results into json format
-    alignments = [alignment_dict(a) for a in outcomes]
+    def load_alignments():
+        outcomes = db.session.execute(outcomes_stmt, dict(user_id=user_id, current_term=current_term.id))
+        # format outcome results into json format
+        return [alignment_dict(a) for a in outcomes]
+
+    record = Record.query.order_by(Record.id.desc()).first()
+    alignments = cached_payload(
+        "student_alignments",
+        [user_id, current_term.id],
+        record.id if record else None,
+        load_alignments,
+    )
 
     return alignments, grades, user
 
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+"""rq worker for the sync queue.
+
+    rq worker cbl-tasks -w app.worker.SyncWorker
+"""
+import traceback
+
+from rq import Queue, Worker
+
+from app.sync_progress import end_course_job, record_course_progress
+
+
+class SyncWorker(Worker):
+    """
+    Counts a sync_course job as ended when it fails without ending itself, e.g. its work
+    horse was killed for running past the hard timeout or out of memory. Otherwise the
+    sync's finish_sync job would never be enqueued.
+    """
+
+    def handle_job_failure(self, job, *args, **kwargs):
+        super().handle_job_failure(job, *args, **kwargs)
+        try:
+            task_id = job.kwargs.get("task_id")
+            if job.func_name != "app.tasks.sync_course" or not task_id:
+                return
+            # Only Redis here, this may be the worker's main process
+            queue = Queue(job.origin, connection=self.connection)
+            if end_course_job(self.connection, queue, task_id, job.id):
+                record_course_progress(self.connection, task_id, False)
+        except Exception:
+            traceback.print_exc()
@@ -1,4 +1,4 @@
-from datetime import datetime
+from datetime import datetime, timedelta
 import re
 
 from apscheduler.schedulers.blocking import BlockingScheduler
@@ -13,52 +13,390 @@ from utilities.data_pull import (
     pull_outcome_results,
     insert_grades,
     update_courses,
+    update_course_roster,
     update_course_students,
     update_terms,
+    filter_graded_courses,
+    sync_course_outcome_results,
     query_current_outcome_results,
+    NON_ACADEMIC_PATTERN,
 )
 
-from utilities.db_functions import get_sync_terms
+from utilities.canvas_client import client
+from utilities.sync_ledger import SyncRunLedger, LedgerProgress
+from utilities.db_functions import (
+    get_sync_terms,
+    get_terms,
+    get_db_courses,
+    clear_staged_outcome_results,
+    publish_staged_outcome_results,
+    start_sync_run,
+    add_sync_checkpoint,
+    has_sync_checkpoint,
+    get_sync_checkpoints,
+    get_sync_run_started_at,
+    clear_sync_checkpoints,
+)
 
 sched = BlockingScheduler(timezone=utc)
 
 
-def run():
-    print(f"job started at {datetime.now()}")
+def _sync_staged(staged):
+    if staged is None:
+        staged = os.getenv("SYNC_STAGED", "false").lower() == "true"
+    return staged
+
+
+def _make_engine(**kwargs):
     config = configuration[os.getenv("PULL_CONFIG")]
-    engine = create_engine(config.SQLALCHEMY_DATABASE_URI)
+    return create_engine(config.SQLALCHEMY_DATABASE_URI, **kwargs)
+
 
-    update_terms(engine)
-    print(f"terms updated at {datetime.now()}")
+def start_or_resume_sync_run(engine):
+    """
+    Picks up the checkpoints of an unfinished sync run, unless it's older than
+    SYNC_CHECKPOINT_MAX_AGE hours
+    :param engine: SQLAlchemy engine
+    :return: sync run id
+    """
+    max_age = timedelta(hours=int(os.getenv("SYNC_CHECKPOINT_MAX_AGE", 24)))
+    sync_run_id, resumed = start_sync_run(engine, max_age=max_age)
+    if resumed:
+        print(f"resuming sync run {sync_run_id}")
+    else:
+        print(f"starting sync run {sync_run_id}")
+    return sync_run_id
 
-    # get the "sync" terms
-    sync_terms = get_sync_terms(engine)
-    print(f"The sync terms are {[term['id'] for term in sync_terms]}")
 
-    update_users(engine)
-    print(f"users updated at {datetime.now()}")
+def _run_stage(
+    sync_run_id, stage, engine, ledger, func, *args, item_id="", progress=None
+):
+    # Runs a stage unless the sync run already finished it, logged under func's name
+    if progress is not None:
+        progress.stage(stage)
+    if has_sync_checkpoint(sync_run_id, stage, engine, item_id):
+        print(f"{stage} {item_id} already finished, skipping")
+        return
+    with ledger.stage(func.__name__, term_id=item_id or None):
+        func(*args)
+    add_sync_checkpoint(sync_run_id, stage, engine, item_id)
+
+
+def run(workers=None, staged=None, progress=None):
+    """
+    Runs the full sync
+    :param workers: number of courses pulled from Canvas concurrently, defaults to the
+        SYNC_WORKERS environment variable
+    :param staged: load outcome results into shadow tables and publish each term at once,
+        defaults to the SYNC_STAGED environment variable
+    :param progress: optional progress reporter, told about each stage (stage) and course
+        (add_courses, course_done)
+    :return: None
+    """
+    if workers is None:
+        workers = int(os.getenv("SYNC_WORKERS", 4))
+    staged = _sync_staged(staged)
+
+    print(f"job started at {datetime.now()}")
+    # Each course being written holds a connection until its transaction commits
+    engine = _make_engine(pool_size=max(5, workers * 3 + 1))
+
+    sync_run_id = start_or_resume_sync_run(engine)
+    ledger = SyncRunLedger.start(engine, "serial_sync", checkpoint_run_id=sync_run_id)
+
+    try:
+        _run_stage(
+            sync_run_id,
+            "terms",
+            engine,
+            ledger,
+            update_terms,
+            engine,
+            progress=progress,
+        )
+        print(f"terms updated at {datetime.now()}")
+
+        # get the "sync" terms
+        sync_terms = get_sync_terms(engine)
+        print(f"The sync terms are {[term['id'] for term in sync_terms]}")
+
+        _run_stage(
+            sync_run_id,
+            "users",
+            engine,
+            ledger,
+            update_users,
+            engine,
+            progress=progress,
+        )
+        print(f"users updated at {datetime.now()}")
+
+        for term in sync_terms:
+            print(f"syncing term {term['id']}")
+            
+            # TODO - create `update_all_courses` and decompose the function
+            _run_stage(
+                sync_run_id,
+                "courses",
+                engine,
+                ledger,
+                update_courses,
+                term,
+                engine,
+                item_id=term["id"],
+                progress=progress,
+            )
+            print(f"courses updated at {datetime.now()}")
+
+            _run_stage(
+                sync_run_id,
+                "rosters",
+                engine,
+                ledger,
+                update_course_students,
+                term,
+                engine,
+                item_id=term["id"],
+                progress=progress,
+            )
+            print(f"course students updated at {datetime.now()}")
+            
+            if progress is not None:
+                progress.stage("outcome results")
+            course_progress = LedgerProgress(ledger, term["id"], progress)
+            with ledger.stage("pull_outcome_results", term_id=term["id"]) as values:
+                pull_outcome_results(
+                    term,
+                    engine,
+                    workers=workers,
+                    staged=staged,
+                    sync_run_id=sync_run_id,
+                    progress=course_progress,
+                )
+                values.update(skipped=course_progress.skipped)
+            print(f"outcome_results pulled at {datetime.now()}")
+
+            _run_stage(
+                sync_run_id,
+                "grades",
+                engine,
+                ledger,
+                insert_grades,
+                term,
+                engine,
+                item_id=term["id"],
+                progress=progress,
+            )
+            print(f"grades inserted at {datetime.now()}")
+    except Exception as e:
+        ledger.finish(f"failed: {e}")
+        raise
+
+    # The grades are in, the next sync starts from scratch
+    clear_sync_checkpoints(sync_run_id, engine)
+    ledger.finish("complete")
+    engine.dispose()
+
 
-    for term in sync_terms:
-        print(f"syncing term {term['id']}")
-        
-        update_courses(term, engine) # TODO - create `update_all_courses` and decompose the function
-        print(f"courses updated at {datetime.now()}")
+def regrade(term_ids=None):
+    """
+    Recalculates grades from the outcome results already in the database, without
+    touching Canvas
+    :param term_ids: terms to regrade, defaults to the sync terms
+    :return: None
+    """
+    print(f"regrade started at {datetime.now()}")
+    engine = _make_engine()
+    ledger = SyncRunLedger.start(engine, "regrade")
 
-        update_course_students(term, engine)
-        print(f"course students updated at {datetime.now()}")
-        
-        pull_outcome_results(term, engine)
-        print(f"outcome_results pulled at {datetime.now()}")
+    if term_ids:
+        terms = get_terms(engine, term_ids)
+    else:
+        terms = get_sync_terms(engine)
 
-        insert_grades(term, engine)
-        print(f"grades inserted at {datetime.now()}")
+    try:
+        for term in terms:
+            with ledger.stage("insert_grades", term_id=term["id"]):
+                insert_grades(term, engine, full=True)
+            print(f"term {term['id']} regraded at {datetime.now()}")
+    except Exception as e:
+        ledger.finish(f"failed: {e}")
+        raise
 
+    ledger.finish("complete")
+    engine.dispose()
+
+
+def prepare_sync(staged=None, progress=None):
+    """
+    First stage of a fanned out sync: updates terms, users and courses, and returns the
+    courses to sync one job at a time. Resumes an unfinished sync run, leaving out the
+    courses it already synced.
+    :param staged: load outcome results into shadow tables and publish each term at once,
+        defaults to the SYNC_STAGED environment variable
+    :param progress: optional progress reporter, told about each stage
+    :return: (sync run id, ledger id, list of (term, graded courses) tuples)
+    """
+    staged = _sync_staged(staged)
+    print(f"job started at {datetime.now()}")
+    engine = _make_engine()
+    sync_run_id = start_or_resume_sync_run(engine)
+    ledger = SyncRunLedger.start(engine, "full_sync", checkpoint_run_id=sync_run_id)
+
+    try:
+        _run_stage(
+            sync_run_id,
+            "terms",
+            engine,
+            ledger,
+            update_terms,
+            engine,
+            progress=progress,
+        )
+        print(f"terms updated at {datetime.now()}")
+
+        sync_terms = get_sync_terms(engine)
+        print(f"The sync terms are {[term['id'] for term in sync_terms]}")
+
+        _run_stage(
+            sync_run_id,
+            "users",
+            engine,
+            ledger,
+            update_users,
+            engine,
+            progress=progress,
+        )
+        print(f"users updated at {datetime.now()}")
+
+        if progress is not None:
+            progress.stage("courses")
+        term_courses = []
+        for term in sync_terms:
+            if has_sync_checkpoint(sync_run_id, "courses", engine, term["id"]):
+                courses = [
+                    dict(id=course[0], name=course[1])
+                    for course in get_db_courses(engine, term["id"])
+                ]
+            else:
+                with ledger.stage("update_courses", term_id=term["id"]):
+                    courses = update_courses(term, engine) or []
+                if staged:
+                    # Throw away anything left over from an interrupted staged sync
+                    clear_staged_outcome_results(term["id"], engine)
+                add_sync_checkpoint(sync_run_id, "courses", engine, term["id"])
+            print(f"courses updated for term {term['id']} at {datetime.now()}")
+
+            finished = get_sync_checkpoints(sync_run_id, "course", engine)
+            courses = [
+                course
+                for course in filter_graded_courses(courses)
+                if str(course["id"]) not in finished
+            ]
+            term_courses.append((term, courses))
+    except Exception as e:
+        ledger.finish(f"failed: {e}")
+        raise
+
+    engine.dispose()
+    return sync_run_id, ledger.sync_run_id, term_courses
+
+
+def sync_course(term, course, staged=None, sync_run_id=None, ledger_id=None):
+    """
+    Syncs one course's roster and outcome results
+    :param term: term dictionary
+    :param course: course dictionary
+    :param staged: load outcome results into the shadow tables
+    :param sync_run_id: checkpoint the course under this sync run
+    :param ledger_id: sync_runs id to record the course's timings under
+    :return: dictionary with synced (False if the course failed), results (outcome
+        results received), skipped (1 if they were unchanged) and canvas_requests
+    """
+    staged = _sync_staged(staged)
+    requests_before = client.get_stats()["requests"]
+    engine = _make_engine(pool_size=2)
+    ledger = SyncRunLedger(engine, ledger_id)
+    try:
+        course_stage = ledger.stage("course", term_id=term["id"], course_id=course["id"])
+        with course_stage as values:
+            if not re.match(NON_ACADEMIC_PATTERN, course["name"]):
+                update_course_roster(course["id"], engine)
+            sync_started_at = None
+            if sync_run_id:
+                sync_started_at = get_sync_run_started_at(sync_run_id, engine)
+            synced, results, unchanged = sync_course_outcome_results(
+                course,
+                term["id"],
+                engine,
+                staged=staged,
+                sync_started_at=sync_started_at,
+            )
+            values.update(results=results, skipped=int(unchanged), failed=not synced)
+        if synced and sync_run_id:
+            add_sync_checkpoint(sync_run_id, "course", engine, course["id"])
+    finally:
+        engine.dispose()
+    print(f'course {course["id"]} synced at {datetime.now()}')
+    return dict(
+        synced=synced,
+        results=results,
+        skipped=int(unchanged),
+        canvas_requests=client.get_stats()["requests"] - requests_before,
+    )
+
+
+def finish_sync(terms, staged=None, sync_run_id=None, progress=None, ledger_id=None):
+    """
+    Join stage of a fanned out sync, runs once every course has synced: publishes staged
+    results and recalculates the grades. The sync run's checkpoints are cleared once the
+    grades are in.
+    :param terms: list of term dictionaries
+    :param staged: publish the shadow tables first
+    :param sync_run_id: sync run id
+    :param progress: optional progress reporter, told about each stage
+    :param ledger_id: sync_runs id to record the stages under
+    :return: None
+    """
+    staged = _sync_staged(staged)
+    engine = _make_engine()
+    ledger = SyncRunLedger(engine, ledger_id)
+    if progress is not None:
+        progress.stage("grades")
+    try:
+        for term in terms:
+            if sync_run_id and has_sync_checkpoint(
+                sync_run_id, "grades", engine, term["id"]
+            ):
+                continue
+            if staged:
+                with ledger.stage("publish_staged_outcome_results", term_id=term["id"]):
+                    publish_staged_outcome_results(term["id"], engine)
+                print(f"staged outcome results published for term {term['id']}")
+
+            with ledger.stage("insert_grades", term_id=term["id"]):
+                insert_grades(term, engine)
+            print(f"grades inserted for term {term['id']} at {datetime.now()}")
+            if sync_run_id:
+                add_sync_checkpoint(sync_run_id, "grades", engine, term["id"])
+    except Exception as e:
+        ledger.finish(f"failed: {e}")
+        raise
+
+    if sync_run_id:
+        clear_sync_checkpoints(sync_run_id, engine)
+    ledger.finish("complete")
     engine.dispose()
 
 
 @sched.scheduled_job("cron", day_of_week="mon-fri", hour=8, minute=5)
 def timed_job():
-    run()
+    # Fan the sync out over the rq workers, imported here because it creates the app
+    from app.task_utils import launch_task
+    from app.extensions import db
+
+    launch_task("full_sync", "Scheduled sync", job_timeout=3600)
+    db.session.commit()
 
 
 if __name__ == "__main__":
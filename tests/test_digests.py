@@ -0,0 +1,94 @@
+"""
+A course sync only writes new and reassessed results. Swapping the written rows into the
+stored digest has to give the new digest exactly when nothing else changed in place.
+
+    python -m pytest tests
+"""
+from datetime import datetime
+
+import numpy as np
+
+from utilities.digests import (
+    DIGEST_RESULT_COLS,
+    format_digest,
+    replace_in_digest,
+    row_hashes,
+    stored_result_columns,
+)
+
+
+def make_results(*rows):
+    return [
+        dict(
+            id=_id,
+            score=score,
+            user_id=1,
+            outcome_id=7,
+            alignment_id="assignment_3",
+            submitted_or_assessed_at=assessed_at,
+        )
+        for _id, score, assessed_at in rows
+    ]
+
+
+def digest_of(results):
+    hashes = row_hashes(stored_result_columns(results), DIGEST_RESULT_COLS)
+    return format_digest(len(hashes), int(hashes.sum()))
+
+
+def swapped_digest(stored, old_rows, new_rows):
+    old_hashes = row_hashes(stored_result_columns(old_rows), DIGEST_RESULT_COLS)
+    new_hashes = row_hashes(stored_result_columns(new_rows), DIGEST_RESULT_COLS)
+    return replace_in_digest(
+        stored,
+        len(old_hashes),
+        int(old_hashes.sum()),
+        len(new_hashes),
+        int(new_hashes.sum()),
+    )
+
+
+STORED = make_results(
+    (1, 3.0, datetime(2021, 9, 1)),
+    (2, None, datetime(2021, 9, 2)),
+    (3, 2.5, datetime(2021, 9, 3, 8, 30, 0, 125)),
+)
+
+
+def test_written_rows_explain_the_new_digest():
+    reassessed = make_results((3, 3.5, datetime(2021, 10, 1)))
+    added = make_results((4, 4.0, datetime(2021, 10, 2)))
+    current = STORED[:1] + reassessed + added
+
+    # Result 2 was removed, result 3 written over and result 4 written new
+    expected = swapped_digest(digest_of(STORED), STORED[1:], reassessed + added)
+    assert expected == digest_of(current)
+
+
+def test_result_changed_in_place_is_caught():
+    reassessed = make_results((3, 3.5, datetime(2021, 10, 1)))
+    # Rescored without moving its assessment time, so it's not written
+    rescored = make_results((1, 2.0, datetime(2021, 9, 1)))
+    current = rescored + STORED[1:2] + reassessed
+
+    expected = swapped_digest(digest_of(STORED), STORED[2:], reassessed)
+    assert expected != digest_of(current)
+
+
+def test_stored_rows_hash_like_canvas_results():
+    # Typed the way decode_outcome_result_page decodes a Canvas page
+    decoded = {
+        "id": np.array([1, 2, 3], dtype="int64"),
+        "score": np.array([3.0, None, 2.5], dtype="float64"),
+        "user_id": np.array(["1", "1", "1"], dtype="int64"),
+        "outcome_id": np.array(["7", "7", "7"], dtype="int64"),
+        "alignment_id": np.array(["assignment_3"] * 3, dtype=object),
+        "submitted_or_assessed_at": np.array(
+            ["2021-09-01T00:00:00", "2021-09-02T00:00:00", "2021-09-03T08:30:00.000125"],
+            dtype="datetime64[us]",
+        ),
+    }
+    stored = stored_result_columns(STORED)
+    assert (
+        row_hashes(decoded, DIGEST_RESULT_COLS) == row_hashes(stored, DIGEST_RESULT_COLS)
+    ).all()
@@ -0,0 +1,76 @@
+"""
+The vectorized grade engine has to give the same grades as the per-group
+calculate_traditional_grade it replaced.
+
+    python -m pytest tests
+"""
+from datetime import datetime
+
+import pandas as pd
+
+from utilities.benchmarks import (
+    CALCULATION_DICTIONARIES,
+    check_grade_equivalence,
+    make_outcome_results_frame,
+)
+from utilities.cbl_calculator import (
+    calculate_outcome_averages,
+    calculate_traditional_grades,
+    grade_rows,
+)
+
+
+def make_outcome_avgs(pairs):
+    """
+    :param pairs: dictionary of (user, course) to the pair's outcome averages
+    :return: DataFrame shaped like calculate_outcome_averages
+    """
+    rows = [
+        (user_id, course_id, avg)
+        for (user_id, course_id), avgs in pairs.items()
+        for avg in avgs
+    ]
+    return pd.DataFrame(rows, columns=["links.user", "course_id", "outcome_avg"])
+
+
+def test_edge_cases_match():
+    outcome_avgs = make_outcome_avgs(
+        {
+            (1, 10): [3.5],
+            (1, 11): [4.0, 3.5, 3.0, 2.5],
+            (2, 10): [2.0, 4.0, 4.0],
+            # Unassessed, the first score in the pair's original order is -1
+            (2, 11): [-1, 3.0],
+            # Below every cutoff
+            (3, 10): [-0.5, 0.0],
+            # Ties on the 75% threshold
+            (3, 11): [3.0, 3.0, 3.0, 3.0, 2.25, 2.25, 2.25, 2.25],
+        }
+    )
+    assert check_grade_equivalence(outcome_avgs, CALCULATION_DICTIONARIES) == []
+
+
+def test_synthetic_term_matches():
+    outcome_results = make_outcome_results_frame(20000, students=150, courses=40)
+    outcome_avgs = calculate_outcome_averages(outcome_results, datetime(2021, 12, 1))
+    outcome_avgs = outcome_avgs[outcome_avgs["graded"]]
+    assert check_grade_equivalence(outcome_avgs, CALCULATION_DICTIONARIES) == []
+
+
+def test_unassessed_grades_store_null_cutoffs():
+    outcome_avgs = make_outcome_avgs({(1, 10): [-1, 4.0], (1, 11): [4.0]})
+    grades = calculate_traditional_grades(
+        outcome_avgs["links.user"].values,
+        outcome_avgs["course_id"].values,
+        outcome_avgs["outcome_avg"].values,
+        CALCULATION_DICTIONARIES,
+    ).rename(columns={"links.user": "user_id"})
+    grades["outcomes"] = [[] for _ in range(len(grades))]
+    grades["record_id"] = 1
+
+    rows = {row["course_id"]: row for row in grade_rows(grades)}
+    assert rows[10]["grade"] == "n/a"
+    assert rows[10]["threshold"] is None
+    assert rows[10]["min_score"] is None
+    assert rows[11]["grade"] == "A"
+    assert rows[11]["threshold"] == 4.0
@@ -0,0 +1,803 @@
+"""
+Benchmarks for the sync pipeline.
+
+Database benchmarks need PULL_CONFIG pointing at a scratch database, they create and drop
+their own tables.
+
+    python -m utilities.benchmarks bulk_load --sizes 10000 100000 1000000
+    python -m utilities.benchmarks grade_engine --results 1000000
+    python -m utilities.benchmarks grade_pool --results 2000000 --workers 1 2 4
+    python -m utilities.benchmarks calculation_methods --results 1000000
+    python -m utilities.benchmarks payload_decode --pages 2000
+    python -m utilities.benchmarks sync --courses 50 --students 25 --outcomes 8 --runs 2
+
+The sync benchmark runs cron.run end to end against utilities.fake_canvas, so it needs
+an empty scratch database: it creates every table and drops them again afterwards.
+"""
+import argparse
+import random
+import time
+from datetime import datetime, timedelta
+
+
+def _timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    func(*args, **kwargs)
+    return time.perf_counter() - start
+
+
+def _print_table(header, rows):
+    widths = [max(len(str(r[i])) for r in [header] + rows) for i in range(len(header))]
+    for row in [header] + rows:
+        print("  ".join(str(val).rjust(width) for val, width in zip(row, widths)))
+
+
+def make_outcome_result_rows(n, seed=0):
+    """
+    Synthetic rows shaped like the outcome_results table
+    :param n: number of rows
+    :param seed: random seed
+    :return: list of row dictionaries
+    """
+    rng = random.Random(seed)
+    start = datetime(2021, 8, 16)
+    return [
+        {
+            "id": i,
+            "score": rng.choice([0.0, 1.0, 2.0, 2.5, 3.0, 3.5, 4.0]),
+            "course_id": rng.randint(1, 500),
+            "user_id": rng.randint(1, 600),
+            "outcome_id": rng.randint(1, 400),
+            "alignment_id": f"assignment_{rng.randint(1, 20000)}",
+            "submitted_or_assessed_at": start + timedelta(minutes=rng.randint(0, 200000)),
+            "last_updated": start,
+        }
+        for i in range(1, n + 1)
+    ]
+
+
+# Roughly the grade_calculation table, ordered by grade_rank
+CALCULATION_DICTIONARIES = [
+    {"grade": "A", "threshold": 3.5, "min_score": 3.0},
+    {"grade": "A-", "threshold": 3.5, "min_score": 2.5},
+    {"grade": "B+", "threshold": 3.0, "min_score": 2.5},
+    {"grade": "B", "threshold": 3.0, "min_score": 2.25},
+    {"grade": "B-", "threshold": 3.0, "min_score": 2.0},
+    {"grade": "C+", "threshold": 2.5, "min_score": 2.0},
+    {"grade": "C", "threshold": 2.25, "min_score": 2.0},
+    {"grade": "C-", "threshold": 2.0, "min_score": 2.0},
+    {"grade": "I", "threshold": 0.0, "min_score": 0.0},
+]
+
+
+def make_outcome_results_frame(n, students=600, courses=450, outcomes=8, seed=0):
+    """
+    Synthetic outcome results shaped like query_current_outcome_results
+    :param n: number of outcome results
+    :param students: number of students
+    :param courses: number of courses
+    :param outcomes: outcomes per course
+    :param seed: random seed
+    :return: DataFrame
+    """
+    import numpy as np
+    import pandas as pd
+
+    rng = np.random.RandomState(seed)
+    course_id = rng.randint(1, courses + 1, n)
+    start = np.datetime64("2021-08-16")
+    return pd.DataFrame(
+        {
+            "_id": np.arange(1, n + 1),
+            "links.user": rng.randint(1, students + 1, n),
+            "course_id": course_id,
+            "outcome_id": course_id * 100 + rng.randint(1, outcomes + 1, n),
+            "score": rng.choice([0.0, 1.0, 2.0, 2.5, 3.0, 3.5, 4.0], n),
+            "calculation_int": 65,
+            "submitted_or_assessed_at": start
+            + rng.randint(0, 120 * 24 * 60, n).astype("timedelta64[m]"),
+        }
+    )
+
+
+def legacy_traditional_grades(outcome_avgs, calculation_dictionaries):
+    """
+    The per-group calculate_traditional_grade path that insert_grades used to run
+    :return: dictionary of grade dictionaries keyed by (user, course)
+    """
+    from utilities.cbl_calculator import calculate_traditional_grade
+
+    grades = outcome_avgs.groupby(["links.user", "course_id"]).agg(
+        grade_dict=(
+            "outcome_avg",
+            lambda x: calculate_traditional_grade(x, calculation_dictionaries),
+        )
+    )
+    return grades["grade_dict"].to_dict()
+
+
+def check_grade_equivalence(outcome_avgs, calculation_dictionaries):
+    """
+    Checks calculate_traditional_grades against calculate_traditional_grade for every pair
+    :param outcome_avgs: DataFrame from calculate_outcome_averages
+    :param calculation_dictionaries: grade cutoffs ordered by grade_rank
+    :return: list of mismatched (user, course) pairs
+    """
+    import math
+
+    from utilities.cbl_calculator import calculate_traditional_grades
+
+    expected = legacy_traditional_grades(outcome_avgs, calculation_dictionaries)
+    grades = calculate_traditional_grades(
+        outcome_avgs["links.user"].values,
+        outcome_avgs["course_id"].values,
+        outcome_avgs["outcome_avg"].values,
+        calculation_dictionaries,
+    )
+
+    def same(a, b):
+        if a is None or (isinstance(a, float) and math.isnan(a)):
+            return b is None or (isinstance(b, float) and math.isnan(b))
+        return a == b
+
+    mismatches = []
+    for row in grades.itertuples(index=False):
+        key = (row[0], row[1])
+        grade_dict = expected.pop(key, None)
+        if grade_dict is None or not all(
+            same(getattr(row, col), grade_dict[col])
+            for col in ["threshold", "min_score", "grade"]
+        ):
+            mismatches.append(key)
+    return mismatches + list(expected.keys())
+
+
+def bench_grade_engine(n_results):
+    """
+    Times the per-group lambda against the vectorized grade engine and checks they agree
+    :param n_results: number of synthetic outcome results
+    :return: None
+    """
+    from datetime import datetime as dt
+
+    from utilities.cbl_calculator import (
+        calculate_outcome_averages,
+        calculate_traditional_grades,
+    )
+
+    outcome_results = make_outcome_results_frame(n_results)
+    outcome_avgs = calculate_outcome_averages(outcome_results, dt(2021, 12, 1))
+    outcome_avgs = outcome_avgs[outcome_avgs["graded"]]
+    args = (
+        outcome_avgs["links.user"].values,
+        outcome_avgs["course_id"].values,
+        outcome_avgs["outcome_avg"].values,
+        CALCULATION_DICTIONARIES,
+    )
+
+    legacy = _timed(legacy_traditional_grades, outcome_avgs, CALCULATION_DICTIONARIES)
+    vectorized = _timed(calculate_traditional_grades, *args)
+    mismatches = check_grade_equivalence(outcome_avgs, CALCULATION_DICTIONARIES)
+
+    pairs = outcome_avgs.groupby(["links.user", "course_id"]).ngroups
+    _print_table(
+        ["results", "pairs", "groupby lambda", "vectorized", "speedup"],
+        [
+            [
+                n_results,
+                pairs,
+                f"{legacy:.2f}s",
+                f"{vectorized:.2f}s",
+                f"{legacy / vectorized:.1f}x",
+            ]
+        ],
+    )
+    if mismatches:
+        raise AssertionError(
+            f"{len(mismatches)} grades differ from calculate_traditional_grade, "
+            f"e.g. {mismatches[:5]}"
+        )
+    print("vectorized grades match calculate_traditional_grade")
+
+
+def _course_frames(outcome_results):
+    # Same shape as iter_course_outcome_results
+    outcome_results = outcome_results.sort_values("course_id", kind="mergesort")
+    return outcome_results.groupby("course_id", sort=False)
+
+
+def _grade_key(grades):
+    grades = grades.sort_values(["user_id", "course_id"]).reset_index(drop=True)
+    return grades[["user_id", "course_id", "threshold", "min_score", "grade"]], [
+        sorted(outcomes, key=lambda o: o["outcome_id"]) for outcomes in grades["outcomes"]
+    ]
+
+
+def bench_grade_pool(n_results, worker_counts, shard_rows):
+    """
+    Times the grade stage course by course, then sharded with 1 to N worker processes,
+    and checks every run grades the same
+    :param n_results: number of synthetic outcome results
+    :param worker_counts: worker process counts to test
+    :param shard_rows: outcome results per shard
+    :return: None
+    """
+    import os
+    from datetime import datetime as dt
+
+    from utilities.cbl_calculator import calculate_grades
+    from utilities.grade_pool import sharded_course_grades
+
+    term = {"cut_off_date": dt(2021, 12, 1), "end_at": dt(2022, 1, 1)}
+    outcome_results = make_outcome_results_frame(n_results).astype(
+        {"links.user": "int32", "course_id": "int32", "outcome_id": "int32"}
+    )
+
+    def serial():
+        import pandas as pd
+
+        return pd.concat(
+            [
+                calculate_grades(frame, term, CALCULATION_DICTIONARIES)
+                for _, frame in _course_frames(outcome_results)
+            ],
+            ignore_index=True,
+        )
+
+    start = time.perf_counter()
+    expected = serial()
+    baseline = time.perf_counter() - start
+    expected_frame, expected_outcomes = _grade_key(expected)
+
+    results = [[1, "per course", f"{baseline:.2f}s", "1.0x"]]
+    for workers in worker_counts:
+        start = time.perf_counter()
+        grades = sharded_course_grades(
+            _course_frames(outcome_results),
+            term,
+            CALCULATION_DICTIONARIES,
+            workers,
+            shard_rows=shard_rows,
+        )
+        elapsed = time.perf_counter() - start
+        frame, outcomes = _grade_key(grades)
+        if not (frame.equals(expected_frame) and outcomes == expected_outcomes):
+            raise AssertionError(f"{workers} workers graded differently than per course")
+        path = "sharded" if workers == 1 else "pool"
+        results.append(
+            [workers, path, f"{elapsed:.2f}s", f"{baseline / elapsed:.1f}x"]
+        )
+
+    print(f"{n_results} results, {os.cpu_count()} cpus, {len(expected)} grades")
+    _print_table(["workers", "path", "time", "speedup"], results)
+    print("sharded grades match grading course by course")
+
+
+def legacy_decaying_averages(outcome_results):
+    """
+    The per-group weighted_avg that cbl_calculator used to have for decaying averages
+    :return: Series of decaying averages indexed by (user, course, outcome)
+    """
+    import pandas as pd
+
+    def weighted_avg(scores):
+        s = scores.apply(pd.Series)
+        if len(s) == 1:
+            return s.iloc[0, 0]
+
+        first_weight = (100 - s.iloc[0, 1]) / 100
+        final_weight = s.iloc[0, 1] / 100
+        return first_weight * s.iloc[:-1, 0].mean() + final_weight * s.iloc[-1, 0]
+
+    ordered = outcome_results.sort_values("submitted_or_assessed_at", kind="mergesort")
+    ordered = ordered.assign(
+        score_int=list(zip(ordered["score"], ordered["calculation_int"]))
+    )
+    return ordered.groupby(["links.user", "course_id", "outcome_id"])["score_int"].agg(
+        weighted_avg
+    )
+
+
+def make_outcome_calculations(outcome_results, seed=0):
+    """
+    Random Canvas calculation settings for every outcome in the results
+    :return: DataFrame with OUTCOME_CALCULATION_COLS
+    """
+    import numpy as np
+    import pandas as pd
+
+    from utilities.cbl_calculator import CALCULATION_METHODS
+
+    rng = np.random.RandomState(seed)
+    outcome_ids = np.unique(outcome_results["outcome_id"].values)
+    methods = rng.choice(CALCULATION_METHODS, len(outcome_ids))
+    return pd.DataFrame(
+        {
+            "outcome_id": outcome_ids,
+            "calculation_method": methods,
+            "calculation_int": np.where(
+                methods == "n_mastery",
+                rng.randint(1, 6, len(outcome_ids)),
+                rng.randint(50, 80, len(outcome_ids)),
+            ),
+            "mastery_points": 3.0,
+        }
+    )
+
+
+def bench_calculation_methods(n_results, legacy_results):
+    """
+    Times the grade stage with each calculation method against the drop lowest path
+    insert_grades runs today, and checks the vectorized methods against the old per-group
+    weighted_avg and the drop lowest path
+    :param n_results: number of synthetic outcome results
+    :param legacy_results: outcome results for the (slow) per-group comparison
+    :return: None
+    """
+    from datetime import datetime as dt
+
+    import numpy as np
+
+    from utilities.cbl_calculator import (
+        CALCULATION_METHODS,
+        OUTCOME_METHOD,
+        calculate_grades,
+        calculate_outcome_averages,
+    )
+
+    cut_off_date = dt(2021, 12, 1)
+    outcome_results = make_outcome_results_frame(n_results).astype(
+        {"links.user": "int32", "course_id": "int32", "outcome_id": "int32"}
+    )
+    outcome_calculations = make_outcome_calculations(outcome_results)
+
+    def grade(method, calculations=None):
+        term = {
+            "cut_off_date": cut_off_date,
+            "end_at": dt(2022, 1, 1),
+            "calculation_method": method,
+        }
+        return calculate_grades(
+            outcome_results, term, CALCULATION_DICTIONARIES, calculations
+        )
+
+    baseline = _timed(grade, None)
+    rows = [["drop_lowest (current)", f"{baseline:.2f}s", "1.0x"]]
+    for method in CALCULATION_METHODS[1:]:
+        elapsed = _timed(grade, method, outcome_calculations)
+        rows.append([method, f"{elapsed:.2f}s", f"{elapsed / baseline:.1f}x"])
+    elapsed = _timed(grade, OUTCOME_METHOD, outcome_calculations)
+    rows.append(["per outcome (mixed)", f"{elapsed:.2f}s", f"{elapsed / baseline:.1f}x"])
+    print(f"{n_results} results")
+    _print_table(["method", "grade stage", "vs current"], rows)
+
+    # The school's rule through the general path matches the drop lowest path
+    expected = calculate_outcome_averages(outcome_results, cut_off_date)
+    general = calculate_outcome_averages(
+        outcome_results, cut_off_date, OUTCOME_METHOD, None
+    )
+    for col in ["outcome_avg", "drop_min", "graded"]:
+        if not np.array_equal(expected[col].values, general[col].values):
+            raise AssertionError(f"{col} differs between the drop lowest paths")
+
+    # Decaying averages against the old per-group weighted_avg
+    sample = outcome_results.iloc[:legacy_results].assign(calculation_int=65)
+    legacy = _timed(legacy_decaying_averages, sample)
+    vectorized = _timed(
+        calculate_outcome_averages, sample, cut_off_date, "decaying_average"
+    )
+    expected = legacy_decaying_averages(sample)
+    averages = calculate_outcome_averages(sample, cut_off_date, "decaying_average")
+    if not np.allclose(expected.values, averages["outcome_avg"].values):
+        raise AssertionError("decaying averages differ from weighted_avg")
+    _print_table(
+        ["results", "weighted_avg", "vectorized", "speedup"],
+        [
+            [
+                legacy_results,
+                f"{legacy:.2f}s",
+                f"{vectorized:.3f}s",
+                f"{legacy / vectorized:.0f}x",
+            ]
+        ],
+    )
+    print("decaying averages match weighted_avg, drop lowest matches the current path")
+
+
+def make_outcome_result_pages(n_pages, page_size=100, seed=0):
+    """
+    Synthetic Canvas outcome_results pages, as response.json() returns them
+    :param n_pages: number of pages
+    :param page_size: outcome results per page
+    :param seed: random seed
+    :return: list of outcome_results lists
+    """
+    rng = random.Random(seed)
+    start = datetime(2021, 8, 16)
+    pages = []
+    for page in range(n_pages):
+        pages.append(
+            [
+                {
+                    "id": page * page_size + i,
+                    "score": rng.choice([None, 1.0, 2.0, 2.5, 3.0, 3.5, 4.0]),
+                    "submitted_or_assessed_at": (
+                        start + timedelta(minutes=rng.randint(0, 200000))
+                    ).strftime("%Y-%m-%dT%H:%M:%SZ"),
+                    "links": {
+                        "user": str(rng.randint(1, 600)),
+                        "learning_outcome": str(rng.randint(1, 400)),
+                        "alignment": f"assignment_{rng.randint(1, 20000)}",
+                    },
+                }
+                for i in range(page_size)
+            ]
+        )
+    return pages
+
+
+def legacy_format_page(outcome_results, course_id, seen):
+    """
+    The per-row dictionaries make_outcome_result built before the columnar decoding
+    :return: list of unseen result dictionaries
+    """
+    from utilities.data_pull import parse_canvas_datetime
+
+    rows = []
+    for res in outcome_results:
+        row = {
+            "id": res["id"],
+            "score": res["score"],
+            "course_id": course_id,
+            "user_id": res["links"]["user"],
+            "outcome_id": res["links"]["learning_outcome"],
+            "alignment_id": res["links"]["alignment"],
+            "submitted_or_assessed_at": parse_canvas_datetime(
+                res["submitted_or_assessed_at"]
+            ),
+            "last_updated": datetime.utcnow(),
+        }
+        if row["id"] not in seen:
+            seen.add(row["id"])
+            rows.append(row)
+    return rows
+
+
+def bench_payload_decode(n_pages):
+    """
+    Times decoding Canvas pages into per-row dictionaries against typed columns, and
+    checks both keep the same results
+    :param n_pages: number of 100 result pages
+    :return: None
+    """
+    from utilities.data_pull import _dedup, decode_outcome_result_page
+
+    pages = make_outcome_result_pages(n_pages)
+
+    def rows():
+        seen = set()
+        return [legacy_format_page(page, 1, seen) for page in pages]
+
+    def columns():
+        seen = set()
+        return [_dedup(decode_outcome_result_page(page, 1), seen) for page in pages]
+
+    legacy = _timed(rows)
+    columnar = _timed(columns)
+    expected = [row["id"] for page in rows() for row in page]
+    decoded = [_id for page in columns() for _id in page["id"].tolist()]
+    if expected != decoded:
+        raise AssertionError("columnar decoding kept different results")
+    _print_table(
+        ["pages", "results", "row dicts", "columns", "speedup"],
+        [
+            [
+                n_pages,
+                len(expected),
+                f"{legacy:.2f}s",
+                f"{columnar:.2f}s",
+                f"{legacy / columnar:.1f}x",
+            ]
+        ],
+    )
+
+
+def bench_bulk_load(sizes, statement_limit):
+    """
+    Compares the multi-row INSERT ... ON CONFLICT statement with the COPY staging path
+    :param sizes: row counts to test
+    :param statement_limit: skip the INSERT statement path above this many rows
+    :return: None
+    """
+    from sqlalchemy import Column, MetaData, Table
+    from sqlalchemy.dialects import postgresql
+
+    from utilities.db_functions import copy_upsert, execute_stmt
+    from utilities.db_models import OutcomeResults, engine
+
+    # Same columns as outcome_results without the foreign keys
+    bench_table = Table(
+        "bench_outcome_results",
+        MetaData(),
+        *[Column(c.name, c.type, primary_key=c.primary_key) for c in OutcomeResults.c]
+    )
+    bench_table.drop(engine, checkfirst=True)
+    bench_table.create(engine)
+
+    def statement_upsert(rows):
+        insert_stmt = postgresql.insert(bench_table).values(rows)
+        update_stmt = insert_stmt.on_conflict_do_update(
+            index_elements=["id"],
+            set_={
+                col: insert_stmt.excluded[col] for col in rows[0].keys() if col != "id"
+            },
+        )
+        execute_stmt(engine, update_stmt)
+
+    def copy_path(rows):
+        copy_upsert(bench_table, rows, engine, index_elements=["id"])
+
+    results = []
+    try:
+        for size in sizes:
+            rows = make_outcome_result_rows(size)
+            for name, loader in [("insert", statement_upsert), ("copy", copy_path)]:
+                if name == "insert" and size > statement_limit:
+                    results.append([size, name, "skipped", "skipped"])
+                    continue
+                execute_stmt(engine, bench_table.delete())
+                empty = _timed(loader, rows)
+                # Second load hits the ON CONFLICT branch for every row
+                conflict = _timed(loader, rows)
+                results.append([size, name, f"{empty:.2f}s", f"{conflict:.2f}s"])
+    finally:
+        bench_table.drop(engine)
+
+    _print_table(["rows", "path", "empty table", "all conflicts"], results)
+
+
+SYNC_STAGE_SQL = """
+    SELECT stage, sum(wall_seconds), sum(cpu_seconds), max(peak_rss_mb),
+        sum(canvas_requests), sum(rows_written), sum(skipped)
+    FROM sync_run_stages
+    WHERE sync_run_id = (SELECT max(id) FROM sync_runs) AND course_id IS NULL
+    GROUP BY stage
+    ORDER BY min(id)
+"""
+
+
+def _seed_sync_database(dataset, engine):
+    # The admin picks the terms to sync and sets up the grade table
+    from utilities.db_models import EnrollmentTerms, GradeCalculation
+
+    columns = [col.name for col in EnrollmentTerms.c]
+    with engine.begin() as conn:
+        for i, term in enumerate(dataset["terms"]):
+            row = {key: value for key, value in term.items() if key in columns}
+            conn.execute(
+                EnrollmentTerms.insert().values(
+                    row, sync_term=True, current_term=(i == 0)
+                )
+            )
+        conn.execute(
+            GradeCalculation.insert(),
+            [
+                dict(calculation, grade_rank=rank)
+                for rank, calculation in enumerate(CALCULATION_DICTIONARIES, 1)
+            ],
+        )
+
+
+def bench_sync(
+    courses,
+    students,
+    outcomes,
+    assessments,
+    runs,
+    change_fraction,
+    latency_ms,
+    workers,
+    dataset_path=None,
+    keep_tables=False,
+):
+    """
+    Runs the full sync against a local fake Canvas and reports each stage's timings,
+    peak memory, Canvas requests, rows written and skipped courses. Runs after the first
+    see a fraction of the courses change first, like the nightly sync does.
+    :param courses: number of synthetic courses
+    :param students: students per course
+    :param outcomes: outcomes per course
+    :param assessments: aligned assessments per outcome
+    :param runs: number of syncs
+    :param change_fraction: share of courses reassessed before each later run
+    :param latency_ms: mean fake Canvas response latency
+    :param workers: courses pulled at once (SYNC_WORKERS)
+    :param dataset_path: recorded dataset instead of the synthetic one
+    :param keep_tables: leave the tables behind for a look at the results
+    :return: None
+    """
+    import os
+
+    from utilities.fake_canvas import (
+        FakeCanvas,
+        load_dataset,
+        make_dataset,
+        mutate_dataset,
+        start_server,
+    )
+
+    if dataset_path:
+        dataset = load_dataset(dataset_path)
+    else:
+        dataset = make_dataset(courses, students, outcomes, assessments)
+    result_count = sum(len(results) for results in dataset["outcome_results"].values())
+    canvas = FakeCanvas(dataset, latency=latency_ms / 1000)
+    server, url = start_server(canvas)
+    # Read when canvas_api is imported, so set it first
+    os.environ["CANVAS_API_URL"] = url
+
+    import cron
+    from sqlalchemy import inspect, text
+
+    from utilities.canvas_client import client
+    from utilities.db_models import engine, metadata
+    from utilities.sync_ledger import _peak_rss_mb
+
+    existing = set(inspect(engine).get_table_names()) & set(metadata.tables)
+    if existing:
+        server.shutdown()
+        raise SystemExit(
+            f"The sync benchmark needs an empty scratch database, it already has "
+            f"{sorted(existing)}"
+        )
+    metadata.create_all(engine)
+    print(
+        f"{len(dataset['courses'])} courses, {len(dataset['users'])} users, "
+        f"{result_count} outcome results served at {url}"
+    )
+
+    try:
+        _seed_sync_database(dataset, engine)
+        for run in range(1, runs + 1):
+            if run > 1 and change_fraction:
+                changed = mutate_dataset(dataset, change_fraction, seed=run)
+                print(f"{changed} courses reassessed before run {run}")
+            client.reset_stats()
+            start = time.perf_counter()
+            cron.run(workers=workers, staged=False)
+            elapsed = time.perf_counter() - start
+
+            with engine.connect() as conn:
+                stages = conn.execute(text(SYNC_STAGE_SQL)).fetchall()
+            rows = [
+                [
+                    stage,
+                    f"{wall or 0:.2f}s",
+                    f"{cpu or 0:.2f}s",
+                    f"{rss or 0:.0f}",
+                    requests or 0,
+                    written or 0,
+                    skipped if skipped is not None else "",
+                ]
+                for stage, wall, cpu, rss, requests, written, skipped in stages
+            ]
+            stats = client.get_stats()
+            print(f"\nrun {run}: {elapsed:.2f}s, peak RSS {_peak_rss_mb():.0f} MB")
+            _print_table(
+                [
+                    "stage",
+                    "wall",
+                    "cpu",
+                    "peak MB",
+                    "requests",
+                    "rows written",
+                    "skipped",
+                ],
+                rows,
+            )
+            print(
+                f"Canvas: {stats['requests']} requests, {stats['bytes'] / 1e6:.1f} MB, "
+                f"{stats['retries']} retries, {stats['throttled']} throttled"
+            )
+    finally:
+        server.shutdown()
+        if not keep_tables:
+            metadata.drop_all(engine)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    subparsers = parser.add_subparsers(dest="benchmark")
+
+    bulk = subparsers.add_parser("bulk_load", help="INSERT vs COPY bulk loading")
+    bulk.add_argument(
+        "--sizes", type=int, nargs="+", default=[10000, 100000, 1000000]
+    )
+    bulk.add_argument(
+        "--statement-limit",
+        type=int,
+        default=1000000,
+        help="skip the INSERT statement path above this many rows",
+    )
+
+    grades = subparsers.add_parser(
+        "grade_engine", help="groupby lambda vs vectorized traditional grades"
+    )
+    grades.add_argument("--results", type=int, default=1000000)
+
+    pool = subparsers.add_parser(
+        "grade_pool", help="grade stage across 1 to N worker processes"
+    )
+    pool.add_argument("--results", type=int, default=2000000)
+    pool.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    pool.add_argument("--shard-rows", type=int, default=50000)
+
+    methods = subparsers.add_parser(
+        "calculation_methods", help="outcome calculation methods vs drop lowest"
+    )
+    methods.add_argument("--results", type=int, default=1000000)
+    methods.add_argument(
+        "--legacy-results",
+        type=int,
+        default=20000,
+        help="outcome results for the per-group weighted_avg comparison",
+    )
+
+    decode = subparsers.add_parser(
+        "payload_decode", help="row dictionaries vs typed columns for Canvas pages"
+    )
+    decode.add_argument("--pages", type=int, default=2000)
+
+    sync = subparsers.add_parser(
+        "sync", help="full sync against a local fake Canvas"
+    )
+    sync.add_argument("--courses", type=int, default=50)
+    sync.add_argument("--students", type=int, default=25, help="students per course")
+    sync.add_argument("--outcomes", type=int, default=8, help="outcomes per course")
+    sync.add_argument(
+        "--assessments", type=int, default=3, help="aligned assessments per outcome"
+    )
+    sync.add_argument("--runs", type=int, default=2)
+    sync.add_argument(
+        "--change-fraction",
+        type=float,
+        default=0.1,
+        help="share of courses reassessed before each run after the first",
+    )
+    sync.add_argument("--latency-ms", type=float, default=50)
+    sync.add_argument("--workers", type=int, default=4)
+    sync.add_argument("--dataset", help="recorded dataset from utilities.fake_canvas")
+    sync.add_argument(
+        "--keep-tables", action="store_true", help="don't drop the tables afterwards"
+    )
+
+    args = parser.parse_args()
+    if args.benchmark == "bulk_load":
+        bench_bulk_load(args.sizes, args.statement_limit)
+    elif args.benchmark == "grade_engine":
+        bench_grade_engine(args.results)
+    elif args.benchmark == "grade_pool":
+        bench_grade_pool(args.results, args.workers, args.shard_rows)
+    elif args.benchmark == "calculation_methods":
+        bench_calculation_methods(args.results, args.legacy_results)
+    elif args.benchmark == "payload_decode":
+        bench_payload_decode(args.pages)
+    elif args.benchmark == "sync":
+        bench_sync(
+            args.courses,
+            args.students,
+            args.outcomes,
+            args.assessments,
+            args.runs,
+            args.change_fraction,
+            args.latency_ms,
+            args.workers,
+            dataset_path=args.dataset,
+            keep_tables=args.keep_tables,
+        )
+    else:
+        parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
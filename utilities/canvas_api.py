@@ -1,17 +1,28 @@
 import os
 
 import pandas as pd
-import requests
 from pandas.io.json import json_normalize
 
+from utilities.canvas_client import client
 from utilities.db_functions import upsert_enrollment_terms, get_token, get_db_courses
 
 
-def get_headers():
-    access_token = os.getenv("CANVAS_API_KEY")
-    # access_token = get_token()
-    headers = {"Authorization": f"Bearer {access_token}"}
-    return headers
+# Canvas instance the sync reads from, e.g. utilities.fake_canvas for benchmarks
+CANVAS_API_URL = os.getenv("CANVAS_API_URL", "https://dtechhs.instructure.com")
+API_URL = f"{CANVAS_API_URL.rstrip('/')}/api/v1"
+
+
+def get_paginated(url, querystring=None):
+    """
+    Rolls up every page of a list endpoint
+    :param url: Canvas API url
+    :param querystring: query parameters for the first request
+    :return: list of the combined page contents
+    """
+    items = []
+    for response in client.get_pages(url, params=querystring):
+        items += response.json()
+    return items
 
 
 def get_users():
@@ -19,19 +30,10 @@ def get_users():
     Roll up current Users into a list of dictionaries (Canvas API /api/v1/accounts/:account_id/users)
     :return: List of user dictionaries
     """
-    headers = get_headers()
-    url = "https://dtechhs.instructure.com/api/v1/accounts/1/users"
+    url = f"{API_URL}/accounts/1/users"
 
     querystring = {"enrollment_type": "student", "per_page": "100"}
-    response = requests.request("GET", url, headers=headers, params=querystring)
-
-    users = response.json()
-
-    # pagination
-    while response.links.get("next"):
-        url = response.links["next"]["url"]
-        response = requests.request("GET", url, headers=headers)
-        users += response.json()
+    users = get_paginated(url, querystring)
 
     return users
 
@@ -42,55 +44,61 @@ def get_courses(current_term):
     :param current_term: Canvas Term to filter courses
     :return: list of course dictionaries
     """
-    headers = get_headers()
-    url = "https://dtechhs.instructure.com/api/v1/accounts/1/courses"
+    url = f"{API_URL}/accounts/1/courses"
     querystring = {
         "enrollment_term_id": current_term,
         "published": True,
         "per_page": 100,
     }
-    # initial request
-    response = requests.request("GET", url, headers=headers, params=querystring)
+    courses = get_paginated(url, querystring)
+    return courses
 
-    courses = response.json()
 
-    # pagination
-    while response.links.get("next"):
-        url = response.links["next"]["url"]
-        response = requests.request("GET", url, headers=headers)
-        courses += response.json()
-    return courses
+# The linked objects the sync stores. "outcomes.alignments" would nest every alignment
+# again inside its outcomes, which nothing reads.
+LINKED_INCLUDES = ["alignments", "outcomes"]
 
 
-def get_outcome_results(course, user_ids=None):
-    headers = get_headers()
-    url = (
-        f"https://dtechhs.instructure.com/api/v1/courses/{course['id']}/outcome_results"
-    )
-    querystring = {
-        "include[]": ["alignments", "outcomes.alignments", "outcomes"],
-        "per_page": "100",
-    }
+def iter_outcome_result_pages(course, user_ids=None, needs_linked=None):
+    """
+    Streams a course's outcome results one page at a time (Canvas API /api/v1/courses/:course_id/outcome_results)
+    :param course: course dictionary
+    :param user_ids: Limit to these user ids
+    :param needs_linked: function taking a page's outcome results and returning True if
+        their linked outcomes and alignments are needed. Pages are then requested without
+        the linked objects, and only requested again with them when it returns True.
+        None always includes them.
+    :return: generator of (outcome_results, alignments, outcomes) tuples, one per page.
+        The linked lists are empty when a page was served without them.
+    """
+    url = f"{API_URL}/courses/{course['id']}/outcome_results"
+    querystring = {"per_page": "100"}
+    if needs_linked is None:
+        querystring["include[]"] = LINKED_INCLUDES
     if user_ids:
         querystring["user_ids[]"] = user_ids
 
-    response = requests.request("GET", url, headers=headers, params=querystring)
-
-    data = response.json()
-
-    outcome_results = data["outcome_results"]
-    alignments = data["linked"]["alignments"]
-    outcomes = data["linked"]["outcomes"]
+    for response in client.get_pages(url, params=querystring):
+        data = response.json()
+        if "linked" not in data and needs_linked(data["outcome_results"]):
+            # Same page (the url keeps the page and user filters) with the linked objects
+            data = client.get(
+                response.url, params={"include[]": LINKED_INCLUDES}
+            ).json()
+        linked = data.get("linked", {})
+        yield (
+            data["outcome_results"],
+            linked.get("alignments", []),
+            linked.get("outcomes", []),
+        )
 
-    # Pagination
-    while response.links.get("next"):
-        url = response.links["next"]["url"]
-        response = requests.request("GET", url, headers=headers)
 
-        data = response.json()
-        outcome_results += data["outcome_results"]
-        alignments += data["linked"]["alignments"]
-        outcomes += data["linked"]["outcomes"]
+def get_outcome_results(course, user_ids=None):
+    outcome_results, alignments, outcomes = [], [], []
+    for page in iter_outcome_result_pages(course, user_ids=user_ids):
+        outcome_results += page[0]
+        alignments += page[1]
+        outcomes += page[2]
 
     return outcome_results, alignments, outcomes
 
@@ -103,10 +111,7 @@ def create_outcome_dataframes(course, user_ids=None):
     :param user_ids: Limit User ids mostly for testing
     :return: Dataframes with outcome_results, assignment alignments, and outcome details
     """
-    headers = get_headers()
-    url = (
-        f"https://dtechhs.instructure.com/api/v1/courses/{course['id']}/outcome_results"
-    )
+    url = f"{API_URL}/courses/{course['id']}/outcome_results"
     querystring = {
         "include[]": ["alignments", "outcomes.alignments", "outcomes"],
         "per_page": "100",
@@ -114,7 +119,7 @@ def create_outcome_dataframes(course, user_ids=None):
     if user_ids:
         querystring["user_ids[]"] = user_ids
 
-    response = requests.request("GET", url, headers=headers)
+    response = client.get(url)
     data = response.json()
 
     outcome_results = json_normalize(data["outcome_results"])
@@ -124,7 +129,7 @@ def create_outcome_dataframes(course, user_ids=None):
     # Pagination
     while response.links.get("next"):
         url = response.links["next"]["url"]
-        response = requests.request("GET", url, headers=headers)
+        response = client.get(url)
         data = response.json()
         outcome_results = pd.concat(
             [outcome_results, json_normalize(data["outcome_results"])]
@@ -145,18 +150,10 @@ def get_course_users_ids(course):
     :param course: course dictionary
     :return: user id's for course
     """
-    headers = get_headers()
-    url = f"https://dtechhs.instructure.com/api/v1/courses/{course['id']}/users"
+    url = f"{API_URL}/courses/{course['id']}/users"
 
     querystring = {"enrollment_type[]": "student", "per_page": "100"}
-    response = requests.request("GET", url, headers=headers, params=querystring)
-    students = [user["id"] for user in response.json()]
-
-    # Pagination
-    while response.links.get("next"):
-        url = response.links["next"]["url"]
-        response = requests.request("GET", url, headers=headers)
-        students += [user["id"] for user in response.json()]
+    students = [user["id"] for user in get_paginated(url, querystring)]
 
     return students
 
@@ -167,53 +164,37 @@ def get_course_users(course):
     :param course: course dictionary
     :return: user id's for course
     """
-    headers = get_headers()
-    url = f"https://dtechhs.instructure.com/api/v1/courses/{course['id']}/users"
+    url = f"{API_URL}/courses/{course['id']}/users"
 
     querystring = {"enrollment_type[]": "student", "per_page": "100"}
-    response = requests.request("GET", url, headers=headers, params=querystring)
-    students = response.json()
-
-    # Pagination
-    while response.links.get("next"):
-        url = response.links["next"]["url"]
-        response = requests.request("GET", url, headers=headers)
-        students += response.json()
+    students = get_paginated(url, querystring)
 
     return students
 
 
 def get_observees(user_id):
-    headers = get_headers()
-    url = f"https://dtechhs.instructure.com/api/v1/users/{user_id}/observees"
-    response = requests.request("GET", url, headers=headers)
+    url = f"{API_URL}/users/{user_id}/observees"
+    response = client.get(url)
 
     return response
 
 
 def get_user_courses(user_id):
-    headers = get_headers()
-    url = f"https://dtechhs.instructure.com/api/v1/users/{user_id}/courses"
+    url = f"{API_URL}/users/{user_id}/courses"
     querystring = {"enrollment_type[]": "student", "per_page": "100"}
-    courses = requests.request("GET", url, headers=headers).json()
+    courses = client.get(url).json()
     keys = ["id", "name", "enrollment_term_id"]
     # courses = [{key: course[key] for key in keys} for course in courses]
     return courses
 
 
 def get_enrollment_terms():
-    headers = get_headers()
-    url = "https://dtechhs.instructure.com/api/v1/accounts/1/terms"
+    url = f"{API_URL}/accounts/1/terms"
     querystring = {"per_page": "100"}
-    response = requests.request("GET", url, headers=headers, params=querystring)
 
-    terms = response.json()["enrollment_terms"]
-
-    while response.links.get("next"):
-        url = response.links["next"]["url"]
-        response = requests.request("GET", url, headers=headers)
-        new_terms = response.json()["enrollment_terms"]
-        terms += new_terms
+    terms = []
+    for response in client.get_pages(url, params=querystring):
+        terms += response.json()["enrollment_terms"]
 
     for term in terms:
         del term["grading_period_group_id"]
@@ -222,12 +203,14 @@ def get_enrollment_terms():
 
 
 def get_sections(course_id):
-    headers = get_headers()
-    url = f"https://dtechhs.instructure.com/api/v1/courses/{course_id}/sections"
+    """
+    Gets every section of a course with its students and their enrollments
+    :param course_id: course id
+    :return: list of section dictionaries
+    """
+    url = f"{API_URL}/courses/{course_id}/sections"
     querystring = {"per_page": "100", "include[]": ["students", "enrollments"]}
-    response = requests.request("GET", url, headers=headers, params=querystring)
-
-    sections = response.json()
+    sections = get_paginated(url, querystring)
 
     return sections
 
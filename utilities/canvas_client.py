@@ -0,0 +1,158 @@
+import os
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# Canvas' leaky bucket starts at 700 units, throttle before we get close to empty
+RATE_LIMIT_FLOOR = 200.0
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class CanvasClient(object):
+    """
+    Shared HTTP client for the Canvas API.
+    Keeps connections alive between paginated requests, retries transient failures with
+    jittered exponential backoff and slows down when Canvas reports the rate limit bucket
+    is running low (X-Rate-Limit-Remaining / X-Request-Cost headers).
+    """
+
+    def __init__(
+        self,
+        pool_size=10,
+        max_retries=5,
+        backoff_base=0.5,
+        backoff_max=30.0,
+        rate_limit_floor=RATE_LIMIT_FLOOR,
+        timeout=60,
+    ):
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.rate_limit_floor = rate_limit_floor
+        self.timeout = timeout
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+        self._lock = threading.Lock()
+        self._rate_limit_remaining = None
+        self.stats = self._empty_stats()
+
+    @staticmethod
+    def _empty_stats():
+        return {
+            "requests": 0,
+            "retries": 0,
+            "throttled": 0,
+            "bytes": 0,
+            "seconds": 0.0,
+            "cost": 0.0,
+        }
+
+    def reset_stats(self):
+        with self._lock:
+            self.stats = self._empty_stats()
+
+    def get_stats(self):
+        """
+        Snapshot of the request counters since the last reset
+        :return: dictionary of counters
+        """
+        with self._lock:
+            return dict(self.stats)
+
+    def _headers(self):
+        access_token = os.getenv("CANVAS_API_KEY")
+        # access_token = get_token()
+        return {"Authorization": f"Bearer {access_token}"}
+
+    def _backoff(self, attempt):
+        # Full jitter so concurrent workers don't retry in lockstep
+        delay = min(self.backoff_max, self.backoff_base * 2 ** attempt)
+        time.sleep(random.uniform(0, delay))
+
+    def _throttle(self):
+        """
+        Sleeps in proportion to how far the rate limit bucket is below the floor.
+        Canvas refills the bucket continuously, so a short pause is enough.
+        """
+        remaining = self._rate_limit_remaining
+        if remaining is None or remaining >= self.rate_limit_floor:
+            return
+        with self._lock:
+            self.stats["throttled"] += 1
+        shortfall = (self.rate_limit_floor - remaining) / self.rate_limit_floor
+        time.sleep(min(self.backoff_max, 0.1 + 5 * shortfall))
+
+    def _record(self, response, elapsed):
+        remaining = response.headers.get("X-Rate-Limit-Remaining")
+        cost = response.headers.get("X-Request-Cost")
+        with self._lock:
+            self.stats["requests"] += 1
+            self.stats["bytes"] += len(response.content)
+            self.stats["seconds"] += elapsed
+            if cost:
+                self.stats["cost"] += float(cost)
+            if remaining:
+                self._rate_limit_remaining = float(remaining)
+
+    @staticmethod
+    def _is_rate_limited(response):
+        return response.status_code == 403 and "Rate Limit Exceeded" in response.text
+
+    def request(self, method, url, params=None):
+        """
+        Makes a request to the Canvas API, retrying on throttling and transient errors
+        :param method: HTTP method
+        :param url: full url (pagination links already include the query string)
+        :param params: query string parameters
+        :return: requests Response
+        """
+        attempt = 0
+        while True:
+            self._throttle()
+            start = time.perf_counter()
+            try:
+                response = self.session.request(
+                    method, url, headers=self._headers(), params=params, timeout=self.timeout
+                )
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt >= self.max_retries:
+                    raise
+            else:
+                self._record(response, time.perf_counter() - start)
+                retry = response.status_code in RETRY_STATUSES or self._is_rate_limited(
+                    response
+                )
+                if not retry or attempt >= self.max_retries:
+                    return response
+
+            with self._lock:
+                self.stats["retries"] += 1
+            self._backoff(attempt)
+            attempt += 1
+
+    def get(self, url, params=None):
+        return self.request("GET", url, params=params)
+
+    def get_pages(self, url, params=None):
+        """
+        Follows Canvas' Link header pagination
+        :param url: url of the first page
+        :param params: query string parameters for the first page
+        :return: generator of responses, one per page
+        """
+        response = self.get(url, params=params)
+        yield response
+
+        while response.links.get("next"):
+            response = self.get(response.links["next"]["url"])
+            yield response
+
+
+client = CanvasClient()
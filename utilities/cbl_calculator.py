@@ -2,25 +2,34 @@ import json
 import math
 from datetime import datetime
 
+import numpy as np
 import pandas as pd
 
-from utilities.db_functions import get_calculation_dictionaries
 
+# How an outcome's scores are combined into its average. drop_lowest is the school's rule
+# and the default, the rest are Canvas's outcome calculation methods.
+DROP_LOWEST = "drop_lowest"
+CALCULATION_METHODS = [
+    DROP_LOWEST,
+    "average",
+    "decaying_average",
+    "latest",
+    "highest",
+    "n_mastery",
+]
+# Term setting that grades each outcome with the calculation method set on it in Canvas
+OUTCOME_METHOD = "outcome"
 
-def weighted_avg(scores):
-    s = scores.apply(pd.Series)
-    if len(s) == 1:
-        return s.iloc[0, 0]
+# Canvas's defaults, for outcomes that don't set them
+DEFAULT_CALCULATION_INTS = {"decaying_average": 65, "n_mastery": 5}
+DEFAULT_MASTERY_POINTS = 3.0
 
-    # need check that there's more than 1 outcome alignment
-    first_weight = (100 - s.iloc[0, 1]) / 100
-    final_weight = s.iloc[0, 1] / 100
-    w_avg = first_weight * s.iloc[:-1, 0].mean() + final_weight * s.iloc[-1, 0]
-    return w_avg
-
-
-def outcome_avg(alignments=None):
-    pass
+OUTCOME_CALCULATION_COLS = [
+    "outcome_id",
+    "calculation_method",
+    "calculation_int",
+    "mastery_points",
+]
 
 
 def calculate_traditional_grade(scores, calculation_dictionaries):
@@ -53,6 +62,391 @@ def calculate_traditional_grade(scores, calculation_dictionaries):
     return calculation_dictionaries[-1]
 
 
+def grade_calculation_method(current_term):
+    return current_term.get("calculation_method") or DROP_LOWEST
+
+
+def resolve_outcome_calculations(outcome_ids, calculation_method, outcome_calculations):
+    """
+    Works out the calculation method, calculation_int and mastery points of each outcome
+    :param outcome_ids: array of unique outcome ids
+    :param calculation_method: the term's calculation method, OUTCOME_METHOD uses each
+        outcome's own
+    :param outcome_calculations: DataFrame or dictionary of arrays with
+        OUTCOME_CALCULATION_COLS, or None
+    :return: DataFrame indexed by outcome_id with method, calculation_int and
+        mastery_points columns
+    """
+    settings = pd.DataFrame(outcome_calculations, columns=OUTCOME_CALCULATION_COLS)
+    settings = settings.drop_duplicates("outcome_id").set_index("outcome_id")
+    settings = settings.reindex(outcome_ids)
+
+    outcome_methods = settings["calculation_method"].values
+    if calculation_method == OUTCOME_METHOD:
+        # Outcomes without a method we know fall back to the school's rule
+        methods = np.array(
+            [m if m in CALCULATION_METHODS else DROP_LOWEST for m in outcome_methods],
+            dtype=object,
+        )
+    else:
+        methods = np.full(len(settings), calculation_method, dtype=object)
+
+    # An outcome's calculation_int belongs to its own method, e.g. 65 means 65% for a
+    # decaying average but 65 times for n_mastery
+    calculation_ints = pd.to_numeric(settings["calculation_int"], errors="coerce").values
+    default_ints = [DEFAULT_CALCULATION_INTS.get(m, 0) for m in methods]
+    calculation_ints = np.where(
+        (outcome_methods == methods) & ~np.isnan(calculation_ints),
+        calculation_ints,
+        default_ints,
+    )
+    mastery_points = pd.to_numeric(settings["mastery_points"], errors="coerce")
+    return pd.DataFrame(
+        {
+            "method": methods,
+            "calculation_int": calculation_ints,
+            "mastery_points": mastery_points.fillna(DEFAULT_MASTERY_POINTS).values,
+        },
+        index=settings.index,
+    )
+
+
+def calculate_outcome_averages(
+    outcome_results, cut_off_date, calculation_method=None, outcome_calculations=None
+):
+    """
+    Averages each student's scores per outcome. Every (user, course, outcome) group is
+    calculated at once from a few groupby aggregates, whatever its calculation method:
+        drop_lowest: the average, dropping the lowest score (assessed before the cut off
+            date) when that gives the higher average
+        average: the average
+        decaying_average: the latest score weighted calculation_int%, the average of the
+            earlier scores the rest
+        latest: the latest score
+        highest: the highest score
+        n_mastery: the average of the scores at or above mastery once there are
+            calculation_int of them, the average of every score until then
+    :param outcome_results: DataFrame with links.user, course_id, outcome_id, score and
+        submitted_or_assessed_at columns
+    :param cut_off_date: only results before this date are eligible to be dropped
+    :param calculation_method: one of CALCULATION_METHODS, or OUTCOME_METHOD to use each
+        outcome's own, defaults to drop_lowest
+    :param outcome_calculations: outcome settings with OUTCOME_CALCULATION_COLS, only
+        needed for methods other than drop_lowest
+    :return: DataFrame of outcome averages, one row per user, course and outcome.
+        Outcomes with no results before the cut off date have graded=False, they're shown
+        on the dashboards but don't count towards the grade.
+    """
+    calculation_method = calculation_method or DROP_LOWEST
+    drop_eligible_results = outcome_results.loc[
+        outcome_results["submitted_or_assessed_at"] < cut_off_date
+    ]
+
+    # get min score from drop_eligible_results
+    group_cols = ["links.user", "course_id", "outcome_id"]
+    min_score = (
+        drop_eligible_results.groupby(group_cols)
+        .agg(min_score=("score", "min"))
+        .reset_index()
+    )
+
+    if calculation_method == DROP_LOWEST:
+        full_avg = (
+            outcome_results.groupby(group_cols)
+            .agg(
+                full_avg=("score", "mean"), count=("score", "count"), sum=("score", "sum")
+            )
+            .reset_index()
+        )
+        settings = None
+    else:
+        outcome_ids = outcome_results["outcome_id"].values
+        settings = resolve_outcome_calculations(
+            np.unique(outcome_ids), calculation_method, outcome_calculations
+        )
+        mastery_points = settings["mastery_points"].values[
+            settings.index.get_indexer(outcome_ids)
+        ]
+        # Oldest first, groupby keeps the row order within a group so "last" is the latest
+        outcome_results = outcome_results.assign(
+            mastered=np.where(
+                outcome_results["score"].values >= mastery_points,
+                outcome_results["score"].values,
+                np.nan,
+            )
+        ).sort_values("submitted_or_assessed_at", kind="mergesort")
+        full_avg = (
+            outcome_results.groupby(group_cols)
+            .agg(
+                full_avg=("score", "mean"),
+                count=("score", "count"),
+                sum=("score", "sum"),
+                highest=("score", "max"),
+                latest=("score", "last"),
+                mastered_count=("mastered", "count"),
+                mastered_avg=("mastered", "mean"),
+            )
+            .reset_index()
+        )
+    outcome_avgs = pd.merge(full_avg, min_score, on=group_cols, how="left")
+    outcome_avgs["graded"] = outcome_avgs["min_score"].notna()
+    outcome_avgs["drop_avg"] = (outcome_avgs["sum"] - outcome_avgs["min_score"]) / (
+        outcome_avgs["count"] - 1
+    )
+
+    # Pick the higher average
+    outcome_avgs["drop_min"] = outcome_avgs["drop_avg"] > outcome_avgs["full_avg"]
+    outcome_avgs["outcome_avg"] = np.where(
+        outcome_avgs["drop_min"], outcome_avgs["drop_avg"], outcome_avgs["full_avg"],
+    )
+    if settings is None:
+        return outcome_avgs
+
+    outcome_index = settings.index.get_indexer(outcome_avgs["outcome_id"].values)
+    method = settings["method"].values[outcome_index]
+    calculation_int = settings["calculation_int"].values[outcome_index]
+    count = outcome_avgs["count"].values
+    latest = outcome_avgs["latest"].values
+
+    weight = calculation_int / 100
+    earlier_avg = (outcome_avgs["sum"].values - latest) / np.maximum(count - 1, 1)
+    decaying_avg = np.where(
+        count > 1, weight * latest + (1 - weight) * earlier_avg, latest
+    )
+    n_mastery_avg = np.where(
+        outcome_avgs["mastered_count"].values >= calculation_int,
+        outcome_avgs["mastered_avg"].values,
+        outcome_avgs["full_avg"].values,
+    )
+
+    outcome_avgs["drop_min"] &= method == DROP_LOWEST
+    outcome_avgs["outcome_avg"] = np.select(
+        [
+            method == "average",
+            method == "decaying_average",
+            method == "latest",
+            method == "highest",
+            method == "n_mastery",
+        ],
+        [
+            outcome_avgs["full_avg"].values,
+            decaying_avg,
+            latest,
+            outcome_avgs["highest"].values,
+            n_mastery_avg,
+        ],
+        default=outcome_avgs["outcome_avg"].values,
+    )
+    return outcome_avgs
+
+
+def calculate_traditional_grades(user_ids, course_ids, scores, calculation_dictionaries):
+    """
+    Vectorized calculate_traditional_grade for every (user, course) pair at once.
+    One lexsort puts each pair's scores in a contiguous, descending segment, so the 75%
+    threshold and min score are plain offsets into the sorted array.
+    :param user_ids: array of user ids, one per outcome average
+    :param course_ids: array of course ids, one per outcome average
+    :param scores: array of outcome averages
+    :param calculation_dictionaries: grade cutoffs ordered by grade_rank
+    :return: DataFrame with links.user, course_id, threshold, min_score and grade columns,
+        sorted by user and course
+    """
+    user_ids = np.asarray(user_ids)
+    course_ids = np.asarray(course_ids)
+    scores = np.asarray(scores, dtype="float64")
+    columns = ["links.user", "course_id", "threshold", "min_score", "grade"]
+    if len(scores) == 0:
+        return pd.DataFrame(columns=columns)
+
+    # Sort by user, course, then score descending (lexsort uses the last key first)
+    order = np.lexsort((-scores, course_ids, user_ids))
+    sorted_users = user_ids[order]
+    sorted_courses = course_ids[order]
+    sorted_scores = scores[order]
+
+    # Segment offsets for each (user, course) pair
+    boundaries = np.empty(len(order), dtype=bool)
+    boundaries[0] = True
+    boundaries[1:] = (sorted_users[1:] != sorted_users[:-1]) | (
+        sorted_courses[1:] != sorted_courses[:-1]
+    )
+    starts = np.flatnonzero(boundaries)
+    counts = np.diff(np.append(starts, len(order)))
+
+    # Find the 75% threshold --> floored, a single score wraps around to itself (index -1)
+    threshold_index = np.floor(0.75 * counts).astype("int64") - 1
+    threshold_index = np.where(threshold_index < 0, counts + threshold_index, threshold_index)
+    threshold = sorted_scores[starts + threshold_index]
+    min_score = sorted_scores[starts + counts - 1]
+
+    # calculate_traditional_grade checks the pair's first score in its original order for
+    # unassessed outcomes. lexsort is stable, so this keeps the original order in each segment
+    first_score = scores[np.lexsort((course_ids, user_ids))][starts]
+    not_assessed = first_score == -1
+
+    # The first grade (by rank) whose cutoffs are met. The grade table is small, so compare
+    # every pair against every row rather than assuming the cutoffs are monotonic
+    cutoffs = pd.DataFrame(calculation_dictionaries)
+    meets = (threshold[:, None] >= cutoffs["threshold"].values[None, :]) & (
+        min_score[:, None] >= cutoffs["min_score"].values[None, :]
+    )
+    has_grade = meets.any(axis=1)
+    grade_index = meets.argmax(axis=1)
+    grade = cutoffs["grade"].values[grade_index].astype(object)
+
+    # No grade matched, calculate_traditional_grade returns the last calculation dictionary
+    last = calculation_dictionaries[-1]
+    grade[~has_grade] = last["grade"]
+    threshold = np.where(has_grade, threshold, last["threshold"])
+    min_score = np.where(has_grade, min_score, last["min_score"])
+
+    # Unassessed
+    grade[not_assessed] = "n/a"
+    threshold = np.where(not_assessed, np.nan, threshold)
+    min_score = np.where(not_assessed, np.nan, min_score)
+
+    return pd.DataFrame(
+        {
+            "links.user": sorted_users[starts],
+            "course_id": sorted_courses[starts],
+            "threshold": threshold,
+            "min_score": min_score,
+            "grade": grade,
+        },
+        columns=columns,
+    )
+
+
+# Columns of the outcome averages stored with each grade
+GRADE_OUTCOME_COLS = ["links.user", "course_id", "outcome_id", "outcome_avg", "drop_min"]
+
+
+def make_grade_outcomes(outcome_avgs):
+    """
+    Formats outcome averages for the grades.outcomes column
+    :param outcome_avgs: DataFrame from calculate_outcome_averages
+    :return: dictionary keyed by (user_id, course_id) of outcome average dictionaries
+    """
+    grade_outcomes = {}
+    for user_id, course_id, outcome_id, avg, drop_min in outcome_avgs[
+        GRADE_OUTCOME_COLS
+    ].itertuples(index=False):
+        grade_outcomes.setdefault((user_id, course_id), []).append(
+            {
+                "outcome_id": int(outcome_id),
+                "avg": round(float(avg), 2),
+                "drop_min": bool(drop_min),
+            }
+        )
+    return grade_outcomes
+
+
+def grade_cut_off_date(current_term):
+    # check if the cut off date has been set, if not, use the last day of the term
+    if current_term["cut_off_date"]:
+        return current_term["cut_off_date"]
+    return current_term["end_at"]
+
+
+def calculate_grade_frames(
+    outcome_results,
+    cut_off_date,
+    calculation_dictionaries,
+    calculation_method=None,
+    outcome_calculations=None,
+):
+    """
+    The grade math without the formatting, so it can run in a worker process
+    :param outcome_results: DataFrame with links.user, course_id, outcome_id, score and
+        submitted_or_assessed_at columns
+    :param cut_off_date: only results before this date are eligible to be dropped
+    :param calculation_dictionaries: grade cutoffs ordered by grade_rank
+    :param calculation_method: see calculate_outcome_averages
+    :param outcome_calculations: see calculate_outcome_averages
+    :return: (grades DataFrame from calculate_traditional_grades, outcome averages
+        DataFrame with GRADE_OUTCOME_COLS)
+    """
+    outcome_avgs = calculate_outcome_averages(
+        outcome_results, cut_off_date, calculation_method, outcome_calculations
+    )
+
+    # calculate the grades
+    graded_avgs = outcome_avgs[outcome_avgs["graded"]]
+    grades = calculate_traditional_grades(
+        graded_avgs["links.user"].values,
+        graded_avgs["course_id"].values,
+        graded_avgs["outcome_avg"].values,
+        calculation_dictionaries,
+    )
+    return grades, outcome_avgs[GRADE_OUTCOME_COLS]
+
+
+def add_grade_outcomes(grades, outcome_avgs):
+    """
+    Stores the per outcome averages with the grade so the dashboards don't recompute them
+    :param grades: DataFrame from calculate_grade_frames
+    :param outcome_avgs: DataFrame from calculate_grade_frames
+    :return: DataFrame of grades with user_id and outcomes columns
+    """
+    grade_outcomes = make_grade_outcomes(outcome_avgs)
+    grades["outcomes"] = [
+        grade_outcomes.get((user_id, course_id), [])
+        for user_id, course_id in zip(grades["links.user"], grades["course_id"])
+    ]
+
+    grades.rename(columns={"links.user": "user_id"}, inplace=True)
+    return grades
+
+
+GRADE_COLS = [
+    "course_id",
+    "user_id",
+    "threshold",
+    "min_score",
+    "grade",
+    "record_id",
+    "outcomes",
+]
+
+
+def grade_rows(grades):
+    """
+    Formats calculated grades for the grades table
+    :param grades: DataFrame of grades with a record_id
+    :return: list of grade dictionaries
+    """
+    grades_list = grades[GRADE_COLS].to_dict("records")
+    # n/a grades come back with NaN cutoffs, they're stored as NULL
+    for grade in grades_list:
+        for col in ("threshold", "min_score"):
+            if pd.isna(grade[col]):
+                grade[col] = None
+    return grades_list
+
+
+def calculate_grades(
+    outcome_results, current_term, calculation_dictionaries, outcome_calculations=None
+):
+    """
+    Calculates grades, with their per outcome averages, from outcome results
+    :param outcome_results: DataFrame from iter_course_outcome_results
+    :param current_term: term dictionary, for the cut off date and calculation method
+    :param calculation_dictionaries: grade cutoffs ordered by grade_rank
+    :param outcome_calculations: outcome settings with OUTCOME_CALCULATION_COLS
+    :return: DataFrame of grades, one row per graded (user, course) pair, without a
+        record_id
+    """
+    grades, outcome_avgs = calculate_grade_frames(
+        outcome_results,
+        grade_cut_off_date(current_term),
+        calculation_dictionaries,
+        grade_calculation_method(current_term),
+        outcome_calculations,
+    )
+    return add_grade_outcomes(grades, outcome_avgs)
+
+
 if __name__ == "__main__":
     with open("../out/alignments.json", "r") as fp:
         alignments = json.load(fp)
@@ -1,6 +1,10 @@
+import os
+import queue
 import re
+import threading
 import time
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
 import json
 
 import numpy as np
@@ -9,32 +13,86 @@ import pandas as pd
 from utilities.canvas_api import (
     get_courses,
     get_outcome_results,
+    iter_outcome_result_pages,
     get_course_users,
     get_users,
     get_enrollment_terms,
     get_sections
 )
-from utilities.cbl_calculator import calculate_traditional_grade
+from utilities.cbl_calculator import (
+    DROP_LOWEST,
+    calculate_grades,
+    grade_calculation_method,
+    grade_rows,
+)
+from utilities.db_models import Alignments, Outcomes
+from utilities.digests import (
+    DIGEST_RESULT_COLS,
+    format_digest,
+    replace_in_digest,
+    row_hashes,
+    stored_result_columns,
+)
+from utilities.grade_pool import GRADE_WORKERS, sharded_course_grades
+from utilities.metadata_cache import MetadataCache, content_hashes
 from utilities.db_functions import (
     insert_grades_to_db,
     create_record,
     delete_outcome_results,
+    delete_outcome_results_by_id,
+    get_course_result_ids,
+    get_course_sync_state,
+    upsert_course_sync_state,
+    get_course_roster_digests,
+    set_course_roster_digests,
+    get_course_students,
+    delete_course_student_pairs,
+    upsert_course_students,
+    clear_staged_outcome_results,
+    stage_outcome_results,
+    stage_outcome_result_deletes,
+    stage_course_sync_state,
+    publish_staged_outcome_results,
+    add_sync_checkpoint,
+    get_sync_checkpoints,
+    get_outcome_results_by_id,
+    get_sync_run_started_at,
     upsert_alignments,
     upsert_users,
-    upsert_outcome_results,
+    get_user_hashes,
+    upsert_outcome_result_columns,
     upsert_outcomes,
     upsert_courses,
     query_current_outcome_results,
     get_db_courses,
-    insert_course_students,
-    delete_course_students,
     delete_grades_current_term,
     upsert_enrollment_terms,
     get_calculation_dictionaries,
+    get_outcome_calculations,
     get_current_term,
-    get_sync_terms
+    get_sync_terms,
+    get_terms,
+    get_courses_by_id,
+    iter_course_outcome_results,
+    delete_pair_grades,
+    mark_dirty_pairs,
+    mark_result_pairs_dirty,
+    get_term_dirty_marks,
+    get_pair_dirty_marks,
+    clear_dirty_marks,
+    has_term_grades,
 )
 
+# Courses without outcome based grades
+NON_GRADED_PATTERN = "@dtech|Teacher Assistant|LAB Day|FIT|Innovation Diploma FIT"
+# Courses without a roster worth tracking
+NON_ACADEMIC_PATTERN = f"{NON_GRADED_PATTERN}|Beyond D.Tech"
+
+# Courses whose rosters are fetched from Canvas at once
+ROSTER_WORKERS = int(os.getenv("ROSTER_WORKERS", 4))
+# Courses whose roster changes are written in one transaction
+ROSTER_BATCH_COURSES = int(os.getenv("ROSTER_BATCH_COURSES", 25))
+
 
 def make_grade_object(grade, outcome_avgs, record_id, course, user_id):
     """
@@ -78,211 +136,762 @@ def make_empty_grade(course, grades_list, record_id, user_id):
     grades_list.append(grade)
 
 
-def make_outcome_result(outcome_result, course_id, enrollment_term):
-    temp_dict = {
-        "id": outcome_result["id"],
-        "score": outcome_result["score"],
-        "course_id": course_id,
-        "user_id": outcome_result["links"]["user"],
-        "outcome_id": outcome_result["links"]["learning_outcome"],
-        "alignment_id": outcome_result["links"]["alignment"],
-        "submitted_or_assessed_at": outcome_result["submitted_or_assessed_at"],
-        "last_updated": datetime.utcnow(),
-        # 'enrollment_term': enrollment_term
+def parse_canvas_datetime(value):
+    """
+    Parses a Canvas ISO 8601 timestamp into a naive UTC datetime (how they're stored)
+    :param value: timestamp string, e.g. 2021-09-07T21:34:24Z
+    :return: datetime or None
+    """
+    if not value:
+        return None
+    parsed = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+
+def _canvas_datetimes(values):
+    # numpy parses ISO 8601, but not the "Z" (UTC) suffix Canvas puts on every timestamp
+    if all(value is None or value.endswith("Z") for value in values):
+        values = [value and value[:-1] for value in values]
+    else:
+        values = [parse_canvas_datetime(value) for value in values]
+    return np.array(values, dtype="datetime64[us]")
+
+
+def page_length(columns):
+    return len(columns["id"])
+
+
+def decode_outcome_result_page(outcome_results, course_id):
+    """
+    Decodes a page of Canvas outcome results straight into typed column arrays
+    :param outcome_results: outcome_results list from the Canvas response
+    :param course_id: course id
+    :return: dictionary of outcome_results column arrays, one entry per result
+    """
+    links = [res["links"] for res in outcome_results]
+    count = len(outcome_results)
+    # Canvas sends the linked ids as strings
+    return {
+        "id": np.array([res["id"] for res in outcome_results], dtype="int64"),
+        "score": np.array([res["score"] for res in outcome_results], dtype="float64"),
+        "course_id": np.full(count, course_id, dtype="int64"),
+        "user_id": np.array([link["user"] for link in links], dtype="int64"),
+        "outcome_id": np.array(
+            [link["learning_outcome"] for link in links], dtype="int64"
+        ),
+        "alignment_id": np.array([link["alignment"] for link in links], dtype=object),
+        "submitted_or_assessed_at": _canvas_datetimes(
+            [res["submitted_or_assessed_at"] for res in outcome_results]
+        ),
+        "last_updated": np.full(count, np.datetime64(datetime.utcnow(), "us")),
     }
-    return temp_dict
 
 
-def format_outcome(outcome):
-    try:
-        temp_dict = {
-            "id": outcome["id"],
-            "display_name": outcome["display_name"],
-            "title": outcome["title"],
-            "calculation_int": outcome["calculation_int"],
-        }
-    except:
-        temp_dict = {
-            "id": outcome["id"],
-            "display_name": outcome["display_name"],
-            "title": outcome["title"],
-            "calculation_int": 65,
-        }
-        print("*****************")
-        print("there was a calc_int error")
+def decode_outcomes(outcomes):
+    """
+    :param outcomes: linked outcomes list from the Canvas response
+    :return: dictionary of outcomes column arrays
+    """
+    # Canvas leaves calculation_int out for some outcomes
+    missing_int = sum("calculation_int" not in outcome for outcome in outcomes)
+    if missing_int:
+        print(f"{missing_int} outcomes without a calculation_int, using 65")
+    return {
+        "id": np.array([outcome["id"] for outcome in outcomes], dtype="int64"),
+        "display_name": np.array(
+            [outcome["display_name"] for outcome in outcomes], dtype=object
+        ),
+        "title": np.array([outcome["title"] for outcome in outcomes], dtype=object),
+        "calculation_int": np.array(
+            [outcome.get("calculation_int", 65) for outcome in outcomes],
+            dtype="float64",
+        ),
+        "calculation_method": np.array(
+            [outcome.get("calculation_method") for outcome in outcomes], dtype=object
+        ),
+        "mastery_points": np.array(
+            [outcome.get("mastery_points") for outcome in outcomes], dtype="float64"
+        ),
+    }
 
-    return temp_dict
 
-    return temp_dict
+def decode_users(users):
+    """
+    :param users: user list from get_users
+    :return: dictionary of users column arrays
+    """
+    return {
+        "id": np.array([user["id"] for user in users], dtype="int64"),
+        "name": np.array([user["name"] for user in users], dtype=object),
+        "sis_user_id": np.array([user["sis_user_id"] for user in users], dtype=object),
+        "login_id": np.array([user["login_id"] for user in users], dtype=object),
+    }
 
 
-def format_alignments(alignment):
-    ids = ["id", "name"]
-    return {_id: alignment[_id] for _id in ids}
+def decode_alignments(alignments):
+    """
+    :param alignments: linked alignments list from the Canvas response
+    :return: dictionary of alignments column arrays
+    """
+    return {
+        "id": np.array([alignment["id"] for alignment in alignments], dtype=object),
+        "name": np.array([alignment["name"] for alignment in alignments], dtype=object),
+    }
 
 
-def pull_outcome_results(current_term, engine):
-    # get all courses for current term todo - pull from database
-    current_term_id = current_term["id"]
-    courses = get_courses(current_term_id)
+def stream_course_outcome_results(course, current_term_id, metadata_cache=None):
+    """
+    Streams a course's decoded outcome results from Canvas one page at a time. Only reads
+    the metadata cache, so it's safe to run in a worker thread.
+    :param course: course dictionary
+    :param current_term_id: enrollment term id
+    :param metadata_cache: MetadataCache, pages only include their linked outcomes and
+        alignments when it's missing some. None always includes them.
+    :return: generator of (outcome_results, outcomes, alignments) column dictionaries,
+        one per page
+    """
+    # get course users
+    users = get_course_users(course)
+    user_ids = [user["id"] for user in users]
+
+    needs_linked = metadata_cache.needs_linked if metadata_cache else None
+    pages = iter_outcome_result_pages(course, user_ids=user_ids, needs_linked=needs_linked)
+    for outcome_results, alignments, outcomes in pages:
+        # Removed Null filter (works better for upsert)
+        yield (
+            decode_outcome_result_page(outcome_results, course["id"]),
+            decode_outcomes(outcomes),
+            decode_alignments(alignments),
+        )
 
 
-    # get outcome result rollups for each course and list of outcomes
-    pattern = "@dtech|Teacher Assistant|LAB Day|FIT|Innovation Diploma FIT"
-    count = 0
-    for idx, course in enumerate(courses):
-        print(course["id"])
-        print(f'{course["name"]} is course {idx + 1} our of {len(courses)}')
-
-        # Check if it's a non-graded course
-        if re.match(pattern, course["name"]):
-            print(course["name"])
-            continue
+class CourseResultWriter(object):
+    """
+    Incrementally syncs one course's outcome results page by page. Each course keeps a
+    high-water mark (newest submitted_or_assessed_at) and the result ids present after the
+    last sync. Only results that are new or were (re)assessed after the high-water mark are
+    upserted, and only results that disappeared from Canvas are deleted. All writes for
+    the course happen inside a single transaction, so a course that fails halfway through
+    keeps its previous results.
+
+    The course's results are also digested as they arrive. When the digest matches the
+    one stored by the last sync, Canvas has nothing new for the course and nothing is
+    written, so its students aren't regraded either. Changed rows are held back (up to
+    DIGEST_BUFFER_ROWS) until the digest is known, so an unchanged course usually
+    doesn't touch the database at all. When it doesn't match, the stored digest with the
+    written and removed rows swapped in should give the new one. If it doesn't, Canvas
+    changed a result without reassessing it, so the high-water mark and digest are
+    cleared and the next sync rewrites the whole course.
+
+    In staged mode the writes go to the shadow tables instead and are published for the
+    whole term at once by publish_staged_outcome_results.
+    """
 
-        # get course users
-        users = get_course_users(course)
-        user_ids = [user["id"] for user in users]
+    def __init__(self, course, engine, staged=False, term_id=None, metadata_cache=None):
+        self.course = course
+        self.engine = engine
+        self.metadata_cache = metadata_cache
+        self.staged = staged
+        self.term_id = term_id
+        self.conn = None
+        self.trans = None
+        self.changed_count = 0
+        self.removed_count = 0
+        self.unchanged = False
+        self.failed = False
+        self.started_at = time.perf_counter()
+
+        state = get_course_sync_state(course["id"], engine)
+        if state is None:
+            # Never synced incrementally, treat every stored result as stale
+            self.high_water_mark = None
+            self.known_results = set(get_course_result_ids(course["id"], engine))
+            self.results_digest = None
+        else:
+            self.high_water_mark = state["high_water_mark"]
+            self.known_results = set(state["result_ids"] or [])
+            self.results_digest = state["results_digest"]
+        self.new_high_water_mark = self.high_water_mark
+        self.has_state = state is not None
+        self.digest_total = 0
+        # Rows written over the stored ones, to check the digest against
+        self.written_count = 0
+        self.written_total = 0
+        self.replaced_ids = []
+        # Changed rows waiting for the digest, only worth holding when it could match
+        self.pending = []
+        self.pending_rows = 0
+        self.hold_writes = self.results_digest is not None
+
+        # ids already written, the linked outcomes/alignments repeat on every page and a
+        # duplicate result sometimes shows up
+        self.seen_results = set()
+        self.seen_outcomes = set()
+        self.seen_alignments = set()
+
+    def _begin(self):
+        if self.conn is None:
+            self.conn = self.engine.connect()
+            self.trans = self.conn.begin()
+
+    def _changed(self, outcome_results):
+        assessed_at = outcome_results["submitted_or_assessed_at"]
+        assessed = assessed_at[~np.isnat(assessed_at)]
+        if len(assessed):
+            newest = assessed.max().item()
+            if self.new_high_water_mark is None or newest > self.new_high_water_mark:
+                self.new_high_water_mark = newest
+
+        if self.high_water_mark is None:
+            return outcome_results
+        known = np.array(
+            [_id in self.known_results for _id in outcome_results["id"].tolist()],
+            dtype=bool,
+        )
+        changed = (
+            ~known
+            | np.isnat(assessed_at)
+            | (assessed_at > np.datetime64(self.high_water_mark, "us"))
+        )
+        return _take(outcome_results, changed)
+
+    def write_page(self, outcome_results, outcomes, alignments):
+        outcome_results = _dedup(outcome_results, self.seen_results)
+        if not page_length(outcome_results):
+            return
+
+        # Outcomes and alignments are shared between courses, so they're committed right
+        # away rather than holding row locks inside the course transaction
+        outcomes = _dedup(outcomes, self.seen_outcomes)
+        alignments = _dedup(alignments, self.seen_alignments)
+        if self.metadata_cache is not None:
+            # Only the outcomes and alignments that changed in Canvas
+            self.metadata_cache.write_changed(Outcomes, outcomes)
+            self.metadata_cache.write_changed(Alignments, alignments)
+        else:
+            if page_length(outcomes):
+                upsert_outcomes(outcomes, self.engine)
+            if page_length(alignments):
+                upsert_alignments(alignments, self.engine)
+
+        self.digest_total += int(row_hashes(outcome_results, DIGEST_RESULT_COLS).sum())
+        changed = self._changed(outcome_results)
+        if page_length(changed):
+            self.changed_count += page_length(changed)
+            if self.hold_writes:
+                self.pending.append(changed)
+                self.pending_rows += page_length(changed)
+                if self.pending_rows <= DIGEST_BUFFER_ROWS:
+                    return
+                # Too much to hold, this course has clearly changed
+                self.hold_writes = False
+            self._flush_pending()
+            self._write_changed(changed)
+
+    def _write_changed(self, changed):
+        self.written_count += page_length(changed)
+        self.written_total += int(row_hashes(changed, DIGEST_RESULT_COLS).sum())
+        self.replaced_ids.extend(
+            _id for _id in changed["id"].tolist() if _id in self.known_results
+        )
+        self._begin()
+        if self.staged:
+            stage_outcome_results(changed, self.term_id, self.conn)
+        else:
+            upsert_outcome_result_columns(changed, self.conn)
+            mark_dirty_pairs(
+                zip(changed["user_id"].tolist(), changed["course_id"].tolist()),
+                self.conn,
+            )
+
+    def _flush_pending(self):
+        pending, self.pending, self.pending_rows = self.pending, [], 0
+        for changed in pending:
+            self._write_changed(changed)
+
+    def digest(self):
+        return format_digest(len(self.seen_results), self.digest_total)
+
+    def commit(self):
+        # Canvas returned nothing, leave the course alone rather than wiping it
+        if not self.seen_results:
+            return
+
+        digest = self.digest()
+        removed = self.known_results - self.seen_results
+        if digest == self.results_digest and not removed:
+            # Exactly what the last sync stored, nothing to write or regrade
+            self.unchanged = True
+            self.changed_count = 0
+            self.rollback()
+            print(f"outcome results: {len(self.seen_results)} unchanged, skipped")
+            return
+        self._flush_pending()
+
+        if (
+            self.results_digest is not None
+            and self.changed_count < len(self.seen_results)
+            and not self._only_written_changed(digest, removed)
+        ):
+            # Canvas changed a result without moving its assessment time past the
+            # high-water mark, which storing the new digest would hide for good.
+            # Clearing the mark and the digest rewrites the course next sync.
+            print(f'Course {self.course["id"]} changed in place, rewriting it next sync')
+            self.new_high_water_mark = None
+            digest = None
+
+        if removed:
+            self._begin()
+            if self.staged:
+                stage_outcome_result_deletes(list(removed), self.term_id, self.conn)
+            else:
+                mark_result_pairs_dirty(list(removed), self.conn)
+                delete_outcome_results_by_id(list(removed), self.conn)
+            self.removed_count = len(removed)
+
+        state_changed = (
+            not self.has_state
+            or self.conn is not None
+            or self.new_high_water_mark != self.high_water_mark
+            or digest != self.results_digest
+        )
+        if state_changed:
+            self._begin()
+            state = dict(
+                course_id=self.course["id"],
+                high_water_mark=self.new_high_water_mark,
+                result_ids=sorted(self.seen_results),
+                synced_at=datetime.utcnow(),
+                results_digest=digest,
+            )
+            if self.staged:
+                stage_course_sync_state(state, self.term_id, self.conn)
+            else:
+                upsert_course_sync_state(state, self.conn)
+
+        if self.conn is not None:
+            self.trans.commit()
+            self.conn.close()
+            self.conn = None
+        print(
+            f"outcome results: {self.changed_count} new or changed, "
+            f"{self.removed_count} removed, "
+            f"{len(self.seen_results) - self.changed_count} unchanged"
+        )
 
-        outcome_results, alignments, outcomes = get_outcome_results(
-            course, user_ids=user_ids
+    def _only_written_changed(self, digest, removed):
+        """
+        :param digest: the course's new digest
+        :param removed: ids of the stored results Canvas no longer has
+        :return: True if the stored digest, with the rows this sync wrote over or removed
+            swapped for the written ones, is the new digest
+        """
+        # Read outside the course transaction, so these are the rows as the last sync
+        # left them
+        stored = get_outcome_results_by_id(self.replaced_ids + list(removed), self.engine)
+        old_hashes = row_hashes(
+            stored_result_columns(list(stored.values())), DIGEST_RESULT_COLS
         )
+        expected = replace_in_digest(
+            self.results_digest,
+            len(old_hashes),
+            int(old_hashes.sum()),
+            self.written_count,
+            self.written_total,
+        )
+        return expected == digest
 
-        # Format results, Removed Null filter (works better for upsert)
-        res_temp = [
-            make_outcome_result(outcome_result, course["id"], current_term_id)
-            for outcome_result in outcome_results
-        ]
+    def rollback(self):
+        self.pending, self.pending_rows = [], 0
+        if self.conn is not None:
+            self.trans.rollback()
+            self.conn.close()
+            self.conn = None
 
-        # filter out any duplicates (this shouldn't be an issue but a duplicate sometimes shown up)
-        done = []
-        outcome_results = []
-        for res in res_temp:
-            if res['id'] not in done:
-                done.append(res['id'])
-                outcome_results.append(res)
-
-        # outcome_results = [i for n, i in enumerate(outcome_results) if i not in outcome_results[n + 1:]]
-
-        # Format outcomes
-        outcomes = [format_outcome(outcome) for outcome in outcomes]
-        # Filter out duplicate outcomes
-        outcomes = [
-            val for idx, val in enumerate(outcomes) if val not in outcomes[idx + 1 :]
-        ]
+    def fail(self, error):
+        print(f'Error syncing outcome results for course {self.course["id"]}: {error}')
+        self.failed = True
+        self.rollback()
 
-        # format Alignments
-        alignments = [format_alignments(alignment) for alignment in alignments]
-        # filter out duplicate alignments
-        alignments = [
-            val
-            for idx, val in enumerate(alignments)
-            if val not in alignments[idx + 1 :]
-        ]
 
-        # If there are results to upload
-        if outcome_results:
-            upsert_outcomes(outcomes, engine)
-            print("outcome upsert complete")
-            upsert_alignments(alignments, engine)
-            print("alignment upsert complete")
+def _take(columns, mask):
+    return {col: values[mask] for col, values in columns.items()}
 
-            print(f'deleting outcome_results for {course["name"]}')
-            delete_outcome_results(course["id"], engine)
-            print("old outcome results deleted")
 
-            print(f"outcomes results to upload: {len(outcome_results)}")
-            upsert_outcome_results(outcome_results, engine)
-            print("result upsert complete")
+def _dedup(columns, seen):
+    """
+    Drops rows whose id has already been seen and records the new ids
+    :param columns: dictionary of column arrays with an "id" column
+    :param seen: set of ids already written
+    :return: column dictionary of the unseen rows
+    """
+    keep = np.zeros(page_length(columns), dtype=bool)
+    for i, _id in enumerate(columns["id"].tolist()):
+        if _id not in seen:
+            seen.add(_id)
+            keep[i] = True
+    if keep.all():
+        return columns
+    return _take(columns, keep)
 
-        # count = count + 1
-        # if count > 1:
-        #     break
 
+# Columns that make up a course's roster digest
+DIGEST_ROSTER_COLS = ["user_id", "section_id", "section_name"]
+# Changed outcome results held back per course until its digest is known
+DIGEST_BUFFER_ROWS = 5000
 
-def insert_grades(current_term, engine):
-    print(f"Grade pull started at {datetime.now()}")
-    calculation_dictionaries = get_calculation_dictionaries(engine)
 
-    # check if the cut off date has been set
-    if current_term["cut_off_date"]:
-        cut_off_date = current_term["cut_off_date"]
-    # if not, set it to the last day of the term
-    else:
-        cut_off_date = current_term["end_at"]
+def roster_digest(roster):
+    """
+    :param roster: dictionary of user id to (section_id, section_name) from
+        parse_course_roster
+    :return: digest of the roster's students and sections
+    """
+    sections = list(roster.values())
+    columns = {
+        "user_id": np.array(list(roster.keys()), dtype="int64"),
+        "section_id": np.array([section[0] for section in sections], dtype="int64"),
+        "section_name": np.array([section[1] for section in sections], dtype=object),
+    }
+    hashes = row_hashes(columns, DIGEST_ROSTER_COLS)
+    return format_digest(len(hashes), int(hashes.sum()))
 
-    outcome_results = query_current_outcome_results(current_term["id"], engine)
 
-    # Check if there are any outcome results in the current_term. If not exit.
-    if outcome_results.empty:
-        print(f"Term {current_term['id']} has no outcome results.")
-        return None
+def _queue_put(page_queue, item, stop):
+    # Block while the queue is full, but give up if the consumer has stopped
+    while not stop.is_set():
+        try:
+            page_queue.put(item, timeout=1)
+            return True
+        except queue.Full:
+            continue
+    return False
 
-    drop_eligible_results = outcome_results.loc[
-        outcome_results["submitted_or_assessed_at"] < cut_off_date
-    ]
 
-    # get min score from drop_eligible_results
-    group_cols = ["links.user", "course_id", "outcome_id"]
-    min_score = (
-        drop_eligible_results.groupby(group_cols)
-        .agg(min_score=("score", "min"))
-        .reset_index()
-    )
-    full_avg = (
-        outcome_results.groupby(group_cols)
-        .agg(full_avg=("score", "mean"), count=("score", "count"), sum=("score", "sum"))
-        .reset_index()
-    )
-    outcome_avgs = pd.merge(min_score, full_avg, on=group_cols)
-    outcome_avgs["drop_avg"] = (outcome_avgs["sum"] - outcome_avgs["min_score"]) / (
-        outcome_avgs["count"] - 1
+def _produce_course_pages(course, current_term_id, page_queue, stop, metadata_cache):
+    error = None
+    try:
+        pages = stream_course_outcome_results(course, current_term_id, metadata_cache)
+        for page in pages:
+            if not _queue_put(page_queue, (course, page, None), stop):
+                return
+    except Exception as e:
+        error = e
+    _queue_put(page_queue, (course, None, error), stop)
+
+
+def filter_graded_courses(courses):
+    """
+    Filters out the non-graded courses
+    :param courses: list of course dictionaries
+    :return: list of graded course dictionaries
+    """
+    graded_courses = []
+    for course in courses:
+        if re.match(NON_GRADED_PATTERN, course["name"]):
+            print(course["name"])
+            continue
+        graded_courses.append(course)
+    return graded_courses
+
+
+def sync_course_outcome_results(
+    course, current_term_id, engine, staged=False, sync_started_at=None
+):
+    """
+    Pulls and writes a single course's outcome results, for running a course on its own
+    (e.g. one rq job per course)
+    :param course: course dictionary
+    :param current_term_id: enrollment term id
+    :param engine: SQLAlchemy engine
+    :param staged: load into the shadow tables, publish_staged_outcome_results publishes
+    :param sync_started_at: when the sync run started, outcomes compared with Canvas
+        since then (e.g. by another course job) aren't asked for again
+    :return: (True if the course synced, number of outcome results received, True if
+        they matched the last sync and nothing was written)
+    """
+    metadata_cache = MetadataCache(engine, started_at=sync_started_at)
+    writer = CourseResultWriter(
+        course,
+        engine,
+        staged=staged,
+        term_id=current_term_id,
+        metadata_cache=metadata_cache,
     )
+    try:
+        for page in stream_course_outcome_results(
+            course, current_term_id, metadata_cache
+        ):
+            writer.write_page(*page)
+        writer.commit()
+    except Exception as e:
+        writer.fail(e)
+    return not writer.failed, len(writer.seen_results), writer.unchanged
+
+
+def pull_outcome_results(
+    current_term, engine, workers=1, staged=False, sync_run_id=None, progress=None
+):
+    """
+    Pulls outcome results for every course in the term. Canvas pages are fetched on a pool
+    of `workers` threads and handed through a bounded queue to the calling thread, which
+    writes each page as it arrives. Peak memory depends on the page size, not the course size.
+    :param current_term: term dictionary
+    :param engine: SQLAlchemy engine
+    :param workers: number of courses fetched from Canvas at once
+    :param staged: load into the shadow tables and publish the term in one transaction
+    :param sync_run_id: checkpoint finished courses under this sync run and skip the
+        ones it already finished
+    :param progress: optional progress reporter, told how many courses will sync
+        (add_courses) and about each finished course (course_done)
+    :return: list of course ids that failed to sync
+    """
+    # get all courses for current term todo - pull from database
+    current_term_id = current_term["id"]
+    courses = get_courses(current_term_id)
+    graded_courses = filter_graded_courses(courses)
+
+    finished = set()
+    sync_started_at = None
+    if sync_run_id:
+        sync_started_at = get_sync_run_started_at(sync_run_id, engine)
+        finished = get_sync_checkpoints(sync_run_id, "course", engine)
+        resumed = [c for c in graded_courses if str(c["id"]) in finished]
+        if resumed:
+            print(f"Resuming sync run {sync_run_id}, {len(resumed)} courses already synced")
+        graded_courses = [c for c in graded_courses if str(c["id"]) not in finished]
+
+    if staged and not finished:
+        # Throw away anything left over from an interrupted staged sync, a resumed run
+        # keeps what its finished courses staged
+        clear_staged_outcome_results(current_term_id, engine)
+
+    if progress is not None:
+        progress.add_courses(len(graded_courses))
 
-    # Pick the higher average
-    outcome_avgs["outcome_avg"] = np.where(
-        outcome_avgs["drop_avg"] > outcome_avgs["full_avg"],
-        outcome_avgs["drop_avg"],
-        outcome_avgs["full_avg"],
+    # get outcome result rollups for each course and list of outcomes
+    failed = []
+    writers = {}
+    done_count = 0
+    unchanged_count = 0
+    page_queue = queue.Queue(maxsize=workers * 2)
+    stop = threading.Event()
+    metadata_cache = MetadataCache(engine, started_at=sync_started_at)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for course in graded_courses:
+            executor.submit(
+                _produce_course_pages,
+                course,
+                current_term_id,
+                page_queue,
+                stop,
+                metadata_cache,
+            )
+
+        try:
+            while done_count < len(graded_courses):
+                course, page, error = page_queue.get()
+                writer = writers.get(course["id"])
+                if writer is None:
+                    writer = writers[course["id"]] = CourseResultWriter(
+                        course,
+                        engine,
+                        staged=staged,
+                        term_id=current_term_id,
+                        metadata_cache=metadata_cache,
+                    )
+
+                # Write pages as they arrive
+                if page is not None:
+                    if not writer.failed:
+                        try:
+                            writer.write_page(*page)
+                        except Exception as e:
+                            writer.fail(e)
+                    continue
+
+                # The course has finished downloading
+                if error is not None:
+                    writer.fail(error)
+                elif not writer.failed:
+                    try:
+                        writer.commit()
+                    except Exception as e:
+                        writer.fail(e)
+
+                # Don't let one bad course stop the rest of the term
+                if writer.failed:
+                    failed.append(course["id"])
+                elif sync_run_id:
+                    add_sync_checkpoint(sync_run_id, "course", engine, course["id"])
+                unchanged_count += writer.unchanged
+                if progress is not None:
+                    progress.course_done(
+                        course["id"],
+                        not writer.failed,
+                        len(writer.seen_results),
+                        seconds=time.perf_counter() - writer.started_at,
+                        rows_written=writer.changed_count + writer.removed_count,
+                        skipped=int(writer.unchanged),
+                    )
+                writers.pop(course["id"])
+                done_count += 1
+                print(course["id"])
+                print(f'{course["name"]} is course {done_count} our of {len(graded_courses)}')
+        finally:
+            stop.set()
+            for writer in writers.values():
+                writer.rollback()
+
+    print(
+        f"{unchanged_count} of {len(graded_courses)} courses unchanged since the last sync"
     )
+    if staged:
+        publish_staged_outcome_results(current_term_id, engine)
+        print(f"staged outcome results published for term {current_term_id}")
 
-    # calculate the grades
-    group_cols = ["links.user", "course_id"]
-    grades = outcome_avgs.groupby(group_cols).agg(
-        grade_dict=(
-            "outcome_avg",
-            lambda x: calculate_traditional_grade(x, calculation_dictionaries),
-        )
+    if failed:
+        print(f"Outcome results failed for courses: {failed}")
+    return failed
+
+
+def get_term_outcome_calculations(current_term, engine):
+    # The default drop lowest rule doesn't use the outcomes' settings
+    if grade_calculation_method(current_term) == DROP_LOWEST:
+        return None
+    return get_outcome_calculations(engine)
+
+
+def calculate_course_grades(
+    course_results,
+    current_term,
+    calculation_dictionaries,
+    workers=None,
+    outcome_calculations=None,
+):
+    """
+    Grades a term in shards of whole courses, only a few shards of outcome results are
+    held at once
+    :param course_results: iterable of (course_id, DataFrame) from
+        iter_course_outcome_results
+    :param current_term: term dictionary, for the cut off date and calculation method
+    :param calculation_dictionaries: grade cutoffs ordered by grade_rank
+    :param workers: grade shards in this many processes, defaults to GRADE_WORKERS
+    :param outcome_calculations: DataFrame from get_term_outcome_calculations
+    :return: DataFrame of grades or None if there were no outcome results
+    """
+    if workers is None:
+        workers = GRADE_WORKERS
+    return sharded_course_grades(
+        course_results,
+        current_term,
+        calculation_dictionaries,
+        workers=workers,
+        outcome_calculations=outcome_calculations,
     )
-    grades.reset_index(inplace=True)
 
-    # format the grades
-    grades[["threshold", "min_score", "grade"]] = pd.DataFrame(
-        grades["grade_dict"].values.tolist(), index=grades.index
+
+def insert_grades(current_term, engine, full=False):
+    """
+    Updates the term's grades. Only the (user, course) pairs whose outcome results
+    changed since their grades were calculated are regraded, unless full is set or the
+    term has no grades yet.
+    :param current_term: term dictionary
+    :param engine: SQLAlchemy engine
+    :param full: recalculate every grade in the term (e.g. the grade cutoffs changed)
+    :return: None
+    """
+    print(f"Grade pull started at {datetime.now()}")
+    if not full and has_term_grades(current_term["id"], engine):
+        marks = get_term_dirty_marks(current_term["id"], engine)
+        if not marks:
+            # Nothing changed, a new record still shows when the data was checked
+            print(f"Term {current_term['id']} has no changed grades.")
+            create_record(current_term["id"], engine)
+            return None
+        regrade_pairs([(user_id, course_id) for user_id, course_id, _ in marks], engine)
+        return None
+
+    calculation_dictionaries = get_calculation_dictionaries(engine)
+    outcome_calculations = get_term_outcome_calculations(current_term, engine)
+
+    # Read the marks first, anything marked after this is left for the next regrade
+    marks = get_term_dirty_marks(current_term["id"], engine)
+    grades = calculate_course_grades(
+        iter_course_outcome_results(current_term["id"], engine),
+        current_term,
+        calculation_dictionaries,
+        outcome_calculations=outcome_calculations,
     )
 
-    # Make a new record
-    print(f"Record created at {datetime.now()}")
-    record_id = create_record(current_term["id"], engine)
-    grades["record_id"] = record_id
-
-    # Create grades_dict for database insert
-    grades.rename(columns={"links.user": "user_id"}, inplace=True)
-    grade_cols = [
-        "course_id",
-        "user_id",
-        "threshold",
-        "min_score",
-        "grade",
-        "record_id",
-    ]
-    grades_list = grades[grade_cols].to_dict("r")
+    # Check if there are any outcome results in the current_term. If not exit.
+    if grades is None:
+        print(f"Term {current_term['id']} has no outcome results.")
+        return None
+
+    # Swap the term's grades in one transaction so dashboards never see an empty term.
+    # The record is created in the same transaction, so a dashboard never sees the new
+    # record id (its cache key) before the grades it belongs to.
+    with engine.begin() as conn:
+        print(f"Record created at {datetime.now()}")
+        grades["record_id"] = create_record(current_term["id"], conn)
+        grades_list = grade_rows(grades)
+
+        delete_grades_current_term(current_term["id"], conn)
+        if len(grades_list):
+            insert_grades_to_db(grades_list, conn)
+        clear_dirty_marks(marks, conn)
 
-    # Delete grades from current term
-    delete_grades_current_term(current_term["id"], engine)
 
-    # Insert into Database
-    if len(grades_list):
-        insert_grades_to_db(grades_list, engine)
+def regrade_pairs(pairs, engine):
+    """
+    Recalculates the grades of just the given students' courses, replacing their grade
+    rows, and clears their dirty marks. A pair left without graded results loses its
+    grade, like in insert_grades.
+    :param pairs: iterable of (user_id, course_id) tuples
+    :param engine: SQLAlchemy engine
+    :return: number of grades written
+    """
+    pairs = set(pairs)
+    if not pairs:
+        return 0
+    courses = get_courses_by_id([course_id for _, course_id in pairs], engine)
+    term_ids = {course["enrollment_term_id"] for course in courses.values()}
+    terms = get_terms(engine, list(term_ids))
+    calculation_dictionaries = get_calculation_dictionaries(engine)
+
+    written = 0
+    for term in terms:
+        term_pairs = [
+            (user_id, course_id)
+            for user_id, course_id in pairs
+            if course_id in courses
+            and courses[course_id]["enrollment_term_id"] == term["id"]
+        ]
+        marks = get_pair_dirty_marks(term_pairs, engine)
+        grades = calculate_course_grades(
+            iter_course_outcome_results(term["id"], engine, pairs=term_pairs),
+            term,
+            calculation_dictionaries,
+            outcome_calculations=get_term_outcome_calculations(term, engine),
+        )
+
+        with engine.begin() as conn:
+            record_id = create_record(term["id"], conn)
+            grades_list = []
+            if grades is not None:
+                grades["record_id"] = record_id
+                grades_list = grade_rows(grades)
+
+            delete_pair_grades(term_pairs, conn)
+            if grades_list:
+                insert_grades_to_db(grades_list, conn)
+            clear_dirty_marks(marks, conn)
+        written += len(grades_list)
+        print(f"{len(term_pairs)} students regraded for term {term['id']}")
+    return written
 
 
 def calc_outcome_avgs(outcome_results):
@@ -377,54 +986,140 @@ def format_outcome_results(outcome_results):
     return outcome_results
 
 
-def update_course_students(current_term, engine):
+def parse_course_roster(sections):
+    """
+    :param sections: section dictionaries from get_sections
+    :return: dictionary of the active students' user ids to (section_id, section_name).
+        A student in more than one section keeps the last.
+    """
+    roster = {}
+    for section in sections:
+        section_id = section["id"]
+        section_name = section["name"]
+        if not section["students"]:
+            print(f"Section {section_id} has no students...skipping")
+            continue
+        for student in section["students"]:
+            # Check if the enrollment is active:
+            if student["enrollments"][0]["enrollment_state"] == "active":
+                roster[student["id"]] = (section_id, section_name)
+    return roster
+
+
+def _fetch_course_roster(course_id):
+    try:
+        return parse_course_roster(get_sections(course_id))
+    except Exception as e:
+        print(e)
+        print(f"Error getting course students for course_id {course_id}")
+        return None
+
+
+def _write_roster_batch(rosters, engine, counts):
+    # Courses without active students keep their previous roster
+    rosters = {course_id: roster for course_id, roster in rosters.items() if roster}
+    digests = {course_id: roster_digest(roster) for course_id, roster in rosters.items()}
+    stored_digests = get_course_roster_digests(list(digests), engine)
+    changed = [
+        course_id
+        for course_id, digest in digests.items()
+        if digest != stored_digests.get(course_id)
+    ]
+    counts["unchanged"] += len(digests) - len(changed)
+    if not changed:
+        return
+
+    stored = get_course_students(changed, engine)
+    current = {
+        (course_id, user_id): section
+        for course_id in changed
+        for user_id, section in rosters[course_id].items()
+    }
+    deletes = [(user_id, course_id) for course_id, user_id in stored.keys() - current]
+    upserts = [key for key, section in current.items() if stored.get(key) != section]
+    with engine.begin() as conn:
+        delete_course_student_pairs(deletes, conn)
+        if upserts:
+            course_ids, user_ids = zip(*upserts)
+            sections = [current[key] for key in upserts]
+            upsert_course_students(
+                {
+                    "course_id": np.array(course_ids, dtype="int64"),
+                    "user_id": np.array(user_ids, dtype="int64"),
+                    "section_id": np.array([s[0] for s in sections], dtype="int64"),
+                    "section_name": np.array([s[1] for s in sections], dtype=object),
+                },
+                conn,
+            )
+        set_course_roster_digests(
+            {course_id: digests[course_id] for course_id in changed}, conn
+        )
+    counts["deleted"] += len(deletes)
+    counts["inserted"] += sum(key not in stored for key in upserts)
+    counts["moved"] += sum(key in stored for key in upserts)
+
+
+def sync_course_rosters(course_ids, engine, workers=None):
+    """
+    Brings course_user_link up to date with the active students in the courses' Canvas
+    sections. Rosters are fetched `workers` courses at a time and compared with the
+    stored ones in batches of ROSTER_BATCH_COURSES courses. Only the students who joined,
+    left or changed section are written, in one transaction per batch. Courses whose
+    roster digest matches the last sync aren't compared at all.
+    :param course_ids: course ids
+    :param engine: SQLAlchemy engine
+    :param workers: number of courses fetched from Canvas at once, defaults to
+        ROSTER_WORKERS
+    :return: dictionary of counts
+    """
+    workers = workers or ROSTER_WORKERS
+    counts = dict(
+        courses=len(course_ids), unchanged=0, failed=0, inserted=0, moved=0, deleted=0
+    )
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # Later courses keep downloading while a batch is written
+        fetched = zip(course_ids, executor.map(_fetch_course_roster, course_ids))
+        batch = {}
+        for course_id, roster in fetched:
+            if roster is None:
+                counts["failed"] += 1
+                continue
+            batch[course_id] = roster
+            if len(batch) >= ROSTER_BATCH_COURSES:
+                _write_roster_batch(batch, engine, counts)
+                batch = {}
+        if batch:
+            _write_roster_batch(batch, engine, counts)
+    print(f"rosters: {counts}")
+    return counts
+
+
+def update_course_roster(course_id, engine):
+    """
+    Syncs one course's roster with the active students in its Canvas sections
+    :param course_id: course id
+    :param engine: SQLAlchemy engine
+    :return: True if the roster was unchanged and left alone
+    """
+    return sync_course_rosters([course_id], engine, workers=1)["unchanged"] == 1
+
+
+def update_course_students(current_term, engine, workers=None):
     current_term_id = current_term["id"]
     # Query current courses
     courses = get_db_courses(engine, current_term_id)
-    pattern = "@dtech|Teacher Assistant|LAB Day|FIT|Innovation Diploma FIT|Beyond D.Tech"
 
+    course_ids = []
     for course in courses:
         course_id = course[0]
         course_name = course[1]
         # Filter out non-academic courses
-        if re.match(pattern, course_name):
+        if re.match(NON_ACADEMIC_PATTERN, course_name):
             print(course_name)
             continue
+        course_ids.append(course_id)
 
-        # Get course sections + students
-        sections = get_sections(course_id)
-
-        try:
-            student_dicts = []
-            # parse sections
-            for section in sections:
-                section_id = section["id"]
-                section_name = section["name"]
-                if not section["students"]:
-                    print(f"Section {section_id} has no students...skipping")
-                    continue
-                for student in section["students"]:
-                    # Check if the enrollment is active:
-                    if student["enrollments"][0]["enrollment_state"] == "active":
-                        _temp = {
-                            "user_id": student["id"],
-                            "course_id": course_id,
-                            "section_id": section_id,
-                            "section_name": section_name
-                        }
-                        student_dicts.append(_temp)
-        except Exception as e:
-            print(e)
-            print(f"Error parsing course students for course_id {course_id}")
-            continue  #TODO: Probably remove this...
-
-        if student_dicts:
-            # delete previous course roster
-            delete_course_students(course_id, engine)
-            # insert current roster
-            insert_course_students(student_dicts, engine)
-
-
+    sync_course_rosters(course_ids, engine, workers=workers)
 
 
 def update_courses(current_term, engine):
@@ -434,15 +1129,37 @@ def update_courses(current_term, engine):
         upsert_courses(courses, engine)
     else:
         print(f"Term {current_term['id']} has no courses to sync")
+    return courses
 
 
 def update_users(engine):
     """
-    Updates users table in database with all current account users
-    :return: None
+    Updates users table in database with all current account users. Each user's content
+    hash is compared with the stored one and only new or changed users are written.
+    :return: dictionary of counts
     """
-    users = get_users()
-    upsert_users(users, engine)
+    users = _dedup(decode_users(get_users()), set())
+    hashes = np.array(content_hashes(users), dtype=object)
+    stored = get_user_hashes(engine)
+
+    ids = users["id"].tolist()
+    changed = np.array(
+        [stored.get(_id) != content_hash for _id, content_hash in zip(ids, hashes)],
+        dtype=bool,
+    )
+    rows = _take(users, changed)
+    rows["content_hash"] = hashes[changed]
+    written = upsert_users(rows, engine)
+
+    inserted = sum(_id not in stored for _id in ids)
+    counts = dict(
+        users=len(ids),
+        inserted=inserted,
+        updated=written - inserted,
+        unchanged=len(ids) - written,
+    )
+    print(f"users: {counts}")
+    return counts
 
 
 def update_terms(engine):
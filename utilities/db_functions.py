@@ -1,14 +1,22 @@
+import io
+import json
 import os
+import threading
+import uuid
 from datetime import datetime
 
+import numpy as np
 import pandas as pd
 from sqlalchemy import create_engine, desc
+from sqlalchemy.engine import Connection
 from sqlalchemy.dialects import postgresql
 from sqlalchemy.orm import Session
-from sqlalchemy.sql import select
+from sqlalchemy.sql import select, text
 from sqlalchemy.sql.expression import bindparam
 
+from app.cache import invalidate_dashboards
 from app.config import configuration
+from utilities.cbl_calculator import DROP_LOWEST
 from utilities.db_models import (
     Outcomes,
     OutcomeResults,
@@ -21,39 +29,234 @@ from utilities.db_models import (
     EnrollmentTerms,
     GradeCalculation,
     CanvasApiToken,
+    CourseSyncState,
+    OutcomeResultsStaging,
+    CourseSyncStateStaging,
+    SyncCheckpoints,
+    SyncRuns,
+    SyncRunStages,
 )
 
+# Rows inserted, updated or deleted by this process, read by the sync ledger
+_rows_lock = threading.Lock()
+_rows_written = 0
+
+
+def count_rows_written(rowcount):
+    global _rows_written
+    if rowcount and rowcount > 0:
+        with _rows_lock:
+            _rows_written += rowcount
+
+
+def get_rows_written():
+    with _rows_lock:
+        return _rows_written
+
+
 def execute_stmt(engine, update_stmt):
     session = Session(engine)
     res = session.execute(update_stmt)
+    # Counts every write that doesn't return rows, Core statements and text() alike,
+    # so callers don't count them again
+    if not res.returns_rows:
+        count_rows_written(res.rowcount)
     session.commit()
     session.close()
 
     return res
 
 
+####################################
+# Bulk Loading
+####################################
+# Above this many rows, loads go through COPY instead of a multi-row INSERT statement
+BULK_LOAD_THRESHOLD = 1000
+COPY_CHUNK_SIZE = 50000
+
+
+def _copy_value(value):
+    """
+    Formats a value for COPY's text format
+    :param value: python value
+    :return: escaped string, \\N for NULL
+    """
+    # Missing values load as NULL, not the text nan or NaT
+    if value is None or (pd.api.types.is_scalar(value) and pd.isna(value)):
+        return "\\N"
+    if isinstance(value, (dict, list)):
+        value = json.dumps(value)
+    return (
+        str(value)
+        .replace("\\", "\\\\")
+        .replace("\t", "\\t")
+        .replace("\n", "\\n")
+        .replace("\r", "\\r")
+    )
+
+
+def _copy_chunk(cursor, staging_table, columns, rows):
+    buffer = io.StringIO()
+    for row in rows:
+        buffer.write("\t".join(_copy_value(row.get(col)) for col in columns))
+        buffer.write("\n")
+    buffer.seek(0)
+    cursor.copy_expert(f"COPY {staging_table} ({', '.join(columns)}) FROM STDIN", buffer)
+
+
+def _column_values(values):
+    # psycopg2 sends python lists as arrays, NaN and NaT go as NULL
+    values = np.asarray(values)
+    if values.dtype.kind == "f":
+        return np.where(np.isnan(values), None, values.astype(object)).tolist()
+    if values.dtype.kind == "M":
+        # Microseconds convert to datetime objects, NaT to None
+        return values.astype("datetime64[us]").astype(object).tolist()
+    return values.tolist()
+
+
+def upsert_columns(
+    table, columns, engine, index_elements, update_cols=None, only_changed=False
+):
+    """
+    Upserts column arrays with a single INSERT ... SELECT FROM unnest(...), one array
+    parameter per column, so no row is ever built as a dictionary
+    :param table: SQLAlchemy Table to load into
+    :param columns: dictionary of equal length column arrays
+    :param engine: SQLAlchemy engine or connection
+    :param index_elements: conflict columns
+    :param update_cols: columns updated on conflict, defaults to every non-conflict column
+    :param only_changed: leave stored rows whose update columns already match alone,
+        so they aren't rewritten (no dead tuples)
+    :return: number of rows inserted or updated
+    """
+    names = list(columns.keys())
+    if not names or not len(columns[names[0]]):
+        return 0
+
+    dialect = postgresql.dialect()
+    arrays = ", ".join(
+        f"CAST(:{name} AS {table.c[name].type.compile(dialect=dialect)}[])"
+        for name in names
+    )
+    col_list = ", ".join(names)
+    conflict_list = ", ".join(index_elements)
+    if update_cols is None:
+        update_cols = [name for name in names if name not in index_elements]
+    # DISTINCT ON guards against the same key showing up twice in one load
+    sql = (
+        f"INSERT INTO {table.name} ({col_list}) "
+        f"SELECT DISTINCT ON ({conflict_list}) {col_list} "
+        f"FROM unnest({arrays}) AS u({col_list}) "
+        f"ON CONFLICT ({conflict_list}) "
+    )
+    if update_cols:
+        sql += "DO UPDATE SET " + ", ".join(
+            f"{col} = EXCLUDED.{col}" for col in update_cols
+        )
+        if only_changed:
+            stored = ", ".join(f"{table.name}.{col}" for col in update_cols)
+            excluded = ", ".join(f"EXCLUDED.{col}" for col in update_cols)
+            sql += f" WHERE ({stored}) IS DISTINCT FROM ({excluded})"
+    else:
+        sql += "DO NOTHING"
+
+    params = {name: _column_values(columns[name]) for name in names}
+    return execute_stmt(engine, text(sql).bindparams(**params)).rowcount
+
+
+def copy_upsert(table, rows, engine, index_elements=None, update_cols=None):
+    """
+    Bulk loads rows by streaming them through COPY FROM STDIN into a temporary staging table,
+    then merging into the target table with a single set-based INSERT ... ON CONFLICT
+    :param table: SQLAlchemy Table to load into
+    :param rows: list of row dictionaries (all with the same keys)
+    :param engine: SQLAlchemy engine, or a Connection to run inside its transaction
+    :param index_elements: conflict columns, plain INSERT if None
+    :param update_cols: columns updated on conflict, defaults to every non-conflict column
+    :return: None
+    """
+    if not rows:
+        return
+
+    columns = list(rows[0].keys())
+    staging_table = f"{table.name}_staging_{uuid.uuid4().hex[:8]}"
+
+    if isinstance(engine, Connection):
+        dbapi_conn, owns_conn = engine.connection, False
+    else:
+        dbapi_conn, owns_conn = engine.raw_connection(), True
+
+    col_list = ", ".join(columns)
+    merge_sql = f"INSERT INTO {table.name} ({col_list}) "
+    if index_elements:
+        # DISTINCT ON guards against the same key showing up twice in one load
+        conflict_list = ", ".join(index_elements)
+        merge_sql += (
+            f"SELECT DISTINCT ON ({conflict_list}) {col_list} FROM {staging_table} "
+            f"ON CONFLICT ({conflict_list}) "
+        )
+        if update_cols is None:
+            update_cols = [col for col in columns if col not in index_elements]
+        if update_cols:
+            merge_sql += "DO UPDATE SET " + ", ".join(
+                f"{col} = EXCLUDED.{col}" for col in update_cols
+            )
+        else:
+            merge_sql += "DO NOTHING"
+    else:
+        merge_sql += f"SELECT {col_list} FROM {staging_table}"
+
+    try:
+        cursor = dbapi_conn.cursor()
+        # Copy the column types but none of the constraints
+        cursor.execute(
+            f"CREATE TEMP TABLE {staging_table} AS "
+            f"SELECT {col_list} FROM {table.name} WITH NO DATA"
+        )
+        for start in range(0, len(rows), COPY_CHUNK_SIZE):
+            _copy_chunk(
+                cursor, staging_table, columns, rows[start : start + COPY_CHUNK_SIZE]
+            )
+        cursor.execute(merge_sql)
+        count_rows_written(cursor.rowcount)
+        cursor.execute(f"DROP TABLE {staging_table}")
+        cursor.close()
+        if owns_conn:
+            dbapi_conn.commit()
+    except Exception:
+        if owns_conn:
+            dbapi_conn.rollback()
+        raise
+    finally:
+        if owns_conn:
+            dbapi_conn.close()
+
+
 ####################################
 # Database Functions
 ####################################
+def get_user_hashes(engine):
+    """
+    :param engine: SQLAlchemy engine
+    :return: dictionary of user id: content_hash for every stored user
+    """
+    stmt = select([Users.c.id, Users.c.content_hash])
+    return {_id: content_hash for _id, content_hash in execute_stmt(engine, stmt)}
+
+
 def upsert_users(users, engine):
     """
-    Upserts users into the Users table
-    :param users: list of user dictionaries from Canvas API (/api/v1/accounts/:account_id/users)
-    :param session: database session
-    :return: None
+    Upserts users into the Users table. Stored users that already match aren't
+    rewritten.
+    :param users: users column dictionary (id, name, sis_user_id, login_id and
+        content_hash)
+    :param engine: SQLAlchemy engine
+    :return: number of users inserted or updated
     """
-    keys = ["id", "name", "sis_user_id", "login_id"]
-    values = [{key: user[key] for key in keys} for user in users]
-    insert_stmt = postgresql.insert(Users).values(values)
-    update_stmt = insert_stmt.on_conflict_do_update(
-        index_elements=["id"],
-        set_={
-            "name": insert_stmt.excluded.name,
-            "sis_user_id": insert_stmt.excluded.sis_user_id,
-            "login_id": insert_stmt.excluded.login_id,
-        },
+    return upsert_columns(
+        Users, users, engine, index_elements=["id"], only_changed=True
     )
-    execute_stmt(engine, update_stmt)
 
 def upsert_courses(courses, engine):
     """
@@ -77,27 +280,69 @@ def upsert_courses(courses, engine):
 
 
 def upsert_outcomes(outcomes, engine):
-    insert_stmt = postgresql.insert(Outcomes).values(outcomes)
-    update_stmt = insert_stmt.on_conflict_do_update(
-        index_elements=["id"],
-        set_={
-            "title": insert_stmt.excluded.title,
-            "display_name": insert_stmt.excluded.display_name,
-            "calculation_int": insert_stmt.excluded.calculation_int,
-        },
-    )
-    execute_stmt(engine, update_stmt)
+    # outcomes: column dictionary from decode_outcomes
+    upsert_columns(Outcomes, outcomes, engine, index_elements=["id"])
 
 
 def upsert_alignments(alignments, engine):
-    insert_stmt = postgresql.insert(Alignments).values(alignments)
-    update_stmt = insert_stmt.on_conflict_do_update(
-        index_elements=["id"], set_={"name": insert_stmt.excluded.name,}
+    # alignments: column dictionary from decode_alignments
+    upsert_columns(Alignments, alignments, engine, index_elements=["id"])
+
+
+def get_outcome_calculation_settings(outcome_ids, engine):
+    """
+    :param outcome_ids: outcome ids to look up
+    :param engine: SQLAlchemy engine or connection
+    :return: dictionary of id: (calculation_method, calculation_int, mastery_points) for
+        the outcomes that are stored
+    """
+    outcome_ids = list(outcome_ids)
+    if not outcome_ids:
+        return {}
+    stmt = select(
+        [
+            Outcomes.c.id,
+            Outcomes.c.calculation_method,
+            Outcomes.c.calculation_int,
+            Outcomes.c.mastery_points,
+        ]
+    ).where(Outcomes.c.id.in_(outcome_ids))
+    return {r[0]: tuple(r[1:]) for r in execute_stmt(engine, stmt)}
+
+
+def get_metadata_hashes(table, ids, engine):
+    """
+    :param table: Outcomes or Alignments
+    :param ids: ids to look up
+    :param engine: SQLAlchemy engine or connection
+    :return: dictionary of id: (content_hash, checked_at) for the ids that are stored
+    """
+    ids = list(ids)
+    if not ids:
+        return {}
+    stmt = select([table.c.id, table.c.content_hash, table.c.checked_at]).where(
+        table.c.id.in_(ids)
     )
-    execute_stmt(engine, update_stmt)
+    return {
+        _id: (content_hash, checked_at)
+        for _id, content_hash, checked_at in execute_stmt(engine, stmt)
+    }
+
+
+def touch_metadata(table, ids, checked_at, engine):
+    # Records that unchanged rows were compared with Canvas
+    ids = list(ids)
+    if not ids:
+        return
+    stmt = table.update().where(table.c.id.in_(ids)).values(checked_at=checked_at)
+    execute_stmt(engine, stmt)
 
 
 def upsert_outcome_results(outcome_results, engine):
+    if len(outcome_results) >= BULK_LOAD_THRESHOLD:
+        copy_upsert(OutcomeResults, outcome_results, engine, index_elements=["id"])
+        return
+
     insert_stmt = postgresql.insert(OutcomeResults).values(outcome_results)
     update_stmt = insert_stmt.on_conflict_do_update(
         index_elements=["id"],
@@ -132,35 +377,633 @@ def delete_outcome_results(course_id, engine):
     execute_stmt(engine, delete_stmt)
 
 
-def delete_course_students(course_id, engine):
-    delete_stmt = CourseUserLink.delete().where(CourseUserLink.c.course_id == course_id)
+def delete_outcome_results_by_id(result_ids, engine):
+    delete_stmt = OutcomeResults.delete().where(OutcomeResults.c.id.in_(result_ids))
     execute_stmt(engine, delete_stmt)
 
 
-def insert_course_students(students, engine):
-    stmt = CourseUserLink.insert().values(students)
+def get_course_result_ids(course_id, engine):
+    stmt = select([OutcomeResults.c.id]).where(OutcomeResults.c.course_id == course_id)
+    res = execute_stmt(engine, stmt)
+    return [r[0] for r in res]
+
+
+def get_course_sync_state(course_id, engine):
+    """
+    Gets the incremental sync state for a course
+    :param course_id: course id
+    :param engine: SQLAlchemy engine
+    :return: state dictionary or None if the course hasn't been synced incrementally yet
+    """
+    stmt = CourseSyncState.select(CourseSyncState.c.course_id == course_id)
+    res = execute_stmt(engine, stmt).first()
+    if res is None:
+        return None
+    return dict(res)
+
+
+def upsert_course_sync_state(state, engine):
+    insert_stmt = postgresql.insert(CourseSyncState).values(state)
+    update_stmt = insert_stmt.on_conflict_do_update(
+        index_elements=["course_id"],
+        set_={
+            "high_water_mark": insert_stmt.excluded.high_water_mark,
+            "result_ids": insert_stmt.excluded.result_ids,
+            "synced_at": insert_stmt.excluded.synced_at,
+            "results_digest": insert_stmt.excluded.results_digest,
+        },
+    )
+    execute_stmt(engine, update_stmt)
+
+
+####################################
+# Sync Checkpoints
+####################################
+# Stage recorded when a sync run starts, its timestamp is the run's age
+RUN_STARTED_STAGE = "run_started"
+
+
+def start_sync_run(engine, max_age=None):
+    """
+    Resumes the latest unfinished sync run or starts a new one. Runs older than max_age
+    are abandoned and their checkpoints removed.
+    :param engine: SQLAlchemy engine
+    :param max_age: timedelta, unfinished runs older than this start over
+    :return: (sync_run_id, resumed)
+    """
+    stmt = (
+        SyncCheckpoints.select()
+        .where(SyncCheckpoints.c.stage == RUN_STARTED_STAGE)
+        .order_by(desc(SyncCheckpoints.c.completed_at))
+    )
+    run = execute_stmt(engine, stmt).first()
+    if run is not None:
+        if max_age is None or datetime.utcnow() - run["completed_at"] < max_age:
+            return run["sync_run_id"], True
+        execute_stmt(engine, SyncCheckpoints.delete())
+
+    sync_run_id = str(uuid.uuid4())
+    add_sync_checkpoint(sync_run_id, RUN_STARTED_STAGE, engine)
+    return sync_run_id, False
+
+
+def add_sync_checkpoint(sync_run_id, stage, engine, item_id=""):
+    insert_stmt = postgresql.insert(SyncCheckpoints).values(
+        sync_run_id=sync_run_id,
+        stage=stage,
+        item_id=str(item_id),
+        completed_at=datetime.utcnow(),
+    )
+    execute_stmt(engine, insert_stmt.on_conflict_do_nothing())
+
+
+def get_sync_checkpoints(sync_run_id, stage, engine):
+    """
+    Gets the finished items of a stage
+    :param sync_run_id: sync run id
+    :param stage: stage name
+    :param engine: SQLAlchemy engine
+    :return: set of item ids (strings)
+    """
+    stmt = select([SyncCheckpoints.c.item_id]).where(
+        (SyncCheckpoints.c.sync_run_id == sync_run_id)
+        & (SyncCheckpoints.c.stage == stage)
+    )
+    return {row[0] for row in execute_stmt(engine, stmt)}
+
+
+def has_sync_checkpoint(sync_run_id, stage, engine, item_id=""):
+    stmt = select([SyncCheckpoints.c.item_id]).where(
+        (SyncCheckpoints.c.sync_run_id == sync_run_id)
+        & (SyncCheckpoints.c.stage == stage)
+        & (SyncCheckpoints.c.item_id == str(item_id))
+    )
+    return execute_stmt(engine, stmt).first() is not None
+
+
+def get_sync_run_started_at(sync_run_id, engine):
+    """
+    :param sync_run_id: sync run id
+    :param engine: SQLAlchemy engine
+    :return: when the sync run first started, resumed runs keep their original start,
+        or None if it has no run_started checkpoint
+    """
+    stmt = select([SyncCheckpoints.c.completed_at]).where(
+        (SyncCheckpoints.c.sync_run_id == sync_run_id)
+        & (SyncCheckpoints.c.stage == RUN_STARTED_STAGE)
+    )
+    return execute_stmt(engine, stmt).scalar()
+
+
+def clear_sync_checkpoints(sync_run_id, engine):
+    execute_stmt(
+        engine,
+        SyncCheckpoints.delete().where(SyncCheckpoints.c.sync_run_id == sync_run_id),
+    )
+
+
+####################################
+# Staged Syncs
+####################################
+RESULT_COLUMNS = [
+    "id",
+    "score",
+    "course_id",
+    "user_id",
+    "outcome_id",
+    "alignment_id",
+    "submitted_or_assessed_at",
+    "last_updated",
+    "enrollment_term",
+]
+
+
+def clear_staged_outcome_results(term_id, engine):
+    execute_stmt(
+        engine,
+        OutcomeResultsStaging.delete().where(OutcomeResultsStaging.c.term_id == term_id),
+    )
+    execute_stmt(
+        engine,
+        CourseSyncStateStaging.delete().where(
+            CourseSyncStateStaging.c.term_id == term_id
+        ),
+    )
+
+
+def upsert_outcome_result_columns(outcome_results, engine):
+    # outcome_results: column dictionary from decode_outcome_result_page
+    upsert_columns(OutcomeResults, outcome_results, engine, index_elements=["id"])
+
+
+def stage_outcome_results(outcome_results, term_id, engine):
+    # outcome_results: column dictionary from decode_outcome_result_page
+    count = len(outcome_results["id"])
+    columns = dict(outcome_results)
+    columns["term_id"] = np.full(count, term_id)
+    columns["deleted"] = np.zeros(count, dtype=bool)
+    upsert_columns(OutcomeResultsStaging, columns, engine, index_elements=["id"])
+
+
+def stage_outcome_result_deletes(result_ids, term_id, engine):
+    rows = [dict(id=_id, term_id=term_id, deleted=True) for _id in result_ids]
+    copy_upsert(OutcomeResultsStaging, rows, engine, index_elements=["id"])
+
+
+def stage_course_sync_state(state, term_id, engine):
+    insert_stmt = postgresql.insert(CourseSyncStateStaging).values(
+        dict(state, term_id=term_id)
+    )
+    update_stmt = insert_stmt.on_conflict_do_update(
+        index_elements=["course_id"],
+        set_={
+            "term_id": insert_stmt.excluded.term_id,
+            "high_water_mark": insert_stmt.excluded.high_water_mark,
+            "result_ids": insert_stmt.excluded.result_ids,
+            "synced_at": insert_stmt.excluded.synced_at,
+            "results_digest": insert_stmt.excluded.results_digest,
+        },
+    )
+    execute_stmt(engine, update_stmt)
+
+
+def publish_staged_outcome_results(term_id, engine):
+    """
+    Publishes a term's staged outcome results to the live tables in a single transaction.
+    Readers keep seeing the previous results until the commit and are never blocked.
+    :param term_id: enrollment term id
+    :param engine: SQLAlchemy engine
+    :return: None
+    """
+    result_cols = ", ".join(RESULT_COLUMNS)
+    result_updates = ", ".join(
+        f"{col} = EXCLUDED.{col}" for col in RESULT_COLUMNS if col != "id"
+    )
+    # Staged results and the stored results they replace or delete need regrading
+    dirty_pairs = """
+        SELECT user_id, course_id FROM outcome_results_staging
+        WHERE term_id = :term_id AND NOT deleted
+        UNION
+        SELECT o.user_id, o.course_id
+        FROM outcome_results o JOIN outcome_results_staging s ON s.id = o.id
+        WHERE s.term_id = :term_id
+    """
+    stmts = [
+        MARK_DIRTY_SQL.format(pairs=dirty_pairs),
+        f"""
+        INSERT INTO outcome_results ({result_cols})
+        SELECT {result_cols} FROM outcome_results_staging
+        WHERE term_id = :term_id AND NOT deleted
+        ON CONFLICT (id) DO UPDATE SET {result_updates}
+        """,
+        """
+        DELETE FROM outcome_results o
+        USING outcome_results_staging s
+        WHERE s.id = o.id AND s.term_id = :term_id AND s.deleted
+        """,
+        """
+        INSERT INTO course_sync_state
+            (course_id, high_water_mark, result_ids, synced_at, results_digest)
+        SELECT course_id, high_water_mark, result_ids, synced_at, results_digest
+        FROM course_sync_state_staging
+        WHERE term_id = :term_id
+        ON CONFLICT (course_id) DO UPDATE SET
+            high_water_mark = EXCLUDED.high_water_mark,
+            result_ids = EXCLUDED.result_ids,
+            synced_at = EXCLUDED.synced_at,
+            results_digest = EXCLUDED.results_digest
+        """,
+        "DELETE FROM outcome_results_staging WHERE term_id = :term_id",
+        "DELETE FROM course_sync_state_staging WHERE term_id = :term_id",
+    ]
+    with engine.begin() as conn:
+        for stmt in stmts:
+            count_rows_written(conn.execute(text(stmt), term_id=term_id).rowcount)
+
+
+def get_course_roster_digests(course_ids, engine):
+    course_ids = list(set(course_ids))
+    if not course_ids:
+        return {}
+    stmt = select([Courses.c.id, Courses.c.roster_digest]).where(
+        Courses.c.id.in_(course_ids)
+    )
+    return {r[0]: r[1] for r in execute_stmt(engine, stmt)}
+
+
+def set_course_roster_digests(digests, engine):
+    """
+    :param digests: dictionary of course id to roster digest
+    :param engine: SQLAlchemy engine or connection
+    :return: None
+    """
+    if not digests:
+        return
+    stmt = text(
+        """
+        UPDATE courses c SET roster_digest = d.roster_digest
+        FROM unnest(CAST(:course_ids AS integer[]), CAST(:digests AS varchar[]))
+            AS d(course_id, roster_digest)
+        WHERE c.id = d.course_id
+        """
+    ).bindparams(course_ids=list(digests.keys()), digests=list(digests.values()))
+    execute_stmt(engine, stmt)
+
+
+def get_course_students(course_ids, engine):
+    """
+    Gets the stored rosters of some courses
+    :param course_ids: course ids
+    :param engine: SQLAlchemy engine or connection
+    :return: dictionary of (course_id, user_id) to (section_id, section_name)
+    """
+    course_ids = list(set(course_ids))
+    if not course_ids:
+        return {}
+    stmt = select(
+        [
+            CourseUserLink.c.course_id,
+            CourseUserLink.c.user_id,
+            CourseUserLink.c.section_id,
+            CourseUserLink.c.section_name,
+        ]
+    ).where(CourseUserLink.c.course_id.in_(course_ids))
+    return {(r[0], r[1]): (r[2], r[3]) for r in execute_stmt(engine, stmt)}
+
+
+def delete_course_student_pairs(pairs, engine):
+    # pairs: (user_id, course_id) tuples
+    if not pairs:
+        return
+    stmt = text(
+        """
+        DELETE FROM course_user_link l
+        USING unnest(CAST(:user_ids AS integer[]), CAST(:course_ids AS integer[]))
+            AS p(user_id, course_id)
+        WHERE l.user_id = p.user_id AND l.course_id = p.course_id
+        """
+    ).bindparams(**_unnest_pairs(pairs))
     execute_stmt(engine, stmt)
 
 
+def upsert_course_students(columns, engine):
+    # columns: course_user_link column arrays, new students and section changes
+    upsert_columns(
+        CourseUserLink, columns, engine, index_elements=["course_id", "user_id"]
+    )
+
+
 def create_record(current_term, engine):
     """
     Creates new record
     :param current_term:
-    :param session:
+    :param engine: engine or connection (the record is committed with its transaction)
     :return: record_id for newly created record
     """
     timestamp = datetime.utcnow()
     values = {"created_at": timestamp, "term_id": current_term}
 
-    # Make new record
-    make_stmt = Records.insert().values(values)
-    execute_stmt(engine, make_stmt)
+    # Make new record, RETURNING hands back its id
+    make_stmt = Records.insert().values(values).returning(Records.c.id)
+    record_id = _insert_returning_id(engine, make_stmt)
 
-    # Grab record to use id later
+    # Cached dashboards are keyed by record id, drop the old ones
+    invalidate_dashboards()
+    return record_id
+
+
+def _insert_returning_id(engine, insert_stmt):
     session = Session(engine)
-    record = session.query(Records).order_by(desc(Records.c.id)).first()
+    _id = session.execute(insert_stmt).scalar()
+    session.commit()
     session.close()
-    return record[0]
+    return _id
+
+
+####################################
+# Sync Run Ledger
+####################################
+def create_sync_run(kind, engine, checkpoint_run_id=None):
+    """
+    Starts a sync run ledger entry
+    :param kind: full_sync, serial_sync or regrade
+    :param engine: SQLAlchemy engine
+    :param checkpoint_run_id: id the run's checkpoints are stored under
+    :return: sync run id
+    """
+    stmt = (
+        SyncRuns.insert()
+        .values(
+            kind=kind,
+            checkpoint_run_id=checkpoint_run_id,
+            started_at=datetime.utcnow(),
+            status="running",
+        )
+        .returning(SyncRuns.c.id)
+    )
+    return _insert_returning_id(engine, stmt)
+
+
+def update_sync_run(sync_run_id, engine, **values):
+    with engine.begin() as conn:
+        conn.execute(SyncRuns.update().where(SyncRuns.c.id == sync_run_id).values(values))
+
+
+def insert_sync_run_stage(stage, engine):
+    # Skips execute_stmt so the ledger's own writes aren't counted as rows written
+    with engine.begin() as conn:
+        conn.execute(SyncRunStages.insert().values(stage))
+
+
+####################################
+# Targeted Updates (live events)
+####################################
+def get_existing_ids(table, ids, engine):
+    """
+    Which of the ids are already in a table
+    :param table: table with an id column
+    :param ids: iterable of ids
+    :param engine: SQLAlchemy engine
+    :return: set of ids found
+    """
+    ids = list(set(ids))
+    if not ids:
+        return set()
+    stmt = select([table.c.id]).where(table.c.id.in_(ids))
+    return {r[0] for r in execute_stmt(engine, stmt)}
+
+
+def get_courses_by_id(course_ids, engine):
+    course_ids = list(set(course_ids))
+    if not course_ids:
+        return {}
+    stmt = Courses.select(Courses.c.id.in_(course_ids))
+    return {r["id"]: dict(r) for r in execute_stmt(engine, stmt)}
+
+
+def get_outcome_results_by_id(result_ids, engine):
+    """
+    Gets stored outcome results, to fill in what a live event leaves out
+    :param result_ids: outcome result ids
+    :param engine: SQLAlchemy engine
+    :return: dictionary of result id to result dictionary
+    """
+    result_ids = list(set(result_ids))
+    if not result_ids:
+        return {}
+    stmt = OutcomeResults.select(OutcomeResults.c.id.in_(result_ids))
+    return {r["id"]: dict(r) for r in execute_stmt(engine, stmt)}
+
+
+def add_course_sync_result_ids(course_id, result_ids, engine):
+    # Results written outside the course sync join its known ids, so a later sync
+    # notices when they disappear from Canvas
+    stmt = text(
+        """
+        UPDATE course_sync_state
+        SET result_ids = ARRAY(
+            SELECT DISTINCT unnest(result_ids || CAST(:result_ids AS integer[]))
+            ORDER BY 1
+        )
+        WHERE course_id = :course_id
+        """
+    ).bindparams(course_id=course_id, result_ids=list(result_ids))
+    execute_stmt(engine, stmt)
+
+
+def clear_course_results_digests(course_ids, engine):
+    # The stored results no longer match what the last sync saw in Canvas, so the next
+    # sync mustn't skip these courses
+    course_ids = list(set(course_ids))
+    if not course_ids:
+        return
+    stmt = (
+        CourseSyncState.update()
+        .where(CourseSyncState.c.course_id.in_(course_ids))
+        .values(results_digest=None)
+    )
+    execute_stmt(engine, stmt)
+
+
+def get_course_pairs(course_ids, engine):
+    """
+    Every (user_id, course_id) pair with outcome results or a grade in the courses
+    :param course_ids: course ids
+    :param engine: SQLAlchemy engine
+    :return: set of (user_id, course_id) tuples
+    """
+    course_ids = list(set(course_ids))
+    if not course_ids:
+        return set()
+    stmt = text(
+        """
+        SELECT user_id, course_id FROM outcome_results
+        WHERE course_id = ANY(:course_ids)
+        UNION
+        SELECT user_id, course_id FROM grades
+        WHERE course_id = ANY(:course_ids)
+        """
+    ).bindparams(course_ids=course_ids)
+    return {(r[0], r[1]) for r in execute_stmt(engine, stmt)}
+
+
+def _unnest_pairs(pairs):
+    user_ids, course_ids = zip(*pairs)
+    return dict(user_ids=list(user_ids), course_ids=list(course_ids))
+
+
+def delete_pair_grades(pairs, engine):
+    stmt = text(
+        """
+        DELETE FROM grades g
+        USING unnest(CAST(:user_ids AS integer[]), CAST(:course_ids AS integer[]))
+            AS p(user_id, course_id)
+        WHERE g.user_id = p.user_id AND g.course_id = p.course_id
+        """
+    ).bindparams(**_unnest_pairs(pairs))
+    execute_stmt(engine, stmt)
+
+
+####################################
+# Dirty Grades
+####################################
+# Marks are compared by marked_at when cleared, so a pair marked again while its grade
+# was being calculated stays dirty
+MARK_DIRTY_SQL = """
+    INSERT INTO grade_dirty_pairs (user_id, course_id, marked_at)
+    SELECT user_id, course_id, clock_timestamp() FROM ({pairs}) p
+    ON CONFLICT (user_id, course_id) DO UPDATE SET marked_at = EXCLUDED.marked_at
+"""
+
+
+def mark_dirty_pairs(pairs, engine):
+    """
+    Marks (user_id, course_id) pairs whose outcome results changed, call it in the same
+    transaction as the change
+    :param pairs: iterable of (user_id, course_id) tuples
+    :param engine: SQLAlchemy engine or connection
+    :return: None
+    """
+    pairs = set(pairs)
+    if not pairs:
+        return
+    pairs_sql = """
+        SELECT DISTINCT * FROM unnest(
+            CAST(:user_ids AS integer[]), CAST(:course_ids AS integer[])
+        ) AS u(user_id, course_id)
+    """
+    stmt = text(MARK_DIRTY_SQL.format(pairs=pairs_sql)).bindparams(
+        **_unnest_pairs(pairs)
+    )
+    execute_stmt(engine, stmt)
+
+
+def mark_result_pairs_dirty(result_ids, engine):
+    # The pairs of stored results that are about to be deleted
+    if not result_ids:
+        return
+    pairs_sql = """
+        SELECT DISTINCT user_id, course_id FROM outcome_results
+        WHERE id = ANY(CAST(:result_ids AS integer[]))
+    """
+    stmt = text(MARK_DIRTY_SQL.format(pairs=pairs_sql)).bindparams(
+        result_ids=list(result_ids)
+    )
+    execute_stmt(engine, stmt)
+
+
+def mark_outcome_pairs_dirty(outcome_ids, engine):
+    """
+    Marks the pairs graded with some outcomes' Canvas calculation settings, in the sync
+    terms that use them (any calculation method but drop_lowest)
+    :param outcome_ids: outcome ids whose settings changed
+    :param engine: SQLAlchemy engine or connection
+    :return: None
+    """
+    if not outcome_ids:
+        return
+    pairs_sql = """
+        SELECT DISTINCT o.user_id, o.course_id
+        FROM outcome_results o
+            JOIN courses c ON c.id = o.course_id
+            JOIN enrollment_terms et ON et.id = c.enrollment_term_id
+        WHERE o.outcome_id = ANY(CAST(:outcome_ids AS integer[]))
+            AND et.sync_term
+            AND COALESCE(et.calculation_method, :drop_lowest) <> :drop_lowest
+    """
+    stmt = text(MARK_DIRTY_SQL.format(pairs=pairs_sql)).bindparams(
+        outcome_ids=list(outcome_ids), drop_lowest=DROP_LOWEST
+    )
+    execute_stmt(engine, stmt)
+
+
+def get_term_dirty_marks(term_id, engine):
+    """
+    :param term_id: enrollment term id
+    :param engine: SQLAlchemy engine
+    :return: list of (user_id, course_id, marked_at) tuples for the term's courses
+    """
+    stmt = text(
+        """
+        SELECT d.user_id, d.course_id, d.marked_at
+        FROM grade_dirty_pairs d
+            JOIN courses c ON c.id = d.course_id
+        WHERE c.enrollment_term_id = :term_id
+        """
+    ).bindparams(term_id=term_id)
+    return [tuple(r) for r in execute_stmt(engine, stmt)]
+
+
+def get_pair_dirty_marks(pairs, engine):
+    stmt = text(
+        """
+        SELECT d.user_id, d.course_id, d.marked_at
+        FROM grade_dirty_pairs d
+            JOIN unnest(CAST(:user_ids AS integer[]), CAST(:course_ids AS integer[]))
+                AS p(user_id, course_id)
+                ON p.user_id = d.user_id AND p.course_id = d.course_id
+        """
+    ).bindparams(**_unnest_pairs(pairs))
+    return [tuple(r) for r in execute_stmt(engine, stmt)]
+
+
+def clear_dirty_marks(marks, engine):
+    """
+    Clears marks whose grades were recalculated, unless they were marked again since
+    :param marks: list of (user_id, course_id, marked_at) tuples
+    :param engine: SQLAlchemy engine or connection
+    :return: None
+    """
+    if not marks:
+        return
+    user_ids, course_ids, marked_ats = zip(*marks)
+    stmt = text(
+        """
+        DELETE FROM grade_dirty_pairs d
+        USING unnest(
+            CAST(:user_ids AS integer[]),
+            CAST(:course_ids AS integer[]),
+            CAST(:marked_ats AS timestamp[])
+        ) AS p(user_id, course_id, marked_at)
+        WHERE d.user_id = p.user_id AND d.course_id = p.course_id
+            AND d.marked_at = p.marked_at
+        """
+    ).bindparams(
+        user_ids=list(user_ids), course_ids=list(course_ids), marked_ats=list(marked_ats)
+    )
+    execute_stmt(engine, stmt)
+
+
+def has_term_grades(term_id, engine):
+    stmt = text(
+        """
+        SELECT EXISTS (
+            SELECT 1 FROM grades g JOIN courses c ON c.id = g.course_id
+            WHERE c.enrollment_term_id = :term_id
+        )
+        """
+    ).bindparams(term_id=term_id)
+    return execute_stmt(engine, stmt).scalar()
 
 
 def delete_grades_current_term(current_term, engine):
@@ -173,6 +1016,10 @@ def delete_grades_current_term(current_term, engine):
 
 
 def insert_grades_to_db(grades_list, engine):
+    if len(grades_list) >= BULK_LOAD_THRESHOLD:
+        copy_upsert(Grades, grades_list, engine)
+        return
+
     stmt = Grades.insert().values(grades_list)
     execute_stmt(engine, stmt)
 
@@ -206,6 +1053,84 @@ def query_current_outcome_results(current_term, engine):
     return outcome_results
 
 
+# The columns the grade calculation reads, as compact dtypes
+GRADE_RESULT_COLUMNS = [
+    "links.user",
+    "course_id",
+    "outcome_id",
+    "score",
+    "submitted_or_assessed_at",
+]
+GRADE_RESULT_DTYPES = {
+    "links.user": "int32",
+    "course_id": "int32",
+    "outcome_id": "int32",
+    "score": "float64",
+    "submitted_or_assessed_at": "datetime64[ns]",
+}
+GRADE_RESULT_CHUNK_ROWS = int(os.getenv("GRADE_RESULT_CHUNK_ROWS", 100000))
+
+
+def _grade_result_frame(rows):
+    frame = pd.DataFrame.from_records(rows, columns=GRADE_RESULT_COLUMNS)
+    return frame.astype(GRADE_RESULT_DTYPES)
+
+
+def iter_course_outcome_results(term_id, engine, pairs=None, chunk_rows=None):
+    """
+    Streams a term's scored outcome results one course at a time, through a server side
+    cursor, so only a chunk and the course being graded are in memory
+    :param term_id: enrollment term id
+    :param engine: SQLAlchemy engine
+    :param pairs: only these (user_id, course_id) pairs, defaults to the whole term
+    :param chunk_rows: rows fetched at a time, defaults to GRADE_RESULT_CHUNK_ROWS
+    :return: generator of (course_id, DataFrame) tuples with GRADE_RESULT_COLUMNS
+    """
+    chunk_rows = chunk_rows or GRADE_RESULT_CHUNK_ROWS
+    params = dict(term_id=term_id)
+    pair_join = ""
+    if pairs is not None:
+        pair_join = """
+            JOIN unnest(CAST(:user_ids AS integer[]), CAST(:course_ids AS integer[]))
+                AS p(user_id, course_id)
+                ON p.user_id = o_res.user_id AND p.course_id = o_res.course_id
+        """
+        params.update(_unnest_pairs(pairs))
+    sql = text(
+        f"""
+        SELECT o_res.user_id, o_res.course_id, o_res.outcome_id, o_res.score,
+            o_res.submitted_or_assessed_at
+        FROM outcome_results o_res
+            JOIN courses c ON c.id = o_res.course_id
+            {pair_join}
+        WHERE o_res.score IS NOT NULL
+            AND c.enrollment_term_id = :term_id
+        ORDER BY o_res.course_id
+        """
+    )
+
+    with engine.connect() as conn:
+        result = conn.execution_options(stream_results=True).execute(sql, **params)
+        # The last course in a chunk may continue in the next one
+        carry = None
+        while True:
+            rows = result.fetchmany(chunk_rows)
+            if not rows:
+                break
+            frame = _grade_result_frame(rows)
+            if carry is not None:
+                frame = pd.concat([carry, frame], ignore_index=True)
+            last_course = frame["course_id"].iat[-1]
+            is_last = frame["course_id"].values == last_course
+            carry = frame[is_last]
+            for course_id, course_results in frame[~is_last].groupby(
+                "course_id", sort=False
+            ):
+                yield int(course_id), course_results
+        if carry is not None and not carry.empty:
+            yield int(carry["course_id"].iat[0]), carry
+
+
 def get_db_courses(engine, current_term=None):
     stmt = Courses.select(Courses.c.enrollment_term_id == current_term)
     session = Session(engine)
@@ -268,6 +1193,23 @@ def get_sync_terms(engine):
     return terms
 
 
+def get_terms(engine, term_ids):
+    stmt = EnrollmentTerms.select(EnrollmentTerms.c.id.in_(term_ids))
+    session = Session(engine)
+    conn = session.connection()
+
+    # Get columns for dict conversion
+    columns = EnrollmentTerms.c
+    columns = [col.key for col in columns]
+
+    terms = list(conn.execute(stmt))
+    terms = [dict(zip(columns, term)) for term in terms]
+
+    session.close()
+
+    return terms
+
+
 def get_calculation_dictionaries(engine):
     cols = [
         GradeCalculation.c.grade,
@@ -286,6 +1228,25 @@ def get_calculation_dictionaries(engine):
     return [r for r in res]
 
 
+def get_outcome_calculations(engine):
+    """
+    :param engine: SQLAlchemy engine
+    :return: DataFrame of every outcome's Canvas calculation settings, with
+        outcome_id, calculation_method, calculation_int and mastery_points columns
+    """
+    cols = [
+        Outcomes.c.id.label("outcome_id"),
+        Outcomes.c.calculation_method,
+        Outcomes.c.calculation_int,
+        Outcomes.c.mastery_points,
+    ]
+    res = execute_stmt(engine, select(cols))
+    return pd.DataFrame.from_records(
+        list(res),
+        columns=["outcome_id", "calculation_method", "calculation_int", "mastery_points"],
+    )
+
+
 def get_token():
     stmt = select([CanvasApiToken.c.token])
     session = get_session()
@@ -10,7 +10,9 @@ from sqlalchemy import (
     Float,
     JSON,
     Boolean,
+    BigInteger,
 )
+from sqlalchemy.dialects.postgresql import ARRAY
 from sqlalchemy.ext.automap import automap_base
 from app.config import configuration
 
@@ -40,6 +42,7 @@ EnrollmentTerms = Table(
     Column("sis_term_id", String),
     Column("sis_import_id", Integer),
     Column("cut_off_date", DateTime),
+    Column("calculation_method", String),
     Column("current_term", Boolean),
     Column("sync_term", Boolean),
 )
@@ -75,7 +78,8 @@ Courses = Table(
     Column("id", Integer, primary_key=True),
     Column("name", String),
     Column("enrollment_term_id", Integer),
-    Column("sis_course_id", String)
+    Column("sis_course_id", String),
+    Column("roster_digest", String),
 )
 
 Grades = Table(
@@ -98,6 +102,7 @@ Users = Table(
     Column("name", String),
     Column("sis_user_id", String),
     Column("login_id", String),
+    Column("content_hash", String),
 )
 
 OutcomeResults = Table(
@@ -120,6 +125,8 @@ Alignments = Table(
     metadata,
     Column("id", String, primary_key=True),
     Column("name", String, nullable=False),
+    Column("content_hash", String),
+    Column("checked_at", DateTime),
 )
 
 Outcomes = Table(
@@ -129,6 +136,10 @@ Outcomes = Table(
     Column("title", String, nullable=False),
     Column("display_name", String),
     Column("calculation_int", Integer, nullable=False),
+    Column("calculation_method", String),
+    Column("mastery_points", Float),
+    Column("content_hash", String),
+    Column("checked_at", DateTime),
 )
 
 CourseUserLink = Table(
@@ -139,3 +150,92 @@ CourseUserLink = Table(
     Column("section_id", Integer),
     Column("section_name", String)
 )
+
+CourseSyncState = Table(
+    "course_sync_state",
+    metadata,
+    Column("course_id", ForeignKey("courses.id"), primary_key=True, nullable=False),
+    Column("high_water_mark", DateTime),
+    Column("result_ids", ARRAY(Integer)),
+    Column("synced_at", DateTime),
+    Column("results_digest", String),
+)
+
+# Shadow tables for staged syncs, published to the live tables in one transaction
+OutcomeResultsStaging = Table(
+    "outcome_results_staging",
+    metadata,
+    Column("id", Integer, primary_key=True),
+    Column("term_id", Integer, nullable=False, index=True),
+    Column("deleted", Boolean, nullable=False, default=False),
+    Column("score", Float),
+    Column("course_id", Integer),
+    Column("user_id", Integer),
+    Column("outcome_id", Integer),
+    Column("alignment_id", String),
+    Column("submitted_or_assessed_at", DateTime),
+    Column("last_updated", DateTime),
+    Column("enrollment_term", Integer),
+)
+
+CourseSyncStateStaging = Table(
+    "course_sync_state_staging",
+    metadata,
+    Column("course_id", Integer, primary_key=True),
+    Column("term_id", Integer, nullable=False, index=True),
+    Column("high_water_mark", DateTime),
+    Column("result_ids", ARRAY(Integer)),
+    Column("synced_at", DateTime),
+    Column("results_digest", String),
+)
+
+# Ledger of sync runs, one row per stage (course_id is set for the per-course rows)
+SyncRuns = Table(
+    "sync_runs",
+    metadata,
+    Column("id", Integer, primary_key=True),
+    Column("kind", String),
+    Column("checkpoint_run_id", String(36), index=True),
+    Column("started_at", DateTime),
+    Column("finished_at", DateTime),
+    Column("status", String),
+)
+
+SyncRunStages = Table(
+    "sync_run_stages",
+    metadata,
+    Column("id", Integer, primary_key=True),
+    Column("sync_run_id", ForeignKey("sync_runs.id"), nullable=False, index=True),
+    Column("stage", String, nullable=False),
+    Column("term_id", Integer),
+    Column("course_id", Integer),
+    Column("wall_seconds", Float),
+    Column("cpu_seconds", Float),
+    Column("peak_rss_mb", Float),
+    Column("canvas_requests", Integer),
+    Column("canvas_bytes", BigInteger),
+    Column("rows_written", Integer),
+    Column("results", Integer),
+    Column("skipped", Integer),
+    Column("failed", Boolean),
+    Column("recorded_at", DateTime),
+)
+
+# Finished stages and courses of a sync run, cleared once the run's grades commit
+SyncCheckpoints = Table(
+    "sync_checkpoints",
+    metadata,
+    Column("sync_run_id", String(36), primary_key=True),
+    Column("stage", String, primary_key=True),
+    Column("item_id", String, primary_key=True, default=""),
+    Column("completed_at", DateTime),
+)
+
+# (user, course) pairs with outcome result changes their grade doesn't include yet
+GradeDirtyPairs = Table(
+    "grade_dirty_pairs",
+    metadata,
+    Column("user_id", Integer, primary_key=True),
+    Column("course_id", Integer, primary_key=True),
+    Column("marked_at", DateTime),
+)
@@ -0,0 +1,70 @@
+"""
+Order independent digests of table rows. A course's outcome results digest is the sum of
+its row hashes, so rows can be swapped in and out of a stored digest without rehashing
+the rest of the course. Kept free of database imports so it can be tested on its own.
+"""
+import numpy as np
+import pandas as pd
+
+# Columns that make up a course's results digest, last_updated changes on every pull
+DIGEST_RESULT_COLS = [
+    "id",
+    "score",
+    "user_id",
+    "outcome_id",
+    "alignment_id",
+    "submitted_or_assessed_at",
+]
+_DIGEST_MULTIPLIER = np.uint64(1000003)
+
+
+def row_hashes(columns, names):
+    """
+    Hashes each row of a column dictionary, equal rows always hash the same
+    :param columns: dictionary of column arrays
+    :param names: columns to hash
+    :return: uint64 array, one hash per row
+    """
+    hashes = np.zeros(len(columns[names[0]]), dtype=np.uint64)
+    for name in names:
+        hashes = hashes * _DIGEST_MULTIPLIER ^ pd.util.hash_array(columns[name])
+    return hashes
+
+
+def format_digest(count, total):
+    # The sum doesn't depend on the order Canvas returns the rows in
+    return f"{count}:{total % 2 ** 64:016x}"
+
+
+def replace_in_digest(digest, old_count, old_total, new_count, new_total):
+    """
+    :param digest: digest from format_digest
+    :param old_count: number of rows taken out
+    :param old_total: sum of their row hashes
+    :param new_count: number of rows put in
+    :param new_total: sum of their row hashes
+    :return: the digest with the old rows replaced by the new ones
+    """
+    count, total = digest.split(":")
+    return format_digest(
+        int(count) - old_count + new_count, int(total, 16) - old_total + new_total
+    )
+
+
+def stored_result_columns(rows):
+    """
+    :param rows: stored outcome result dictionaries, e.g. from get_outcome_results_by_id
+    :return: dictionary of the DIGEST_RESULT_COLS arrays, typed like
+        decode_outcome_result_page so a stored row hashes the same as the Canvas result
+        it was written from
+    """
+    return {
+        "id": np.array([row["id"] for row in rows], dtype="int64"),
+        "score": np.array([row["score"] for row in rows], dtype="float64"),
+        "user_id": np.array([row["user_id"] for row in rows], dtype="int64"),
+        "outcome_id": np.array([row["outcome_id"] for row in rows], dtype="int64"),
+        "alignment_id": np.array([row["alignment_id"] for row in rows], dtype=object),
+        "submitted_or_assessed_at": np.array(
+            [row["submitted_or_assessed_at"] for row in rows], dtype="datetime64[us]"
+        ),
+    }
@@ -0,0 +1,443 @@
+"""
+Local stand-in for the parts of the Canvas API the sync reads: terms, users, courses,
+sections, course users and outcome results. Responses come from a synthetic dataset (or
+one recorded from Canvas) and are paginated with Link headers like Canvas' own, after an
+optional latency. Every response reports its cost and what's left of a leaky bucket
+rate limit (X-Request-Cost / X-Rate-Limit-Remaining), and an empty bucket answers
+403 Rate Limit Exceeded, so the client's throttling and retries get exercised too.
+
+Point the sync at it with CANVAS_API_URL, e.g. CANVAS_API_URL=http://127.0.0.1:8900
+
+    python -m utilities.fake_canvas serve --courses 50 --students 25 --outcomes 8
+    python -m utilities.fake_canvas serve --dataset recorded.json --latency-ms 80
+    python -m utilities.fake_canvas record 6 recorded.json
+
+Recordings hold real student data, keep them out of the repository.
+"""
+import argparse
+import json
+import random
+import re
+import threading
+import time
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlencode, urlparse
+
+# Canvas' bucket holds 700 units
+RATE_LIMIT_BUCKET = 700.0
+
+
+def _canvas_time(value):
+    return value.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def make_dataset(
+    courses=20, students=25, outcomes=8, assessments=3, account_students=None, seed=0
+):
+    """
+    Synthetic Canvas data for one term
+    :param courses: number of courses
+    :param students: students per course
+    :param outcomes: outcomes per course
+    :param assessments: aligned assessments per outcome, each student has a result for
+        every one
+    :param account_students: students in the account, defaults to enough for every
+        student to take about six courses
+    :param seed: random seed
+    :return: dataset dictionary
+    """
+    rng = random.Random(seed)
+    term_start = datetime(2021, 8, 16)
+    term = {
+        "id": 1,
+        "name": "Fall 2021",
+        "start_at": _canvas_time(term_start),
+        "end_at": _canvas_time(term_start + timedelta(days=125)),
+        "created_at": _canvas_time(term_start - timedelta(days=90)),
+        "workflow_state": "active",
+        "sis_term_id": "2021-fall",
+        "sis_import_id": None,
+        "grading_period_group_id": None,
+    }
+    if account_students is None:
+        account_students = max(students, courses * students // 6)
+    users = [
+        {
+            "id": 1000 + i,
+            "name": f"Student {i}",
+            "sis_user_id": f"S{i:05d}",
+            "login_id": f"student{i}@example.com",
+        }
+        for i in range(account_students)
+    ]
+
+    dataset = dict(
+        terms=[term],
+        users=users,
+        courses=[],
+        sections={},
+        course_users={},
+        outcome_results={},
+        outcomes={},
+        alignments={},
+    )
+    result_id = 1
+    for i in range(courses):
+        course_id = 100 + i
+        dataset["courses"].append(
+            {
+                "id": course_id,
+                "name": f"Course {i}",
+                "enrollment_term_id": term["id"],
+                "sis_course_id": f"C{i:04d}",
+            }
+        )
+        roster = rng.sample(users, min(students, len(users)))
+        half = len(roster) // 2
+        dataset["sections"][str(course_id)] = [
+            {
+                "id": course_id * 10 + k,
+                "name": f"Course {i} Section {k + 1}",
+                "students": [
+                    dict(student, enrollments=[{"enrollment_state": "active"}])
+                    for student in part
+                ],
+            }
+            for k, part in enumerate([roster[:half], roster[half:]])
+        ]
+        dataset["course_users"][str(course_id)] = roster
+
+        results = []
+        for k in range(outcomes):
+            outcome_id = course_id * 100 + k
+            dataset["outcomes"][str(outcome_id)] = {
+                "id": outcome_id,
+                "display_name": f"Outcome {k + 1}",
+                "title": f"Course {i} Outcome {k + 1}",
+                "calculation_int": 65,
+                "calculation_method": "decaying_average",
+                "mastery_points": 3.0,
+            }
+            for a in range(assessments):
+                alignment_id = f"assignment_{outcome_id * 10 + a}"
+                dataset["alignments"][alignment_id] = {
+                    "id": alignment_id,
+                    "name": f"Assignment {a + 1} for outcome {k + 1}",
+                }
+                assessed_at = term_start + timedelta(days=rng.randint(0, 100))
+                for student in roster:
+                    results.append(
+                        {
+                            "id": result_id,
+                            "score": rng.choice([1.0, 2.0, 2.5, 3.0, 3.5, 4.0]),
+                            "submitted_or_assessed_at": _canvas_time(
+                                assessed_at + timedelta(minutes=rng.randint(0, 600))
+                            ),
+                            "links": {
+                                "user": str(student["id"]),
+                                "learning_outcome": str(outcome_id),
+                                "alignment": alignment_id,
+                            },
+                        }
+                    )
+                    result_id += 1
+        dataset["outcome_results"][str(course_id)] = results
+    return dataset
+
+
+def mutate_dataset(dataset, fraction, seed=0):
+    """
+    Reassesses a result in a fraction of the courses, like a day of grading
+    :param dataset: dataset dictionary, changed in place
+    :param fraction: share of courses that change
+    :param seed: random seed
+    :return: number of courses changed
+    """
+    rng = random.Random(seed)
+    course_ids = [str(course["id"]) for course in dataset["courses"]]
+    changed = rng.sample(course_ids, int(round(len(course_ids) * fraction)))
+    now = _canvas_time(datetime.utcnow())
+    for course_id in changed:
+        results = dataset["outcome_results"][course_id]
+        if results:
+            result = rng.choice(results)
+            result["score"] = rng.choice([1.0, 2.0, 3.0, 4.0])
+            result["submitted_or_assessed_at"] = now
+    return len(changed)
+
+
+def load_dataset(path):
+    with open(path) as fp:
+        return json.load(fp)
+
+
+def record_dataset(term_id, path):
+    """
+    Records what the sync reads from the Canvas instance at CANVAS_API_URL for a term
+    :param term_id: enrollment term id
+    :param path: file the dataset is written to
+    :return: None
+    """
+    from utilities import canvas_api
+
+    terms = [
+        dict(term, grading_period_group_id=None)
+        for term in canvas_api.get_enrollment_terms()
+    ]
+    courses = canvas_api.get_courses(term_id)
+    dataset = dict(
+        terms=terms,
+        users=canvas_api.get_users(),
+        courses=courses,
+        sections={},
+        course_users={},
+        outcome_results={},
+        outcomes={},
+        alignments={},
+    )
+    for course in courses:
+        course_id = str(course["id"])
+        dataset["sections"][course_id] = canvas_api.get_sections(course["id"])
+        users = canvas_api.get_course_users(course)
+        dataset["course_users"][course_id] = users
+        results, alignments, outcomes = canvas_api.get_outcome_results(
+            course, user_ids=[user["id"] for user in users]
+        )
+        dataset["outcome_results"][course_id] = results
+        for outcome in outcomes:
+            dataset["outcomes"][str(outcome["id"])] = outcome
+        for alignment in alignments:
+            dataset["alignments"][alignment["id"]] = alignment
+        print(f"course {course_id}: {len(results)} outcome results")
+
+    with open(path, "w") as fp:
+        json.dump(dataset, fp)
+
+
+class FakeCanvas(object):
+    """
+    Answers Canvas API requests from a dataset. Thread safe, the server handles
+    requests concurrently like Canvas does.
+    """
+
+    def __init__(
+        self,
+        dataset,
+        latency=0.0,
+        refill_rate=50.0,
+        bucket_size=RATE_LIMIT_BUCKET,
+        max_per_page=100,
+    ):
+        self.dataset = dataset
+        self.latency = latency
+        self.refill_rate = refill_rate
+        self.bucket_size = bucket_size
+        self.max_per_page = max_per_page
+        self._lock = threading.Lock()
+        self._bucket = bucket_size
+        self._refilled_at = time.monotonic()
+        self.stats = dict(requests=0, rate_limited=0)
+        self.routes = [
+            (r"/api/v1/accounts/\d+/terms", self._terms),
+            (r"/api/v1/accounts/\d+/users", self._users),
+            (r"/api/v1/accounts/\d+/courses", self._courses),
+            (r"/api/v1/courses/(\d+)/sections", self._sections),
+            (r"/api/v1/courses/(\d+)/users", self._course_users),
+            (r"/api/v1/courses/(\d+)/outcome_results", self._outcome_results),
+        ]
+
+    def _spend(self, cost):
+        # Leaky bucket: refills continuously, a request is refused once it's empty
+        with self._lock:
+            now = time.monotonic()
+            self._bucket = min(
+                self.bucket_size,
+                self._bucket + (now - self._refilled_at) * self.refill_rate,
+            )
+            self._refilled_at = now
+            self.stats["requests"] += 1
+            if self._bucket <= 0:
+                self.stats["rate_limited"] += 1
+                return False, self._bucket
+            self._bucket -= cost
+            return True, self._bucket
+
+    def handle(self, url, host):
+        """
+        :param url: request path and query string
+        :param host: Host header, for the pagination links
+        :return: (status, headers, body bytes)
+        """
+        if self.latency:
+            time.sleep(random.uniform(0.5, 1.5) * self.latency)
+        parsed = urlparse(url)
+        query = parse_qs(parsed.query, keep_blank_values=True)
+        for pattern, route in self.routes:
+            match = re.fullmatch(pattern, parsed.path)
+            if match:
+                break
+        else:
+            body = {"errors": [{"message": "The specified resource does not exist."}]}
+            return 404, {}, json.dumps(body).encode()
+
+        items, wrap = route(query, *match.groups())
+        per_page = min(int(query.get("per_page", ["10"])[0]), self.max_per_page)
+        page = int(query.get("page", ["1"])[0])
+        last = max(1, -(-len(items) // per_page))
+        page_items = items[(page - 1) * per_page : page * per_page]
+
+        cost = 1.0 + len(page_items) / 50
+        allowed, remaining = self._spend(cost)
+        headers = {
+            "X-Request-Cost": f"{cost:.4f}",
+            "X-Rate-Limit-Remaining": f"{max(remaining, 0):.4f}",
+        }
+        if not allowed:
+            return 403, headers, b"403 Forbidden (Rate Limit Exceeded)"
+
+        def link(number, rel):
+            page_query = dict(query, page=[str(number)], per_page=[str(per_page)])
+            page_url = f"http://{host}{parsed.path}?{urlencode(page_query, doseq=True)}"
+            return f'<{page_url}>; rel="{rel}"'
+
+        links = [link(page, "current"), link(1, "first"), link(last, "last")]
+        if page < last:
+            links.append(link(page + 1, "next"))
+        if page > 1:
+            links.append(link(page - 1, "prev"))
+        headers["Link"] = ",".join(links)
+        headers["Content-Type"] = "application/json"
+        return 200, headers, json.dumps(wrap(page_items)).encode()
+
+    def _terms(self, query):
+        return self.dataset["terms"], lambda page: {"enrollment_terms": page}
+
+    def _users(self, query):
+        return self.dataset["users"], list
+
+    def _courses(self, query):
+        courses = self.dataset["courses"]
+        term_ids = query.get("enrollment_term_id")
+        if term_ids:
+            courses = [c for c in courses if str(c["enrollment_term_id"]) in term_ids]
+        return courses, list
+
+    def _sections(self, query, course_id):
+        return self.dataset["sections"].get(course_id, []), list
+
+    def _course_users(self, query, course_id):
+        return self.dataset["course_users"].get(course_id, []), list
+
+    def _outcome_results(self, query, course_id):
+        results = self.dataset["outcome_results"].get(course_id, [])
+        user_ids = set(query.get("user_ids[]", []))
+        if user_ids:
+            results = [res for res in results if res["links"]["user"] in user_ids]
+        includes = set(query.get("include[]", []))
+
+        def wrap(page):
+            data = {"outcome_results": page}
+            if includes:
+                # Only the objects the page links to
+                linked = {}
+                if "outcomes" in includes:
+                    ids = {res["links"]["learning_outcome"] for res in page}
+                    linked["outcomes"] = [self.dataset["outcomes"][_id] for _id in ids]
+                if "alignments" in includes:
+                    ids = {res["links"]["alignment"] for res in page}
+                    linked["alignments"] = [
+                        self.dataset["alignments"][_id] for _id in ids
+                    ]
+                data["linked"] = linked
+            return data
+
+        return results, wrap
+
+
+def _make_handler(canvas):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            status, headers, body = canvas.handle(self.path, self.headers["Host"])
+            self.send_response(status)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def start_server(canvas, host="127.0.0.1", port=0):
+    """
+    Serves a FakeCanvas on a background thread
+    :param canvas: FakeCanvas
+    :param host: interface to listen on
+    :param port: port, 0 picks a free one
+    :return: (server, base url for CANVAS_API_URL)
+    """
+    server = ThreadingHTTPServer((host, port), _make_handler(canvas))
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server, f"http://{host}:{server.server_address[1]}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    subparsers = parser.add_subparsers(dest="command")
+
+    serve = subparsers.add_parser("serve", help="serve a synthetic or recorded dataset")
+    serve.add_argument("--dataset", help="recorded dataset, synthetic if not given")
+    serve.add_argument("--courses", type=int, default=20)
+    serve.add_argument("--students", type=int, default=25, help="students per course")
+    serve.add_argument("--outcomes", type=int, default=8, help="outcomes per course")
+    serve.add_argument("--assessments", type=int, default=3, help="per outcome")
+    serve.add_argument("--latency-ms", type=float, default=0)
+    serve.add_argument(
+        "--refill-rate",
+        type=float,
+        default=50,
+        help="rate limit units restored per second",
+    )
+    serve.add_argument("--host", default="127.0.0.1")
+    serve.add_argument("--port", type=int, default=8900)
+
+    record = subparsers.add_parser(
+        "record", help="record a term from the Canvas at CANVAS_API_URL"
+    )
+    record.add_argument("term_id", type=int)
+    record.add_argument("path")
+
+    args = parser.parse_args()
+    if args.command == "serve":
+        if args.dataset:
+            dataset = load_dataset(args.dataset)
+        else:
+            dataset = make_dataset(
+                args.courses, args.students, args.outcomes, args.assessments
+            )
+        canvas = FakeCanvas(
+            dataset, latency=args.latency_ms / 1000, refill_rate=args.refill_rate
+        )
+        server, url = start_server(canvas, args.host, args.port)
+        print(f"fake Canvas serving at {url}, set CANVAS_API_URL={url}")
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            server.shutdown()
+    elif args.command == "record":
+        record_dataset(args.term_id, args.path)
+    else:
+        parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+"""
+Process pool for the grade stage. Courses are graded independently, so they're grouped
+into shards of whole courses and graded in worker processes (or one after another in
+this process). Shards cross the process boundary as
+dictionaries of numpy arrays, which pickle as raw buffers, rather than DataFrames. The
+grades and outcome averages come back the same way and are merged in the parent before
+the database write.
+"""
+import os
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import pandas as pd
+
+from utilities.cbl_calculator import (
+    GRADE_OUTCOME_COLS,
+    OUTCOME_CALCULATION_COLS,
+    add_grade_outcomes,
+    calculate_grade_frames,
+    grade_calculation_method,
+    grade_cut_off_date,
+)
+
+GRADE_WORKERS = int(os.getenv("GRADE_WORKERS", 1))
+# Outcome results per shard, small courses are graded together to save round trips
+GRADE_SHARD_ROWS = int(os.getenv("GRADE_SHARD_ROWS", 50000))
+
+RESULT_COLS = ["links.user", "course_id", "outcome_id", "score", "submitted_or_assessed_at"]
+GRADE_FRAME_COLS = ["links.user", "course_id", "threshold", "min_score", "grade"]
+
+
+def frame_to_arrays(frame, columns):
+    return {col: frame[col].values for col in columns}
+
+
+def grade_shard(
+    result_arrays,
+    cut_off_date,
+    calculation_dictionaries,
+    calculation_method=None,
+    outcome_calculations=None,
+):
+    """
+    Grades one shard, runs in the worker processes
+    :param result_arrays: dictionary of outcome result column arrays (RESULT_COLS)
+    :param cut_off_date: only results before this date are eligible to be dropped
+    :param calculation_dictionaries: grade cutoffs ordered by grade_rank
+    :param calculation_method: the term's calculation method
+    :param outcome_calculations: dictionary of outcome setting column arrays
+        (OUTCOME_CALCULATION_COLS) or None
+    :return: (grade column arrays, outcome average column arrays)
+    """
+    grades, outcome_avgs = calculate_grade_frames(
+        pd.DataFrame(result_arrays),
+        cut_off_date,
+        calculation_dictionaries,
+        calculation_method,
+        outcome_calculations,
+    )
+    return (
+        frame_to_arrays(grades, GRADE_FRAME_COLS),
+        frame_to_arrays(outcome_avgs, GRADE_OUTCOME_COLS),
+    )
+
+
+def make_shards(course_results, shard_rows=None):
+    """
+    Groups whole courses into shards of about shard_rows outcome results
+    :param course_results: iterable of (course_id, DataFrame)
+    :param shard_rows: outcome results per shard, defaults to GRADE_SHARD_ROWS
+    :return: generator of column array dictionaries
+    """
+    shard_rows = shard_rows or GRADE_SHARD_ROWS
+    frames, rows = [], 0
+    for _, frame in course_results:
+        frames.append(frame)
+        rows += len(frame)
+        if rows >= shard_rows:
+            yield frame_to_arrays(pd.concat(frames, ignore_index=True), RESULT_COLS)
+            frames, rows = [], 0
+    if frames:
+        yield frame_to_arrays(pd.concat(frames, ignore_index=True), RESULT_COLS)
+
+
+def _merge_shard(grade_arrays, outcome_arrays):
+    return add_grade_outcomes(
+        pd.DataFrame(grade_arrays, columns=GRADE_FRAME_COLS),
+        pd.DataFrame(outcome_arrays, columns=GRADE_OUTCOME_COLS),
+    )
+
+
+def sharded_course_grades(
+    course_results,
+    current_term,
+    calculation_dictionaries,
+    workers=1,
+    shard_rows=None,
+    outcome_calculations=None,
+):
+    """
+    Grades a term shard by shard, in this process or across a process pool. At most two
+    shards per worker are in flight, so memory stays flat however large the term is.
+    :param course_results: iterable of (course_id, DataFrame) from
+        iter_course_outcome_results
+    :param current_term: term dictionary, for the cut off date and calculation method
+    :param calculation_dictionaries: grade cutoffs ordered by grade_rank
+    :param workers: number of worker processes, 1 grades in this process
+    :param shard_rows: outcome results per shard, defaults to GRADE_SHARD_ROWS
+    :param outcome_calculations: DataFrame of outcome settings
+        (OUTCOME_CALCULATION_COLS), None for the default drop lowest rule
+    :return: DataFrame of grades or None if there were no outcome results
+    """
+    grade_args = (
+        grade_cut_off_date(current_term),
+        calculation_dictionaries,
+        grade_calculation_method(current_term),
+        None
+        if outcome_calculations is None
+        else frame_to_arrays(outcome_calculations, OUTCOME_CALCULATION_COLS),
+    )
+    shards = make_shards(course_results, shard_rows)
+
+    if workers <= 1:
+        grade_frames = [
+            _merge_shard(*grade_shard(shard, *grade_args)) for shard in shards
+        ]
+    else:
+        grade_frames = []
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            pending = set()
+            for shard in shards:
+                if len(pending) >= workers * 2:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    grade_frames += [_merge_shard(*f.result()) for f in done]
+                pending.add(pool.submit(grade_shard, shard, *grade_args))
+            grade_frames += [_merge_shard(*f.result()) for f in pending]
+
+    if not grade_frames:
+        return None
+    return pd.concat(grade_frames, ignore_index=True)
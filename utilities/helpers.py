@@ -72,6 +72,29 @@ def make_outcome_avg_dicts(outcome_results, grades, current_term):
     return outcome_averages
 
 
+def grade_outcome_avg_dicts(grades):
+    """
+    Builds the dashboard rows from the outcome averages stored on each grade at sync time
+    :param grades: Grade models with the user loaded
+    :return: list of student dictionaries with an average per outcome id
+    """
+    outcome_averages = []
+    for grade in grades:
+        student_dict = {
+            "user_name": grade.user.name,
+            "user_id": grade.user.id,
+            "grade": grade.grade,
+            "email": grade.user.login_id,
+            "course_id": grade.course_id,
+        }
+        for outcome in grade.outcomes or []:
+            student_dict[str(outcome["outcome_id"])] = outcome["avg"]
+
+        outcome_averages.append(student_dict)
+
+    return outcome_averages
+
+
 def format_users(users):
     keys = ["id", "name"]
     users = [dict(zip(keys, (user["id"], user["name"]))) for user in users]
@@ -0,0 +1,365 @@
+"""
+Applies queued Canvas Live Events in micro-batches, so grades change within minutes of
+an assessment instead of waiting for the nightly sync.
+
+Outcome result events are upserted straight into outcome_results. Events that can't be
+placed (an outcome, alignment or student the database doesn't know yet, or a result
+missing its student) resync their course from Canvas instead. Enrollment events refresh
+the course roster. Only the touched (user, course) pairs are regraded. The nightly sync
+is still the source of truth and picks up anything this misses.
+
+    python -m utilities.live_events work
+    python -m utilities.live_events work --once
+    python -m utilities.live_events replay recorded_events.jsonl
+"""
+import argparse
+import json
+import os
+import re
+import time
+import traceback
+from datetime import datetime
+
+from redis import Redis
+from sqlalchemy import create_engine
+
+from app.config import configuration
+from app.live_events import (
+    LIVE_EVENTS_FAILED,
+    OUTCOME_RESULT_EVENTS,
+    ENROLLMENT_EVENTS,
+    event_name,
+    pop_live_events,
+    queue_live_events,
+)
+from utilities.data_pull import (
+    NON_GRADED_PATTERN,
+    NON_ACADEMIC_PATTERN,
+    parse_canvas_datetime,
+    regrade_pairs,
+    sync_course_outcome_results,
+    sync_course_rosters,
+)
+from utilities.db_models import Alignments, Outcomes, Users
+from utilities.db_functions import (
+    add_course_sync_result_ids,
+    clear_course_results_digests,
+    delete_outcome_results_by_id,
+    get_course_pairs,
+    get_courses_by_id,
+    get_existing_ids,
+    get_outcome_results_by_id,
+    mark_dirty_pairs,
+    mark_result_pairs_dirty,
+    upsert_outcome_results,
+)
+
+# Live events carry global ids (shard id * 10^13 + local id), the tables use local ids
+SHARD_FACTOR = 10 ** 13
+
+
+def local_id(value):
+    if value in (None, ""):
+        return None
+    return int(value) % SHARD_FACTOR
+
+
+def _course_id(metadata, body):
+    if body.get("course_id") is not None:
+        return local_id(body["course_id"])
+    if metadata.get("context_type") == "Course":
+        return local_id(metadata.get("context_id"))
+    return None
+
+
+def _alignment_id(body):
+    # The outcome results API links results to alignments as e.g. "assignment_123"
+    if body.get("associated_asset_type") == "Assignment":
+        asset_id = local_id(body.get("associated_asset_id"))
+        if asset_id is not None:
+            return f"assignment_{asset_id}"
+    return None
+
+
+def parse_outcome_result_event(event):
+    """
+    Formats an outcome result event like decode_outcome_result_page does a page, ids the
+    event leaves out are None
+    :param event: Live Events payload
+    :return: dictionary with the outcome_results columns plus deleted and event_time
+    """
+    metadata = event.get("metadata") or {}
+    body = event.get("body") or {}
+    submitted_or_assessed_at = (
+        body.get("submitted_at") or body.get("assessed_at") or body.get("created_at")
+    )
+    return {
+        "id": local_id(body.get("id") or body.get("result_id")),
+        "score": body.get("score"),
+        "course_id": _course_id(metadata, body),
+        "user_id": local_id(body.get("user_id")),
+        "outcome_id": local_id(body.get("learning_outcome_id")),
+        "alignment_id": _alignment_id(body),
+        "submitted_or_assessed_at": parse_canvas_datetime(submitted_or_assessed_at),
+        "last_updated": datetime.utcnow(),
+        "deleted": body.get("workflow_state") == "deleted",
+        "event_time": parse_canvas_datetime(metadata.get("event_time")),
+    }
+
+
+def parse_enrollment_event(event):
+    """
+    :param event: Live Events payload
+    :return: dictionary with user_id, course_id, type and workflow_state
+    """
+    body = event.get("body") or {}
+    return {
+        "user_id": local_id(body.get("user_id")),
+        "course_id": local_id(body.get("course_id")),
+        "type": body.get("type"),
+        "workflow_state": body.get("workflow_state"),
+    }
+
+
+def _latest_results(events):
+    # A result can be updated several times in one batch, keep its last event. Events
+    # are queued in arrival order, which decides when a timestamp is missing.
+    results = {}
+    for event in events:
+        result = parse_outcome_result_event(event)
+        if result["id"] is None:
+            print(f"Skipping outcome result event without a result id: {event}")
+            continue
+        previous = results.get(result["id"])
+        if previous is not None and previous["event_time"] and result["event_time"]:
+            if result["event_time"] < previous["event_time"]:
+                continue
+        results[result["id"]] = result
+    return list(results.values())
+
+
+def _fill_from_stored(results, engine):
+    # Updates to a known result may leave out its student, course or alignment
+    stored = get_outcome_results_by_id([res["id"] for res in results], engine)
+    pairs = set()
+    for result in results:
+        previous = stored.get(result["id"])
+        if previous is None:
+            continue
+        for col in ["user_id", "course_id", "outcome_id", "alignment_id"]:
+            if result[col] is None:
+                result[col] = previous[col]
+        if result["submitted_or_assessed_at"] is None:
+            result["submitted_or_assessed_at"] = previous["submitted_or_assessed_at"]
+        # The old pair is regraded too if the result moved
+        pairs.add((previous["user_id"], previous["course_id"]))
+    return stored, pairs
+
+
+def apply_live_events(events, engine):
+    """
+    Applies a batch of Live Events and regrades the (user, course) pairs they touched
+    :param events: list of Live Events payloads
+    :param engine: SQLAlchemy engine
+    :return: dictionary of counts
+    """
+    result_events = [e for e in events if event_name(e) in OUTCOME_RESULT_EVENTS]
+    enrollment_events = [e for e in events if event_name(e) in ENROLLMENT_EVENTS]
+
+    results = _latest_results(result_events)
+    stored, pairs = _fill_from_stored(results, engine)
+    enrollments = [
+        enrollment
+        for enrollment in map(parse_enrollment_event, enrollment_events)
+        if enrollment["type"] == "StudentEnrollment"
+        and enrollment["user_id"] is not None
+    ]
+
+    courses = get_courses_by_id(
+        [res["course_id"] for res in results if res["course_id"] is not None]
+        + [enrollment["course_id"] for enrollment in enrollments],
+        engine,
+    )
+    known_users = get_existing_ids(Users, [res["user_id"] for res in results], engine)
+    known_outcomes = get_existing_ids(
+        Outcomes, [res["outcome_id"] for res in results], engine
+    )
+    known_alignments = get_existing_ids(
+        Alignments, [res["alignment_id"] for res in results], engine
+    )
+
+    upserts, deletes, resync, touched = [], [], set(), set()
+    for result in results:
+        course = courses.get(result["course_id"])
+        if course is None:
+            print(f"Skipping outcome result {result['id']}, unknown course")
+            continue
+        if re.match(NON_GRADED_PATTERN, course["name"]):
+            continue
+        if result["deleted"]:
+            if result["id"] in stored:
+                deletes.append(result["id"])
+                touched.add(stored[result["id"]]["course_id"])
+            continue
+        if (
+            result["user_id"] not in known_users
+            or result["outcome_id"] not in known_outcomes
+            or result["alignment_id"] not in known_alignments
+            or result["submitted_or_assessed_at"] is None
+        ):
+            resync.add(course["id"])
+            continue
+        upserts.append(result)
+        pairs.add((result["user_id"], result["course_id"]))
+
+    cols = [
+        "id",
+        "score",
+        "course_id",
+        "user_id",
+        "outcome_id",
+        "alignment_id",
+        "submitted_or_assessed_at",
+        "last_updated",
+    ]
+    if upserts or deletes:
+        with engine.begin() as conn:
+            if upserts:
+                upsert_outcome_results([{c: res[c] for c in cols} for res in upserts], conn)
+            if deletes:
+                mark_result_pairs_dirty(deletes, conn)
+                delete_outcome_results_by_id(deletes, conn)
+            # Marked in the same transaction, so the nightly regrade still picks them
+            # up if the regrade below fails
+            mark_dirty_pairs(pairs, conn)
+            new_ids = {}
+            for res in upserts:
+                if res["id"] not in stored:
+                    new_ids.setdefault(res["course_id"], []).append(res["id"])
+            for course_id, result_ids in new_ids.items():
+                add_course_sync_result_ids(course_id, result_ids, conn)
+            # The next sync compares these courses with Canvas instead of skipping them
+            touched |= {course_id for _, course_id in pairs}
+            clear_course_results_digests(touched, conn)
+
+    # Roster changes
+    rosters = set()
+    for enrollment in enrollments:
+        course = courses.get(enrollment["course_id"])
+        if course is None:
+            continue
+        if re.match(NON_ACADEMIC_PATTERN, course["name"]):
+            continue
+        rosters.add(course["id"])
+        pairs.add((enrollment["user_id"], course["id"]))
+    if rosters:
+        try:
+            sync_course_rosters(list(rosters), engine)
+        except Exception as e:
+            print(f"Error updating the rosters for courses {sorted(rosters)}: {e}")
+
+    # Courses the events couldn't be applied to directly
+    for course_id in resync:
+        course = courses[course_id]
+        synced, _, _ = sync_course_outcome_results(
+            course, course["enrollment_term_id"], engine
+        )
+        if synced:
+            pairs |= get_course_pairs([course_id], engine)
+
+    grades = regrade_pairs(pairs, engine)
+    counts = dict(
+        events=len(events),
+        upserted=len(upserts),
+        deleted=len(deletes),
+        rosters=len(rosters),
+        resynced=len(resync),
+        regraded=len(pairs),
+        grades=grades,
+    )
+    print(f"live events applied at {datetime.now()}: {counts}")
+    return counts
+
+
+def _make_engine():
+    config = configuration[os.getenv("PULL_CONFIG")]
+    return create_engine(config.SQLALCHEMY_DATABASE_URI)
+
+
+def _redis():
+    return Redis.from_url(os.getenv("REDIS_URL"))
+
+
+def run_worker(batch_size=None, batch_seconds=None, once=False):
+    """
+    Applies queued live events until stopped
+    :param batch_size: most events applied together, defaults to LIVE_EVENTS_BATCH_SIZE
+    :param batch_seconds: longest an event waits for its batch to fill, defaults to
+        LIVE_EVENTS_BATCH_SECONDS
+    :param once: stop once the queue is empty
+    :return: None
+    """
+    if batch_size is None:
+        batch_size = int(os.getenv("LIVE_EVENTS_BATCH_SIZE", 500))
+    if batch_seconds is None:
+        batch_seconds = float(os.getenv("LIVE_EVENTS_BATCH_SECONDS", 30))
+    redis_conn = _redis()
+    engine = _make_engine()
+
+    print(f"live events worker started at {datetime.now()}")
+    while True:
+        events = pop_live_events(
+            redis_conn, batch_size, 0 if once else batch_seconds, wait=1 if once else 5
+        )
+        if not events:
+            if once:
+                break
+            continue
+        try:
+            apply_live_events(events, engine)
+        except Exception as e:
+            # Park the batch rather than retrying it forever, the nightly sync catches up
+            print(f"Error applying {len(events)} live events: {e}")
+            traceback.print_exc()
+            queue_live_events(redis_conn, events, queue=LIVE_EVENTS_FAILED)
+            time.sleep(1)
+    engine.dispose()
+
+
+def replay(path):
+    """
+    Queues recorded Live Events, one JSON payload per line
+    :param path: file of recorded payloads
+    :return: None
+    """
+    with open(path) as fp:
+        events = [json.loads(line) for line in fp if line.strip()]
+    queued = queue_live_events(_redis(), events)
+    print(f"{queued} of {len(events)} events queued")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    subparsers = parser.add_subparsers(dest="command")
+
+    work = subparsers.add_parser("work", help="apply queued live events")
+    work.add_argument("--batch-size", type=int)
+    work.add_argument("--batch-seconds", type=float)
+    work.add_argument(
+        "--once", action="store_true", help="stop once the queue is empty"
+    )
+
+    replay_parser = subparsers.add_parser("replay", help="queue recorded live events")
+    replay_parser.add_argument("path")
+
+    args = parser.parse_args()
+    if args.command == "work":
+        run_worker(args.batch_size, args.batch_seconds, once=args.once)
+    elif args.command == "replay":
+        replay(args.path)
+    else:
+        parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
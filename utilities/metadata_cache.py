@@ -0,0 +1,174 @@
+"""
+Cache of the outcome and alignment metadata the database already has. Course pulls only
+ask Canvas for a page's linked outcomes and alignments when it references one that isn't
+stored, or that hasn't been compared with Canvas recently enough, and only the rows whose
+content changed are written.
+
+Alignments are trusted for METADATA_CACHE_SECONDS. Outcomes carry the calculation
+settings the grades can depend on, so they're only trusted when they were compared with
+Canvas after the sync run started. Every course job of a run shares that boundary, so
+each outcome is asked for about once per run. When an outcome's settings change, the
+students graded with it are marked for regrading.
+
+Each row's content hash and when it was last compared with Canvas are stored with it in
+the outcomes and alignments tables, so the cache carries over between runs and worker
+processes. A cache keeps the rows it has looked up in memory.
+"""
+import hashlib
+import json
+import os
+import threading
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from utilities.db_functions import (
+    get_metadata_hashes,
+    get_outcome_calculation_settings,
+    mark_outcome_pairs_dirty,
+    touch_metadata,
+    upsert_columns,
+)
+from utilities.db_models import Alignments, Outcomes
+
+# How long a stored alignment is trusted before it's compared with Canvas again
+METADATA_CACHE_SECONDS = int(os.getenv("METADATA_CACHE_SECONDS", 7 * 24 * 60 * 60))
+
+
+def content_hashes(columns):
+    """
+    :param columns: column dictionary from decode_outcomes or decode_alignments
+    :return: list of md5 hex digests, one per row
+    """
+    names = sorted(columns)
+    rows = zip(*(columns[name].tolist() for name in names))
+    return [
+        hashlib.md5(json.dumps(row, default=str).encode()).hexdigest() for row in rows
+    ]
+
+
+# Outcome settings the grade calculation reads, see resolve_outcome_calculations
+CALCULATION_COLS = ["calculation_method", "calculation_int", "mastery_points"]
+
+
+def _same_setting(stored, value):
+    # NaN (decoded) and NULL (stored) are the same missing setting
+    if stored is None or (isinstance(stored, float) and np.isnan(stored)):
+        return value is None or (isinstance(value, float) and np.isnan(value))
+    return stored == value
+
+
+class MetadataCache(object):
+    """
+    In-process layer over the content hashes stored with each outcome and alignment.
+    Shared by the course threads of a pull, so lookups hold a lock.
+    """
+
+    def __init__(self, engine, max_age=None, started_at=None):
+        """
+        :param engine: SQLAlchemy engine
+        :param max_age: seconds a stored alignment is trusted, default
+            METADATA_CACHE_SECONDS
+        :param started_at: when the sync run started, outcomes compared with Canvas
+            before it are stale. Defaults to now.
+        """
+        self.engine = engine
+        if max_age is None:
+            max_age = METADATA_CACHE_SECONDS
+        self.max_age = timedelta(seconds=max_age)
+        self.started_at = started_at or datetime.utcnow()
+        self._lock = threading.Lock()
+        # table name: {id: (content_hash, checked_at)}
+        self._known = {Outcomes.name: {}, Alignments.name: {}}
+
+    def _lookup(self, table, ids):
+        known = self._known[table.name]
+        missing = [_id for _id in ids if _id not in known]
+        if missing:
+            # Stored by an earlier run or another process
+            known.update(get_metadata_hashes(table, missing, self.engine))
+        return known
+
+    def _is_fresh(self, table, entry, now):
+        if entry is None or entry[0] is None or entry[1] is None:
+            return False
+        if table is Outcomes:
+            # Checked during this sync run, by this job or another
+            return entry[1] >= self.started_at
+        return now - entry[1] < self.max_age
+
+    def needs_linked(self, outcome_results):
+        """
+        :param outcome_results: a page of Canvas outcome results
+        :return: True if the page references an outcome or alignment that isn't stored,
+            or wasn't compared with Canvas within max_age
+        """
+        outcome_ids = {int(res["links"]["learning_outcome"]) for res in outcome_results}
+        alignment_ids = {res["links"]["alignment"] for res in outcome_results}
+        now = datetime.utcnow()
+        with self._lock:
+            for table, ids in [(Outcomes, outcome_ids), (Alignments, alignment_ids)]:
+                known = self._lookup(table, ids)
+                if not all(self._is_fresh(table, known.get(_id), now) for _id in ids):
+                    return True
+        return False
+
+    def write_changed(self, table, columns):
+        """
+        Upserts the rows whose content changed, and records that the unchanged rows were
+        compared with Canvas
+        :param table: Outcomes or Alignments
+        :param columns: column dictionary from decode_outcomes or decode_alignments
+        :return: number of rows upserted
+        """
+        ids = columns["id"].tolist()
+        if not ids:
+            return 0
+        hashes = content_hashes(columns)
+        now = datetime.utcnow()
+        with self._lock:
+            known = self._lookup(table, ids)
+            stored = [known.get(_id) for _id in ids]
+        changed = np.array(
+            [entry is None or entry[0] != h for entry, h in zip(stored, hashes)],
+            dtype=bool,
+        )
+        stale = {
+            _id
+            for _id, entry, is_changed in zip(ids, stored, changed)
+            if not is_changed and not self._is_fresh(table, entry, now)
+        }
+
+        if changed.any():
+            rows = {col: values[changed] for col, values in columns.items()}
+            rows["content_hash"] = np.array(hashes, dtype=object)[changed]
+            rows["checked_at"] = np.full(changed.sum(), np.datetime64(now, "us"))
+            with self.engine.begin() as conn:
+                if table is Outcomes:
+                    # Marked in the same transaction, so no regrade can miss the change
+                    mark_outcome_pairs_dirty(self._recalculated(rows, conn), conn)
+                upsert_columns(table, rows, conn, index_elements=["id"])
+        if stale:
+            touch_metadata(table, stale, now, self.engine)
+
+        with self._lock:
+            known = self._known[table.name]
+            for _id, h, is_changed in zip(ids, hashes, changed):
+                if is_changed or _id in stale:
+                    known[_id] = (h, now)
+        return int(changed.sum())
+
+    def _recalculated(self, rows, conn):
+        """
+        :param rows: changed outcome rows about to be written
+        :param conn: connection of the write
+        :return: ids of the stored outcomes whose calculation settings changed
+        """
+        stored = get_outcome_calculation_settings(rows["id"].tolist(), conn)
+        settings = zip(*(rows[col].tolist() for col in CALCULATION_COLS))
+        return [
+            _id
+            for _id, setting in zip(rows["id"].tolist(), settings)
+            if _id in stored
+            and not all(map(_same_setting, stored[_id], setting))
+        ]
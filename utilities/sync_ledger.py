@@ -0,0 +1,178 @@
+import resource
+import sys
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+from utilities.canvas_client import client
+from utilities.db_functions import (
+    create_sync_run,
+    update_sync_run,
+    insert_sync_run_stage,
+    get_rows_written,
+)
+
+
+def _peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        return peak / (1024 * 1024)
+    return peak / 1024
+
+
+def _snapshot():
+    stats = client.get_stats()
+    return dict(
+        wall=time.perf_counter(),
+        cpu=time.process_time(),
+        requests=stats["requests"],
+        bytes=stats["bytes"],
+        rows=get_rows_written(),
+    )
+
+
+class SyncRunLedger(object):
+    """
+    Records a sync run in the sync_runs/sync_run_stages tables: wall time, CPU time,
+    peak RSS, Canvas requests and bytes, and rows written for every stage, plus a row
+    per course. CPU time and peak RSS are for the whole process, so stages running in
+    parallel threads share them. A ledger without a sync_run_id records nothing.
+    """
+
+    def __init__(self, engine, sync_run_id=None):
+        self.engine = engine
+        self.sync_run_id = sync_run_id
+
+    @classmethod
+    def start(cls, engine, kind, checkpoint_run_id=None):
+        """
+        Creates the run's ledger entry
+        :param engine: SQLAlchemy engine
+        :param kind: full_sync, serial_sync or regrade
+        :param checkpoint_run_id: id the run's checkpoints are stored under
+        :return: SyncRunLedger
+        """
+        sync_run_id = create_sync_run(kind, engine, checkpoint_run_id=checkpoint_run_id)
+        print(f"sync run {sync_run_id} started")
+        return cls(engine, sync_run_id)
+
+    def _record(self, stage, start, end, term_id=None, course_id=None, **values):
+        if self.sync_run_id is None:
+            return
+        row = dict(
+            sync_run_id=self.sync_run_id,
+            stage=stage,
+            term_id=term_id,
+            course_id=course_id,
+            wall_seconds=end["wall"] - start["wall"],
+            cpu_seconds=end["cpu"] - start["cpu"],
+            peak_rss_mb=_peak_rss_mb(),
+            canvas_requests=end["requests"] - start["requests"],
+            canvas_bytes=end["bytes"] - start["bytes"],
+            rows_written=end["rows"] - start["rows"],
+            recorded_at=datetime.utcnow(),
+        )
+        row.update(values)
+        insert_sync_run_stage(row, self.engine)
+        print(
+            f"{stage} took {row['wall_seconds']:.1f}s "
+            f"({row['cpu_seconds']:.1f}s CPU, {row['canvas_requests']} Canvas requests, "
+            f"{row['rows_written']} rows written)"
+        )
+
+    @contextmanager
+    def stage(self, stage, term_id=None, course_id=None):
+        """
+        Measures the code inside the with block as one stage
+        :param stage: stage name
+        :param term_id: term the stage ran for
+        :param course_id: course the stage ran for
+        :return: dictionary the block can add columns to (results, failed)
+        """
+        start = _snapshot()
+        values = {}
+        try:
+            yield values
+        except Exception:
+            values["failed"] = True
+            self._record(stage, start, _snapshot(), term_id, course_id, **values)
+            raise
+        values.setdefault("failed", False)
+        self._record(stage, start, _snapshot(), term_id, course_id, **values)
+
+    def record_course(
+        self,
+        course_id,
+        term_id=None,
+        synced=True,
+        results=None,
+        skipped=None,
+        seconds=None,
+        rows_written=None,
+        canvas_requests=None,
+    ):
+        """
+        Adds a course measured by the caller, for courses synced side by side in threads
+        :return: None
+        """
+        if self.sync_run_id is None:
+            return
+        insert_sync_run_stage(
+            dict(
+                sync_run_id=self.sync_run_id,
+                stage="course",
+                term_id=term_id,
+                course_id=course_id,
+                wall_seconds=seconds,
+                canvas_requests=canvas_requests,
+                rows_written=rows_written,
+                results=results,
+                skipped=skipped,
+                failed=not synced,
+                recorded_at=datetime.utcnow(),
+            ),
+            self.engine,
+        )
+
+    def finish(self, status):
+        if self.sync_run_id is None:
+            return
+        update_sync_run(
+            self.sync_run_id, self.engine, finished_at=datetime.utcnow(), status=status
+        )
+
+
+class LedgerProgress(object):
+    """
+    Progress reporter for cron.run: records each finished course in the ledger and
+    passes everything on to another reporter (e.g. the rq task's)
+    """
+
+    def __init__(self, ledger, term_id=None, progress=None):
+        self.ledger = ledger
+        self.term_id = term_id
+        self.progress = progress
+        # Courses whose outcome results were unchanged
+        self.skipped = 0
+
+    def stage(self, stage):
+        if self.progress is not None:
+            self.progress.stage(stage)
+
+    def add_courses(self, total):
+        if self.progress is not None:
+            self.progress.add_courses(total)
+
+    def course_done(self, course_id, synced, results, **kwargs):
+        self.skipped += kwargs.get("skipped") or 0
+        self.ledger.record_course(
+            course_id, term_id=self.term_id, synced=synced, results=results, **kwargs
+        )
+        if self.progress is not None:
+            self.progress.course_done(
+                course_id,
+                synced,
+                results,
+                canvas_requests=kwargs.get("canvas_requests"),
+            )